@@ -0,0 +1,317 @@
+import asyncio
+import math
+import socket
+
+import msgpack
+from msgpackrpc.error import RPCError, TimeoutError, TransportError
+
+from airsim_client import (AirSimClientBase, AirSimImageType, CarObservation, CarState, CollisionInfo, DrivetrainType, GeoPoint,
+                           ImageRequest, ImageResponse, Quaternionr, Vector3r, YawMode)
+
+
+# The message types of the msgpack-rpc protocol
+REQUEST = 0
+RESPONSE = 1
+NOTIFY = 2
+
+DEFAULT_TIMEOUT_SEC = 5
+
+
+# A msgpack-rpc client for asyncio.
+# Any number of requests can be in flight on the connection at once, each one is matched to its reply by its message id.
+# Every call has a timeout, the client's default or the one given to the call.
+# The connection is opened by the first call.
+class AsyncRpcClient(object):
+    def __init__(self, host, port, timeout=DEFAULT_TIMEOUT_SEC):
+        self.__host = host
+        self.__port = port
+        self.__timeout = timeout
+        self.__reader = None
+        self.__writer = None
+        self.__read_task = None
+        self.__connect_lock = asyncio.Lock()
+        self.__packer = msgpack.Packer(default=lambda x: x.to_msgpack(), use_bin_type=False)
+        self.__next_message_id = 0
+        self.__pending = {}
+
+    @property
+    def is_connected(self):
+        return self.__writer is not None
+
+    async def connect(self):
+        async with self.__connect_lock:
+            if self.is_connected:
+                return
+            self.__reader, self.__writer = await asyncio.wait_for(asyncio.open_connection(self.__host, self.__port), self.__timeout)
+
+            # Concurrent requests are written back to back, do not hold them back until the previous ones are acknowledged
+            connection = self.__writer.get_extra_info('socket')
+            if (connection is not None):
+                connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            self.__read_task = asyncio.ensure_future(self.__read_responses(self.__reader))
+
+    async def close(self):
+        if (self.__writer is not None):
+            self.__writer.close()
+        if (self.__read_task is not None):
+            self.__read_task.cancel()
+        self.__reader = None
+        self.__writer = None
+        self.__read_task = None
+        self.__fail_pending(TransportError('The connection was closed'))
+
+    # Calls a method on the server and returns its result.
+    # timeout overrides the client's timeout for this call, None means the client's.
+    async def call(self, method, *args, timeout=None):
+        if not self.is_connected:
+            await self.connect()
+
+        message_id = self.__next_message_id
+        self.__next_message_id = (self.__next_message_id + 1) & 0xFFFFFFFF
+        future = asyncio.get_event_loop().create_future()
+        self.__pending[message_id] = future
+
+        self.__writer.write(self.__packer.pack([REQUEST, message_id, method, args]))
+        try:
+            return await asyncio.wait_for(future, self.__timeout if timeout is None else timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError('Request {0} timed out'.format(method))
+        finally:
+            self.__pending.pop(message_id, None)
+
+    # Sends a notification, which the server does not reply to
+    async def notify(self, method, *args):
+        if not self.is_connected:
+            await self.connect()
+        self.__writer.write(self.__packer.pack([NOTIFY, method, args]))
+        await self.__writer.drain()
+
+    async def __read_responses(self, reader):
+        # Like the synchronous clients, strings are decoded to str and arrays to tuples, binary payloads stay bytes
+        unpacker = msgpack.Unpacker(raw=False, use_list=False)
+        try:
+            while True:
+                data = await reader.read(1 << 16)
+                if not data:
+                    break
+                unpacker.feed(data)
+                for message in unpacker:
+                    if (len(message) != 4 or message[0] != RESPONSE):
+                        continue
+                    _, message_id, error, result = message
+                    future = self.__pending.get(message_id)
+                    if (future is None or future.done()):
+                        continue
+                    if (error is not None):
+                        future.set_exception(RPCError(error))
+                    else:
+                        future.set_result(result)
+        except (ConnectionError, OSError) as e:
+            self.__drop_connection(reader, TransportError(str(e)))
+            return
+        self.__drop_connection(reader, TransportError('The connection was closed by the server'))
+
+    # Forgets a connection that the server closed or that failed, so that the next call reconnects.
+    # Nothing is done if the client has been closed or has reconnected since, close() has already failed the pending calls.
+    def __drop_connection(self, reader, error):
+        if (self.__reader is reader):
+            if (self.__writer is not None):
+                self.__writer.close()
+            self.__reader = None
+            self.__writer = None
+            self.__read_task = None
+            self.__fail_pending(error)
+
+    def __fail_pending(self, error):
+        for future in self.__pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self.__pending = {}
+
+
+# The asyncio counterpart of AirSimClientBase.
+# The methods have the same names and arguments, and are awaitable. Each one also takes an optional timeout.
+class AsyncAirSimClientBase(object):
+    def __init__(self, ip, port, timeout=DEFAULT_TIMEOUT_SEC):
+        self.client = AsyncRpcClient(ip, port, timeout)
+
+    async def close(self):
+        await self.client.close()
+
+    async def ping(self, timeout=None):
+        return await self.client.call('ping', timeout=timeout)
+
+    async def reset(self, timeout=None):
+        await self.client.call('reset', timeout=timeout)
+
+    async def confirmConnection(self, timeout=None):
+        print('Waiting for connection: ', end='')
+        home = await self.getHomeGeoPoint(timeout=timeout)
+        while ((home.latitude == 0 and home.longitude == 0 and home.altitude == 0) or
+                math.isnan(home.latitude) or math.isnan(home.longitude) or math.isnan(home.altitude)):
+            await asyncio.sleep(1)
+            home = await self.getHomeGeoPoint(timeout=timeout)
+            print('X', end='')
+        print('')
+
+    async def getHomeGeoPoint(self, timeout=None):
+        return GeoPoint.from_msgpack(await self.client.call('getHomeGeoPoint', timeout=timeout))
+
+    async def enableApiControl(self, is_enabled, timeout=None):
+        return await self.client.call('enableApiControl', is_enabled, timeout=timeout)
+
+    async def isApiControlEnabled(self, timeout=None):
+        return await self.client.call('isApiControlEnabled', timeout=timeout)
+
+    async def simSetSegmentationObjectID(self, mesh_name, object_id, is_name_regex=False, timeout=None):
+        return await self.client.call('simSetSegmentationObjectID', mesh_name, object_id, is_name_regex, timeout=timeout)
+
+    async def simGetSegmentationObjectID(self, mesh_name, timeout=None):
+        return await self.client.call('simGetSegmentationObjectID', mesh_name, timeout=timeout)
+
+    async def simGetImage(self, camera_id, image_type, timeout=None):
+        result = await self.client.call('simGetImage', camera_id, image_type, timeout=timeout)
+        if (result == "" or result == "\0"):
+            return None
+        return result
+
+    async def simGetImages(self, requests, timeout=None):
+        responses_raw = await self.client.call('simGetImages', requests, timeout=timeout)
+        return [ImageResponse.from_msgpack(response_raw) for response_raw in responses_raw]
+
+    async def getCollisionInfo(self, timeout=None):
+        return CollisionInfo.from_msgpack(await self.client.call('getCollisionInfo', timeout=timeout))
+
+    async def simSetPose(self, pose, ignore_collison, timeout=None):
+        await self.client.call('simSetPose', pose, ignore_collison, timeout=timeout)
+
+    async def simGetPose(self, timeout=None):
+        return await self.client.call('simGetPose', timeout=timeout)
+
+    stringToUint8Array = staticmethod(AirSimClientBase.stringToUint8Array)
+    stringToFloatArray = staticmethod(AirSimClientBase.stringToFloatArray)
+    listTo2DFloatArray = staticmethod(AirSimClientBase.listTo2DFloatArray)
+    getPfmArray = staticmethod(AirSimClientBase.getPfmArray)
+    toEulerianAngle = staticmethod(AirSimClientBase.toEulerianAngle)
+    toQuaternion = staticmethod(AirSimClientBase.toQuaternion)
+
+
+# The asyncio counterpart of MultirotorClient
+class AsyncMultirotorClient(AsyncAirSimClientBase):
+    def __init__(self, ip="", port=41451, timeout=DEFAULT_TIMEOUT_SEC):
+        if (ip == ""):
+            ip = "127.0.0.1"
+        super(AsyncMultirotorClient, self).__init__(ip, port, timeout)
+
+    async def armDisarm(self, arm, timeout=None):
+        return await self.client.call('armDisarm', arm, timeout=timeout)
+
+    # The long running commands wait for the vehicle, so by default they are allowed max_wait_seconds on top of the client's timeout
+    async def takeoff(self, max_wait_seconds=15, timeout=None):
+        return await self.client.call('takeoff', max_wait_seconds, timeout=self.__command_timeout(max_wait_seconds, timeout))
+
+    async def land(self, max_wait_seconds=60, timeout=None):
+        return await self.client.call('land', max_wait_seconds, timeout=self.__command_timeout(max_wait_seconds, timeout))
+
+    async def goHome(self, timeout=None):
+        return await self.client.call('goHome', timeout=timeout)
+
+    async def hover(self, timeout=None):
+        return await self.client.call('hover', timeout=timeout)
+
+    async def getPosition(self, timeout=None):
+        return Vector3r.from_msgpack(await self.client.call('getPosition', timeout=timeout))
+
+    async def getVelocity(self, timeout=None):
+        return Vector3r.from_msgpack(await self.client.call('getVelocity', timeout=timeout))
+
+    async def getOrientation(self, timeout=None):
+        return Quaternionr.from_msgpack(await self.client.call('getOrientation', timeout=timeout))
+
+    async def getLandedState(self, timeout=None):
+        return await self.client.call('getLandedState', timeout=timeout)
+
+    async def getGpsLocation(self, timeout=None):
+        return GeoPoint.from_msgpack(await self.client.call('getGpsLocation', timeout=timeout))
+
+    async def getPitchRollYaw(self, timeout=None):
+        return self.toEulerianAngle(await self.getOrientation(timeout=timeout))
+
+    async def timestampNow(self, timeout=None):
+        return await self.client.call('timestampNow', timeout=timeout)
+
+    async def isSimulationMode(self, timeout=None):
+        return await self.client.call('isSimulationMode', timeout=timeout)
+
+    async def getServerDebugInfo(self, timeout=None):
+        return await self.client.call('getServerDebugInfo', timeout=timeout)
+
+    async def moveByAngle(self, pitch, roll, z, yaw, duration, timeout=None):
+        return await self.client.call('moveByAngle', pitch, roll, z, yaw, duration, timeout=timeout)
+
+    async def moveByVelocity(self, vx, vy, vz, duration, drivetrain=DrivetrainType.MaxDegreeOfFreedom, yaw_mode=YawMode(), timeout=None):
+        return await self.client.call('moveByVelocity', vx, vy, vz, duration, drivetrain, yaw_mode, timeout=timeout)
+
+    async def moveByVelocityZ(self, vx, vy, z, duration, drivetrain=DrivetrainType.MaxDegreeOfFreedom, yaw_mode=YawMode(), timeout=None):
+        return await self.client.call('moveByVelocityZ', vx, vy, z, duration, drivetrain, yaw_mode, timeout=timeout)
+
+    async def moveOnPath(self, path, velocity, max_wait_seconds=60, drivetrain=DrivetrainType.MaxDegreeOfFreedom, yaw_mode=YawMode(),
+                         lookahead=-1, adaptive_lookahead=1, timeout=None):
+        return await self.client.call('moveOnPath', path, velocity, max_wait_seconds, drivetrain, yaw_mode, lookahead, adaptive_lookahead,
+                                      timeout=self.__command_timeout(max_wait_seconds, timeout))
+
+    async def moveToZ(self, z, velocity, max_wait_seconds=60, yaw_mode=YawMode(), lookahead=-1, adaptive_lookahead=1, timeout=None):
+        return await self.client.call('moveToZ', z, velocity, max_wait_seconds, yaw_mode, lookahead, adaptive_lookahead,
+                                      timeout=self.__command_timeout(max_wait_seconds, timeout))
+
+    async def moveToPosition(self, x, y, z, velocity, max_wait_seconds=60, drivetrain=DrivetrainType.MaxDegreeOfFreedom, yaw_mode=YawMode(),
+                             lookahead=-1, adaptive_lookahead=1, timeout=None):
+        return await self.client.call('moveToPosition', x, y, z, velocity, max_wait_seconds, drivetrain, yaw_mode, lookahead, adaptive_lookahead,
+                                      timeout=self.__command_timeout(max_wait_seconds, timeout))
+
+    async def moveByManual(self, vx_max, vy_max, z_min, duration, drivetrain=DrivetrainType.MaxDegreeOfFreedom, yaw_mode=YawMode(), timeout=None):
+        return await self.client.call('moveByManual', vx_max, vy_max, z_min, duration, drivetrain, yaw_mode, timeout=timeout)
+
+    async def rotateToYaw(self, yaw, max_wait_seconds=60, margin=5, timeout=None):
+        return await self.client.call('rotateToYaw', yaw, max_wait_seconds, margin, timeout=self.__command_timeout(max_wait_seconds, timeout))
+
+    async def rotateByYawRate(self, yaw_rate, duration, timeout=None):
+        return await self.client.call('rotateByYawRate', yaw_rate, duration, timeout=timeout)
+
+    def __command_timeout(self, max_wait_seconds, timeout):
+        if (timeout is not None):
+            return timeout
+        return max_wait_seconds + DEFAULT_TIMEOUT_SEC
+
+
+# The asyncio counterpart of CarClient.
+# The calls of observe and step are all in flight at once, so a step costs a single round trip, like CarClient.step.
+class AsyncCarClient(AsyncAirSimClientBase):
+    def __init__(self, ip="", port=42451, timeout=DEFAULT_TIMEOUT_SEC):
+        if (ip == ""):
+            ip = "127.0.0.1"
+        super(AsyncCarClient, self).__init__(ip, port, timeout)
+
+    async def setCarControls(self, controls, timeout=None):
+        await self.client.call('setCarControls', controls, timeout=timeout)
+
+    async def getCarState(self, timeout=None):
+        return CarState.from_msgpack(await self.client.call('getCarState', timeout=timeout))
+
+    async def observe(self, image_requests=None, timeout=None):
+        if (image_requests is None):
+            image_requests = [ImageRequest(0, AirSimImageType.Scene, False, False)]
+        images, car_state, collision_info = await asyncio.gather(self.simGetImages(image_requests, timeout=timeout),
+                                                                 self.getCarState(timeout=timeout),
+                                                                 self.getCollisionInfo(timeout=timeout))
+        return CarObservation(images, car_state, collision_info)
+
+    # Sends the controls, waits delay_sec for them to take effect, then gets the images, the car state and the collision info
+    async def step(self, controls, delay_sec=0, image_requests=None, timeout=None):
+        controls_call = asyncio.ensure_future(self.setCarControls(controls, timeout=timeout))
+        if (delay_sec > 0):
+            await asyncio.sleep(delay_sec)
+        observation = await self.observe(image_requests, timeout=timeout)
+        await controls_call
+        return observation
@@ -1,5 +1,8 @@
 from __future__ import print_function
+import msgpack
 import msgpackrpc
+from msgpackrpc.transport import tcp
+from tornado.iostream import IOStream
 import numpy as np
 import math
 import time
@@ -7,18 +10,54 @@ import sys
 import os
 import inspect
 import re
+import socket
 
 
-class MsgpackMixin:
+# The metaclass of the message classes.
+# A message class lists its fields in _fields as (name, default) pairs. The fields become __slots__, so messages have no __dict__.
+# A field whose default is itself a message class holds a nested message of that class, decoded recursively by from_msgpack.
+# The fields are listed once per class in _decoders, the (name, nested message class or None, default) of each field.
+# The default of a nested message is an instance of its class, which all of the decoded messages that lack the field share,
+# as the class attributes of the original message classes did.
+class MessageType(type):
+    def __new__(mcs, name, bases, namespace):
+        fields = namespace.get('_fields', ())
+        namespace['__slots__'] = tuple(field_name for field_name, _ in fields)
+        cls = super(MessageType, mcs).__new__(mcs, name, bases, namespace)
+        cls._decoders = tuple((field_name, default, default()) if isinstance(default, MessageType) else (field_name, None, default)
+                              for field_name, default in fields)
+        return cls
+
+
+class MsgpackMixin(metaclass=MessageType):
+    _fields = ()
+
+    def __init__(self):
+        for name, message_type, default in self._decoders:
+            setattr(self, name, message_type() if message_type is not None else default)
+
     def to_msgpack(self, *args, **kwargs):
-        return self.__dict__
+        return {name: getattr(self, name) for name, _, _ in self._decoders}
 
+    # Builds a message from its decoded msgpack map.
+    # The keys can be str, as the clients decode them, or bytes, as a raw msgpack decoder returns them.
+    # Missing fields take their default, and fields that the class does not declare are ignored.
     @classmethod
     def from_msgpack(cls, encoded):
-        obj = cls()
-        obj.__dict__ = {k.decode('utf-8'): v for k, v in encoded.items()}
+        if (len(encoded) > 0 and type(next(iter(encoded))) is bytes):
+            encoded = {k.decode('utf-8'): v for k, v in encoded.items()}
+        obj = object.__new__(cls)
+        for name, message_type, default in cls._decoders:
+            if (message_type is None):
+                setattr(obj, name, encoded.get(name, default))
+            else:
+                value = encoded.get(name)
+                setattr(obj, name, default if value is None else message_type.from_msgpack(value))
         return obj
 
+    def __repr__(self):
+        return '{0}({1})'.format(type(self).__name__, ', '.join('{0}={1!r}'.format(name, getattr(self, name)) for name, _, _ in self._decoders))
+
 
 class AirSimImageType:    
     Scene = 0
@@ -38,64 +77,62 @@ class LandedState:
     Flying = 1
 
 class Vector3r(MsgpackMixin):
-    x_val = np.float32(0)
-    y_val = np.float32(0)
-    z_val = np.float32(0)
+    _fields = (('x_val', 0.0), ('y_val', 0.0), ('z_val', 0.0))
 
-    def __init__(self, x_val = np.float32(0), y_val = np.float32(0), z_val = np.float32(0)):
+    def __init__(self, x_val = 0.0, y_val = 0.0, z_val = 0.0):
         self.x_val = x_val
         self.y_val = y_val
         self.z_val = z_val
 
 
 class Quaternionr(MsgpackMixin):
-    w_val = np.float32(0)
-    x_val = np.float32(0)
-    y_val = np.float32(0)
-    z_val = np.float32(0)
+    _fields = (('w_val', 1.0), ('x_val', 0.0), ('y_val', 0.0), ('z_val', 0.0))
 
-    def __init__(self, x_val = np.float32(0), y_val = np.float32(0), z_val = np.float32(0), w_val = np.float32(1)):
+    def __init__(self, x_val = 0.0, y_val = 0.0, z_val = 0.0, w_val = 1.0):
         self.x_val = x_val
         self.y_val = y_val
         self.z_val = z_val
         self.w_val = w_val
 
 class Pose(MsgpackMixin):
-    position = Vector3r()
-    orientation = Quaternionr()
+    _fields = (('position', Vector3r), ('orientation', Quaternionr))
 
     def __init__(self, position_val, orientation_val):
         self.position = position_val
         self.orientation = orientation_val
 
 
+class KinematicsState(MsgpackMixin):
+    _fields = (('position', Vector3r),
+               ('orientation', Quaternionr),
+               ('linear_velocity', Vector3r),
+               ('angular_velocity', Vector3r),
+               ('linear_acceleration', Vector3r),
+               ('angular_acceleration', Vector3r))
+
+
 class CollisionInfo(MsgpackMixin):
-    has_collided = False
-    normal = Vector3r()
-    impact_point = Vector3r()
-    position = Vector3r()
-    penetration_depth = np.float32(0)
-    time_stamp = np.float32(0)
-    object_name = ""
-    object_id = -1
+    _fields = (('has_collided', False),
+               ('normal', Vector3r),
+               ('impact_point', Vector3r),
+               ('position', Vector3r),
+               ('penetration_depth', 0.0),
+               ('time_stamp', 0.0),
+               ('object_name', ""),
+               ('object_id', -1))
 
 class GeoPoint(MsgpackMixin):
-    latitude = 0.0
-    longitude = 0.0
-    altitude = 0.0
+    _fields = (('latitude', 0.0), ('longitude', 0.0), ('altitude', 0.0))
 
 class YawMode(MsgpackMixin):
-    is_rate = True
-    yaw_or_rate = 0.0
+    _fields = (('is_rate', True), ('yaw_or_rate', 0.0))
+
     def __init__(self, is_rate = True, yaw_or_rate = 0.0):
         self.is_rate = is_rate
         self.yaw_or_rate = yaw_or_rate
 
 class ImageRequest(MsgpackMixin):
-    camera_id = np.uint8(0)
-    image_type = AirSimImageType.Scene
-    pixels_as_float = False
-    compress = False
+    _fields = (('camera_id', 0), ('image_type', AirSimImageType.Scene), ('pixels_as_float', False), ('compress', False))
 
     def __init__(self, camera_id, image_type, pixels_as_float = False, compress = True):
         self.camera_id = camera_id
@@ -104,27 +141,28 @@ class ImageRequest(MsgpackMixin):
         self.compress = compress
 
 
+# image_data_uint8 is the raw payload as sent by the server, a bytes object that np.frombuffer can wrap without copying
 class ImageResponse(MsgpackMixin):
-    image_data_uint8 = np.uint8(0)
-    image_data_float = np.float32(0)
-    camera_position = Vector3r()
-    camera_orientation = Quaternionr()
-    time_stamp = np.uint64(0)
-    message = ''
-    pixels_as_float = np.float32(0)
-    compress = True
-    width = 0
-    height = 0
-    image_type = AirSimImageType.Scene
+    _fields = (('image_data_uint8', 0),
+               ('image_data_float', 0.0),
+               ('camera_position', Vector3r),
+               ('camera_orientation', Quaternionr),
+               ('time_stamp', 0),
+               ('message', ''),
+               ('pixels_as_float', 0.0),
+               ('compress', True),
+               ('width', 0),
+               ('height', 0),
+               ('image_type', AirSimImageType.Scene))
 
 class CarControls(MsgpackMixin):
-    throttle = np.float32(0)
-    steering = np.float32(0)
-    brake = np.float32(0)
-    handbrake = False
-    is_manual_gear = False
-    manual_gear = 0
-    gear_immediate = True
+    _fields = (('throttle', 0.0),
+               ('steering', 0.0),
+               ('brake', 0.0),
+               ('handbrake', False),
+               ('is_manual_gear', False),
+               ('manual_gear', 0),
+               ('gear_immediate', True))
 
     def set_throttle(self, throttle_val, forward):
         if (forward):
@@ -136,16 +174,57 @@ class CarControls(MsgpackMixin):
             manual_gear = -1
             throttle = - abs(throttle_val)
 
+# kinematics_true is the true kinematics of the car, position, velocity and orientation are the fields of older servers
 class CarState(MsgpackMixin):
-    speed = np.float32(0)
-    gear = 0
-    position = Vector3r()
-    velocity = Vector3r()
-    orientation = Quaternionr()
+    _fields = (('speed', 0.0),
+               ('gear', 0),
+               ('rpm', 0.0),
+               ('maxrpm', 0.0),
+               ('handbrake', False),
+               ('collision', CollisionInfo),
+               ('kinematics_true', KinematicsState),
+               ('timestamp', 0),
+               ('position', Vector3r),
+               ('velocity', Vector3r),
+               ('orientation', Quaternionr))
+
+# The result of CarClient.step and CarClient.observe: the image responses, the car state and the collision info, captured together
+class CarObservation:
+    __slots__ = ('images', 'car_state', 'collision_info')
+
+    def __init__(self, images, car_state, collision_info):
+        self.images = images
+        self.car_state = car_state
+        self.collision_info = collision_info
+
+# The address of a msgpack-rpc server, connected to with Nagle's algorithm disabled.
+# Pipelined calls write several small requests back to back, which would otherwise be held back until the previous ones are acknowledged.
+class NoDelayAddress(msgpackrpc.Address):
+    def socket(self):
+        sock = super(NoDelayAddress, self).socket()
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+# The msgpack-rpc client connection of the AirSim clients.
+# Replies are unpacked with strings decoded to str and arrays as tuples, which is cheaper than lists.
+# Binary payloads, such as the image data, stay bytes objects.
+class TypedClientSocket(tcp.ClientSocket):
+    def __init__(self, stream, transport, encodings):
+        tcp.ClientSocket.__init__(self, stream, transport, encodings)
+        self._unpacker = msgpack.Unpacker(raw=False, use_list=False)
+
+class TypedClientTransport(tcp.ClientTransport):
+    def connect(self):
+        stream = IOStream(self._address.socket(), io_loop=self._session._loop._ioloop)
+        TypedClientSocket(stream, self, self._encodings).connect()
+
+# The transport builder passed to msgpackrpc.Client
+class TypedTransportBuilder:
+    ClientTransport = TypedClientTransport
 
 class AirSimClientBase:
     def __init__(self, ip, port):
-        self.client = msgpackrpc.Client(msgpackrpc.Address(ip, port), timeout = 5)
+        self.client = msgpackrpc.Client(NoDelayAddress(ip, port), timeout = 5, builder = TypedTransportBuilder)
         
     def ping(self):
         return self.client.call('ping')
@@ -197,12 +276,21 @@ class AirSimClientBase:
     def getCollisionInfo(self):
         return CollisionInfo.from_msgpack(self.client.call('getCollisionInfo'))
 
+    # The arrays are read-only views of bstr, not copies
     @staticmethod
     def stringToUint8Array(bstr):
-        return np.fromstring(bstr, np.uint8)
+        return np.frombuffer(bstr, np.uint8)
     @staticmethod
     def stringToFloatArray(bstr):
-        return np.fromstring(bstr, np.float32)
+        return np.frombuffer(bstr, np.float32)
+    # Copies the region of an uncompressed image response, such as np.s_[76:135, 0:255, 0:3], into out.
+    # The image data is viewed in place, so the only copy is the one of the region into the preallocated out array.
+    @staticmethod
+    def copyImageRegion(image_response, out, region):
+        image1d = np.frombuffer(image_response.image_data_uint8, np.uint8)
+        image = image1d.reshape(image_response.height, image_response.width, -1)
+        np.copyto(out, image[region])
+        return out
     @staticmethod
     def listTo2DFloatArray(flst, width, height):
         return np.reshape(np.asarray(flst, np.float32), (height, width))
@@ -411,10 +499,10 @@ class AirSimClientBase:
 
 # -----------------------------------  Multirotor APIs ---------------------------------------------
 class MultirotorClient(AirSimClientBase, object):
-    def __init__(self, ip = ""):
+    def __init__(self, ip = "", port = 41451):
         if (ip == ""):
             ip = "127.0.0.1"
-        super(MultirotorClient, self).__init__(ip, 41451)
+        super(MultirotorClient, self).__init__(ip, port)
 
     def armDisarm(self, arm):
         return self.client.call('armDisarm', arm)
@@ -486,10 +574,10 @@ class MultirotorClient(AirSimClientBase, object):
 
 # -----------------------------------  Car APIs ---------------------------------------------
 class CarClient(AirSimClientBase, object):
-    def __init__(self, ip = ""):
+    def __init__(self, ip = "", port = 42451):
         if (ip == ""):
             ip = "127.0.0.1"
-        super(CarClient, self).__init__(ip, 42451)
+        super(CarClient, self).__init__(ip, port)
 
     def setCarControls(self, controls):
         self.client.call('setCarControls', controls)
@@ -497,3 +585,33 @@ class CarClient(AirSimClientBase, object):
     def getCarState(self):
         state_raw = self.client.call('getCarState')
         return CarState.from_msgpack(state_raw)
+
+    # Gets the images, the car state and the collision info.
+    # The three calls are pipelined on the connection, so they cost a single round trip.
+    # By default, the uncompressed scene image of camera 0 is requested.
+    def observe(self, image_requests = None):
+        return self.__get_observation(self.__send_observation_requests(image_requests))
+
+    # Sends the controls, waits delay_sec for them to take effect, then gets the images, the car state and the collision info.
+    # All of the calls are pipelined: the controls are sent without waiting for their reply,
+    # and the replies of the whole step arrive in a single round trip.
+    def step(self, controls, delay_sec = 0, image_requests = None):
+        controls_future = self.client.call_async('setCarControls', controls)
+        if (delay_sec > 0):
+            time.sleep(delay_sec)
+        observation_futures = self.__send_observation_requests(image_requests)
+
+        controls_future.get()
+        return self.__get_observation(observation_futures)
+
+    def __send_observation_requests(self, image_requests):
+        if (image_requests is None):
+            image_requests = [ImageRequest(0, AirSimImageType.Scene, False, False)]
+        return (self.client.call_async('simGetImages', image_requests),
+                self.client.call_async('getCarState'),
+                self.client.call_async('getCollisionInfo'))
+
+    def __get_observation(self, futures):
+        images_future, car_state_future, collision_info_future = futures
+        images = [ImageResponse.from_msgpack(response_raw) for response_raw in images_future.get()]
+        return CarObservation(images, CarState.from_msgpack(car_state_future.get()), CollisionInfo.from_msgpack(collision_info_future.get()))
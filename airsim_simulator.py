@@ -0,0 +1,377 @@
+import argparse
+import math
+import time
+
+import msgpack
+import msgpackrpc
+import numpy as np
+from msgpackrpc.transport import tcp
+
+from road_map import SegmentGrid, load_road_segments, to_car_coordinates
+
+
+# A stand-in for the AirSim car simulator, for running the agent without the AirSim binary.
+# It serves the msgpack-rpc calls that airsim_client.CarClient makes on the same port, drives a kinematic car on the roads of road_lines.txt,
+# and renders synthetic camera frames with the size and layout of the real ones.
+# The car collides when it leaves the road. The response latency and the camera frame rate are configurable,
+# so the overhead of the agent itself can be measured against a simulator that answers instantly.
+
+CAR_PORT = 42451
+
+IMAGE_HEIGHT = 144
+IMAGE_WIDTH = 256
+HORIZON_ROW = 72
+
+ROAD_HALF_WIDTH = 5.0           # Beyond this distance from a road line, the car has hit the curb
+LANE_MARKING_HALF_WIDTH = 0.15
+CAMERA_HEIGHT = 1.5
+
+# AirSim's default home location
+HOME_GEO_POINT = {'latitude': 47.641468, 'longitude': -122.140165, 'altitude': 122.0}
+
+# The colors of the rendered frame, indexed by SKY, GRASS, ROAD and LANE_MARKING
+SKY, GRASS, ROAD, LANE_MARKING = 0, 1, 2, 3
+PALETTE = np.array([[135, 190, 235, 255],
+                    [70, 120, 50, 255],
+                    [90, 90, 90, 255],
+                    [230, 230, 230, 255]], dtype=np.uint8)
+
+
+def vector3r(x=0.0, y=0.0, z=0.0):
+    return {'x_val': float(x), 'y_val': float(y), 'z_val': float(z)}
+
+
+def quaternionr_from_yaw(yaw):
+    return {'w_val': math.cos(yaw * 0.5), 'x_val': 0.0, 'y_val': 0.0, 'z_val': math.sin(yaw * 0.5)}
+
+
+# Reads a field of a decoded msgpack map, whose keys are bytes or str depending on the encoding of the client
+def get_field(message, name, default=None):
+    if (name in message):
+        return message[name]
+    return message.get(name.encode('utf-8'), default)
+
+
+# A kinematic bicycle model of the car.
+# Coordinates are AirSim's: x forward at a yaw of 0, y to the right, and the yaw in radians.
+class KinematicCar(object):
+    def __init__(self, wheelbase=2.7, max_steering_angle=0.5, max_acceleration=4.0, max_braking=8.0, drag=0.05, max_speed=30.0):
+        self.wheelbase = wheelbase
+        self.max_steering_angle = max_steering_angle
+        self.max_acceleration = max_acceleration
+        self.max_braking = max_braking
+        self.drag = drag
+        self.max_speed = max_speed
+
+        self.x = 0.0
+        self.y = 0.0
+        self.yaw = 0.0
+        self.speed = 0.0
+        self.yaw_rate = 0.0
+
+        self.throttle = 0.0
+        self.steering = 0.0
+        self.brake = 0.0
+        self.handbrake = False
+
+    def set_pose(self, x, y, yaw):
+        self.x = x
+        self.y = y
+        self.yaw = yaw
+
+    def set_controls(self, throttle, steering, brake, handbrake):
+        self.throttle = min(max(throttle, -1.0), 1.0)
+        self.steering = min(max(steering, -1.0), 1.0)
+        self.brake = min(max(brake, 0.0), 1.0)
+        self.handbrake = handbrake
+
+    def stop(self):
+        self.speed = 0.0
+        self.yaw_rate = 0.0
+
+    def step(self, dt):
+        braking = 1.0 if self.handbrake else self.brake
+        acceleration = (self.throttle * self.max_acceleration) - (self.drag * self.speed)
+        speed = self.speed + (acceleration * dt)
+
+        # The brakes slow the car down, but never reverse it
+        braking_delta = braking * self.max_braking * dt
+        if (abs(speed) <= braking_delta):
+            speed = 0.0
+        else:
+            speed -= math.copysign(braking_delta, speed)
+        self.speed = min(max(speed, -self.max_speed), self.max_speed)
+
+        self.yaw_rate = self.speed * math.tan(self.steering * self.max_steering_angle) / self.wheelbase
+        self.yaw = math.atan2(math.sin(self.yaw + (self.yaw_rate * dt)), math.cos(self.yaw + (self.yaw_rate * dt)))
+        self.x += self.speed * math.cos(self.yaw) * dt
+        self.y += self.speed * math.sin(self.yaw) * dt
+
+
+# Renders what the front camera of the car sees: the sky above the horizon, and below it the ground, with the roads and their center lines.
+# The ground point seen by every pixel, relative to the car, is computed once. A frame is then a single distance query for all of the pixels.
+# The ground is computed in blocks of pixel_block x pixel_block pixels, which are then scaled up to the full frame.
+class SceneRenderer(object):
+    def __init__(self, road_grid, height=IMAGE_HEIGHT, width=IMAGE_WIDTH, horizon_row=HORIZON_ROW, camera_height=CAMERA_HEIGHT, pixel_block=2):
+        self.__road_grid = road_grid
+
+        # A pinhole camera with a 90 degree horizontal field of view, sampled at the center of each block
+        focal_length = width / 2.0
+        rows = np.arange(horizon_row + 1, height, pixel_block, dtype=np.float64) + ((pixel_block - 1) / 2.0)
+        columns = np.arange(0, width, pixel_block, dtype=np.float64) + (pixel_block / 2.0) - (width / 2.0)
+        forward = (camera_height * focal_length) / (rows - horizon_row)
+        self.__forward = np.repeat(forward, columns.shape[0])
+        self.__right = (forward[:, np.newaxis] * columns[np.newaxis, :] / focal_length).reshape(-1)
+
+        # The block of each ground pixel
+        ground_rows = np.arange(0, height - horizon_row - 1) // pixel_block
+        ground_columns = np.arange(0, width) // pixel_block
+        self.__pixel_blocks = ((ground_rows[:, np.newaxis] * columns.shape[0]) + ground_columns[np.newaxis, :]).reshape(-1)
+
+        self.__labels = np.full((height, width), SKY, dtype=np.uint8)
+        self.__ground_labels = self.__labels[horizon_row + 1:].reshape(-1)
+        self.__block_labels = np.empty(self.__forward.shape[0], dtype=np.uint8)
+        self.__frame = np.empty((height, width, 4), dtype=np.uint8)
+        self.__points = np.empty((self.__forward.shape[0], 2), dtype=np.float64)
+
+    # Returns the RGBA frame seen from the pose. The returned array is reused by the next call.
+    def render(self, x, y, yaw):
+        cos_yaw = math.cos(yaw)
+        sin_yaw = math.sin(yaw)
+        self.__points[:, 0] = x + (self.__forward * cos_yaw) - (self.__right * sin_yaw)
+        self.__points[:, 1] = y + (self.__forward * sin_yaw) + (self.__right * cos_yaw)
+
+        distances = self.__road_grid.distances(self.__points)
+        self.__block_labels[:] = GRASS
+        self.__block_labels[distances < ROAD_HALF_WIDTH] = ROAD
+        self.__block_labels[distances < LANE_MARKING_HALF_WIDTH] = LANE_MARKING
+
+        np.take(self.__block_labels, self.__pixel_blocks, out=self.__ground_labels)
+        np.take(PALETTE, self.__labels, axis=0, out=self.__frame)
+        return self.__frame
+
+
+# A msgpack-rpc connection that, like AirSim, sends bytes such as the image data as msgpack binaries and strings as msgpack strings
+class SimulatorServerSocket(tcp.ServerSocket):
+    def __init__(self, stream, transport, encodings):
+        tcp.ServerSocket.__init__(self, stream, transport, encodings)
+        self._packer = msgpack.Packer(default=lambda x: x.to_msgpack(), use_bin_type=True)
+
+
+# Accepts msgpack-rpc connections with Nagle's algorithm disabled, so that the replies to pipelined requests are not held back
+class SimulatorMessagePackServer(tcp.MessagePackServer):
+    def handle_stream(self, stream, address):
+        stream.set_nodelay(True)
+        SimulatorServerSocket(stream, self._transport, self._encodings)
+
+
+class SimulatorServerTransport(tcp.ServerTransport):
+    def listen(self, server):
+        self._server = server
+        self._mp_server = SimulatorMessagePackServer(self, io_loop=self._server._loop._ioloop, encodings=self._encodings)
+        self._mp_server.listen(self._address.port, self._address.host)
+
+
+# The transport builder passed to msgpackrpc.Server
+class SimulatorTransportBuilder(object):
+    ServerTransport = SimulatorServerTransport
+
+
+# The RPC handlers. Each method is called with the decoded arguments of the request of the same name.
+# The simulation advances with the wall clock. Whenever a request arrives, the car is first stepped up to the current time.
+class SimulatorServer(object):
+    def __init__(self, road_segments, latency_sec=0.0, fps=30.0, physics_hz=100.0):
+        self.__road_grid = SegmentGrid(road_segments)
+        self.__renderer = SceneRenderer(self.__road_grid)
+        self.__car = KinematicCar()
+        self.__latency_sec = float(latency_sec)
+        self.__frame_period = 1.0 / fps if fps > 0 else 0.0
+        self.__physics_dt = 1.0 / physics_hz
+        self.__loop = None
+
+        self.__api_control_enabled = False
+        self.__has_collided = False
+        self.__collision_position = vector3r()
+        self.__collision_time_stamp = 0
+
+        self.__last_step_time = time.time()
+        self.__frame = None
+        self.__frame_time = None
+        self.__frame_time_stamp = 0
+
+        self.num_requests = 0
+        self.num_frames_rendered = 0
+
+        # Start on the first road, facing along it
+        start, end = road_segments[0]
+        self.__car.set_pose((start[0] + end[0]) / 2.0, (start[1] + end[1]) / 2.0, math.atan2(end[1] - start[1], end[0] - start[0]))
+
+    # Serves the RPCs on the address until the process is stopped
+    def serve(self, host, port):
+        server = msgpackrpc.Server(self, builder=SimulatorTransportBuilder)
+        server.listen(msgpackrpc.Address(host, port))
+        self.__loop = server._loop._ioloop
+        print('AirSim simulator listening on {0}:{1}'.format(host, port))
+        server.start()
+
+    # Answers a request after the configured latency, without blocking the other requests
+    def __respond(self, result):
+        self.num_requests += 1
+        if (self.__latency_sec <= 0 or self.__loop is None):
+            return result
+
+        async_result = msgpackrpc.server.AsyncResult()
+        self.__loop.call_later(self.__latency_sec, async_result.set_result, result)
+        return async_result
+
+    def __advance(self):
+        now = time.time()
+
+        # Do not try to catch up with long pauses, such as the process being suspended
+        elapsed = min(now - self.__last_step_time, 1.0)
+        num_steps = int(elapsed / self.__physics_dt)
+        if (num_steps == 0):
+            return
+        self.__last_step_time = max(self.__last_step_time + (num_steps * self.__physics_dt), now - 1.0)
+
+        for _ in range(0, num_steps, 1):
+            self.__car.step(self.__physics_dt)
+            if self.__has_collided:
+                self.__car.stop()
+            elif (self.__road_grid.distances((self.__car.x, self.__car.y))[0] > ROAD_HALF_WIDTH):
+                self.__has_collided = True
+                self.__collision_position = vector3r(self.__car.x, self.__car.y)
+                self.__collision_time_stamp = int(now * 1e9)
+                self.__car.stop()
+
+    def __current_frame(self):
+        now = time.time()
+        if (self.__frame is None or now - self.__frame_time >= self.__frame_period):
+            self.__frame = self.__renderer.render(self.__car.x, self.__car.y, self.__car.yaw).tobytes()
+            self.__frame_time = now
+            self.__frame_time_stamp = int(now * 1e9)
+            self.num_frames_rendered += 1
+        return self.__frame
+
+    def __kinematics(self):
+        car = self.__car
+        kinematics = {}
+        kinematics['position'] = vector3r(car.x, car.y)
+        kinematics['orientation'] = quaternionr_from_yaw(car.yaw)
+        kinematics['linear_velocity'] = vector3r(car.speed * math.cos(car.yaw), car.speed * math.sin(car.yaw))
+        kinematics['angular_velocity'] = vector3r(0.0, 0.0, car.yaw_rate)
+        kinematics['linear_acceleration'] = vector3r()
+        kinematics['angular_acceleration'] = vector3r()
+        return kinematics
+
+    def ping(self):
+        return self.__respond(True)
+
+    def reset(self):
+        self.__car.stop()
+        self.__has_collided = False
+        return self.__respond(None)
+
+    def getHomeGeoPoint(self):
+        return self.__respond(HOME_GEO_POINT)
+
+    def enableApiControl(self, is_enabled):
+        self.__api_control_enabled = bool(is_enabled)
+        return self.__respond(None)
+
+    def isApiControlEnabled(self):
+        return self.__respond(self.__api_control_enabled)
+
+    # Like AirSim, setting the pose does not change the speed of the car
+    def simSetPose(self, pose, ignore_collision):
+        self.__advance()
+        position = get_field(pose, 'position')
+        orientation = get_field(pose, 'orientation')
+        w = get_field(orientation, 'w_val', 1.0)
+        x = get_field(orientation, 'x_val', 0.0)
+        y = get_field(orientation, 'y_val', 0.0)
+        z = get_field(orientation, 'z_val', 0.0)
+        yaw = math.atan2(2.0 * ((w * z) + (x * y)), 1.0 - (2.0 * ((y * y) + (z * z))))
+
+        self.__car.set_pose(float(get_field(position, 'x_val', 0.0)), float(get_field(position, 'y_val', 0.0)), yaw)
+        if ignore_collision:
+            self.__has_collided = False
+        self.__frame = None
+        return self.__respond(None)
+
+    def simGetPose(self):
+        self.__advance()
+        kinematics = self.__kinematics()
+        return self.__respond({'position': kinematics['position'], 'orientation': kinematics['orientation']})
+
+    def setCarControls(self, controls):
+        self.__advance()
+        self.__car.set_controls(float(get_field(controls, 'throttle', 0.0)), float(get_field(controls, 'steering', 0.0)),
+                                float(get_field(controls, 'brake', 0.0)), bool(get_field(controls, 'handbrake', False)))
+        return self.__respond(None)
+
+    def getCarState(self):
+        self.__advance()
+        kinematics = self.__kinematics()
+        state = {}
+        state['speed'] = abs(self.__car.speed)
+        state['gear'] = 0 if self.__car.speed == 0 else (1 if self.__car.speed > 0 else -1)
+        state['rpm'] = 0.0
+        state['maxrpm'] = 0.0
+        state['handbrake'] = self.__car.handbrake
+        state['position'] = kinematics['position']
+        state['velocity'] = kinematics['linear_velocity']
+        state['orientation'] = kinematics['orientation']
+        state['kinematics_true'] = kinematics
+        state['timestamp'] = int(time.time() * 1e9)
+        return self.__respond(state)
+
+    def getCollisionInfo(self):
+        self.__advance()
+        collision_info = {}
+        collision_info['has_collided'] = self.__has_collided
+        collision_info['normal'] = vector3r()
+        collision_info['impact_point'] = self.__collision_position
+        collision_info['position'] = self.__collision_position
+        collision_info['penetration_depth'] = 0.0
+        collision_info['time_stamp'] = self.__collision_time_stamp
+        collision_info['object_name'] = 'curb' if self.__has_collided else ''
+        collision_info['object_id'] = -1
+        return self.__respond(collision_info)
+
+    # Every request gets the uncompressed RGBA scene, which is the only image the agent uses
+    def simGetImages(self, requests):
+        self.__advance()
+        frame = self.__current_frame()
+        kinematics = self.__kinematics()
+
+        responses = []
+        for request in requests:
+            response = {}
+            response['image_data_uint8'] = frame
+            response['image_data_float'] = []
+            response['camera_position'] = kinematics['position']
+            response['camera_orientation'] = kinematics['orientation']
+            response['time_stamp'] = self.__frame_time_stamp
+            response['message'] = ''
+            response['pixels_as_float'] = False
+            response['compress'] = False
+            response['width'] = IMAGE_WIDTH
+            response['height'] = IMAGE_HEIGHT
+            response['image_type'] = get_field(request, 'image_type', 0)
+            responses.append(response)
+        return self.__respond(responses)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serves a stand-in for the AirSim car simulator, for running the agent without AirSim.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=CAR_PORT)
+    parser.add_argument('--road_lines', default='road_lines.txt')
+    parser.add_argument('--latency_ms', type=float, default=0.0, help='Delay added to every response')
+    parser.add_argument('--fps', type=float, default=30.0, help='Rate at which new camera frames are rendered, 0 for a new frame on every request')
+    parser.add_argument('--physics_hz', type=float, default=100.0)
+    args = parser.parse_args()
+
+    simulator = SimulatorServer(to_car_coordinates(load_road_segments(args.road_lines)), args.latency_ms / 1000.0, args.fps, args.physics_hz)
+    simulator.serve(args.host, args.port)
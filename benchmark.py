@@ -0,0 +1,413 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+
+import msgpack
+import numpy as np
+
+from inference_service import InferenceService
+from numpy_inference import NumpyInferenceEngine
+from quantize_model import QUANTIZATION_DTYPES, quantize_packet
+from airsim_client import AirSimClientBase, CarClient, CarState, CollisionInfo, ImageResponse
+from prioritized_replay import PrioritizedReplayMemory
+from replay_memory import ReplayMemory
+from reward_function import RewardFunction
+from tensor_packet import dumps_packet, loads_packet
+from wire_protocol import to_json_compatible
+
+
+# Benchmarks for the hot paths of training and inference.
+# Each benchmark runs one piece in isolation on synthetic data, and reports its throughput, latency percentiles and peak memory.
+# The end-to-end benchmark drives the control loop of DistributedAgent against the simulator stand-in in airsim_simulator.py.
+# The results are written to a JSON file, so that runs can be compared across commits.
+# Benchmarks that need TensorFlow are skipped if it is not installed.
+
+FRAME_SHAPE = (59, 255, 3)
+IMAGE_REGION = np.s_[76:135, 0:255, 0:3]
+IMAGE_HEIGHT = 144
+IMAGE_WIDTH = 256
+
+# The shapes of the weights of the network built by RlModel
+MODEL_WEIGHT_SHAPES = [(3, 3, 3, 16), (16,), (3, 3, 16, 32), (32,), (3, 3, 32, 32), (32,), (6944, 128), (128,), (128, 5), (5,)]
+
+# The number of calls with tracemalloc enabled, to measure the peak memory. Timings are taken without it.
+MEMORY_ITERATIONS = 3
+
+# The single-frame latency that the NumPy inference engine is meant to reach, which it does not yet
+NUMPY_INFERENCE_TARGET_MS = 1.0
+
+
+# Runs function repeatedly and returns the benchmark results.
+# items_per_call is the number of steps, such as transitions or frames, that one call processes.
+def measure(name, function, iterations, warmup=3, items_per_call=1):
+    for _ in range(0, warmup, 1):
+        function()
+
+    latencies = np.empty(iterations, dtype=np.float64)
+    for i in range(0, iterations, 1):
+        start = time.perf_counter()
+        function()
+        latencies[i] = time.perf_counter() - start
+
+    tracemalloc.start()
+    for _ in range(0, MEMORY_ITERATIONS, 1):
+        function()
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return summarize(name, latencies, items_per_call, peak_memory)
+
+
+def summarize(name, latencies, items_per_call, peak_memory):
+    latencies_ms = latencies * 1000
+    result = {}
+    result['name'] = name
+    result['iterations'] = int(latencies.shape[0])
+    result['steps_per_sec'] = float(items_per_call * latencies.shape[0] / np.sum(latencies))
+    result['mean_ms'] = float(np.mean(latencies_ms))
+    result['p50_ms'] = float(np.percentile(latencies_ms, 50))
+    result['p90_ms'] = float(np.percentile(latencies_ms, 90))
+    result['p99_ms'] = float(np.percentile(latencies_ms, 99))
+    result['max_ms'] = float(np.max(latencies_ms))
+    result['peak_memory_bytes'] = int(peak_memory)
+    return result
+
+
+def random_frame(random_state):
+    return random_state.randint(0, 256, size=FRAME_SHAPE, dtype=np.uint8)
+
+
+# Fills a replay memory with episodes of random frames, like the agent does
+def fill_replay_memory(memory, num_transitions, random_state, episode_length=100):
+    frames = [random_frame(random_state) for _ in range(0, 16, 1)]
+    added = 0
+    while (added < num_transitions):
+        memory.start_episode(frames[0:4])
+        for i in range(0, min(episode_length, num_transitions - added), 1):
+            memory.add(frames[i % len(frames)], random_state.randint(0, 5), random_state.random_sample(), random_state.random_sample(),
+                       position=tuple(random_state.random_sample(2) * 100), speed=5.0)
+            added += 1
+        memory.mark_last_terminal()
+    return memory
+
+
+def random_model_packet(random_state):
+    weights = [random_state.standard_normal(shape).astype(np.float32) for shape in MODEL_WEIGHT_SHAPES]
+    return {'action_model': weights, 'target_model': [w.copy() for w in weights]}
+
+
+def benchmark_reward(args, random_state):
+    reward_function = RewardFunction.from_file('reward_points.txt')
+    segments = reward_function.segments
+    points = segments[random_state.randint(0, segments.shape[0], size=4096), 0, :] + random_state.standard_normal((4096, 2)) * 3
+    state = {'i': 0}
+
+    def single():
+        state['i'] = (state['i'] + 1) % points.shape[0]
+        reward_function.compute_reward(points[state['i']], 5.0, False)
+
+    def batch():
+        reward_function.compute_rewards(points, np.full(points.shape[0], 5.0), np.zeros(points.shape[0], dtype=bool))
+
+    return [measure('compute_reward', single, args.iterations * 10),
+            measure('compute_rewards_batch', batch, args.iterations, items_per_call=points.shape[0])]
+
+
+def benchmark_replay(args, random_state):
+    memory = fill_replay_memory(ReplayMemory(args.replay_size, frame_dtype=np.uint8), args.replay_size, random_state)
+    frame = random_frame(random_state)
+
+    def add():
+        memory.add(frame, 1, 0.5, 0.5, position=(1.0, 2.0), speed=5.0)
+
+    def sample_uniform():
+        memory.sample(args.num_batches, args.batch_size, True)
+
+    def sample_surprise():
+        memory.sample(args.num_batches, args.batch_size, False)
+
+    return [measure('replay_add', add, args.iterations * 10),
+            measure('replay_sample_uniform', sample_uniform, args.iterations, items_per_call=args.num_batches * args.batch_size),
+            measure('replay_sample_surprise', sample_surprise, args.iterations, items_per_call=args.num_batches * args.batch_size)]
+
+
+def benchmark_prioritized_replay(args, random_state):
+    memory = fill_replay_memory(PrioritizedReplayMemory(args.replay_size, frame_dtype=np.uint8), args.replay_size, random_state)
+
+    def sample_and_update():
+        experiences = memory.sample(args.num_batches, args.batch_size)
+        memory.update_priorities(experiences['indices'], random_state.standard_normal(experiences['indices'].shape[0]))
+
+    return [measure('prioritized_sample_and_update', sample_and_update, args.iterations, items_per_call=args.num_batches * args.batch_size)]
+
+
+def benchmark_packets(args, random_state):
+    packet = random_model_packet(random_state)
+    binary = dumps_packet(packet)
+    json_text = json.dumps(to_json_compatible(packet))
+
+    return [measure('packet_encode_binary', lambda: dumps_packet(packet), args.iterations),
+            measure('packet_decode_binary', lambda: loads_packet(binary), args.iterations),
+            measure('packet_encode_json', lambda: json.dumps(to_json_compatible(packet)), max(1, args.iterations // 10)),
+            measure('packet_decode_json', lambda: json.loads(json_text), max(1, args.iterations // 10))]
+
+
+# Decodes the responses of the RPCs that the agent makes on every step, the way the AirSim clients do
+def benchmark_rpc_decode(args, random_state):
+    vector = {'x_val': 1.0, 'y_val': 2.0, 'z_val': 0.0}
+    quaternion = {'w_val': 1.0, 'x_val': 0.0, 'y_val': 0.0, 'z_val': 0.0}
+    kinematics = {'position': vector, 'orientation': quaternion, 'linear_velocity': vector, 'angular_velocity': vector,
+                  'linear_acceleration': vector, 'angular_acceleration': vector}
+    car_state = msgpack.packb({'speed': 5.0, 'gear': 1, 'rpm': 0.0, 'maxrpm': 0.0, 'handbrake': False, 'position': vector,
+                               'velocity': vector, 'orientation': quaternion, 'kinematics_true': kinematics, 'timestamp': 0}, use_bin_type=True)
+    collision_info = msgpack.packb({'has_collided': False, 'normal': vector, 'impact_point': vector, 'position': vector,
+                                    'penetration_depth': 0.0, 'time_stamp': 0, 'object_name': '', 'object_id': -1}, use_bin_type=True)
+    image = random_state.randint(0, 256, size=IMAGE_HEIGHT * IMAGE_WIDTH * 4, dtype=np.uint8).tobytes()
+    images = msgpack.packb([{'image_data_uint8': image, 'image_data_float': [], 'camera_position': vector, 'camera_orientation': quaternion,
+                             'time_stamp': 0, 'message': '', 'pixels_as_float': False, 'compress': False,
+                             'width': IMAGE_WIDTH, 'height': IMAGE_HEIGHT, 'image_type': 0}], use_bin_type=True)
+
+    def decode_car_state():
+        CarState.from_msgpack(msgpack.unpackb(car_state, raw=False, use_list=False))
+
+    def decode_collision_info():
+        CollisionInfo.from_msgpack(msgpack.unpackb(collision_info, raw=False, use_list=False))
+
+    frame = np.zeros(FRAME_SHAPE, dtype=np.uint8)
+
+    def decode_image():
+        response = ImageResponse.from_msgpack(msgpack.unpackb(images, raw=False, use_list=False)[0])
+        AirSimClientBase.copyImageRegion(response, frame, IMAGE_REGION)
+
+    return [measure('rpc_decode_car_state', decode_car_state, args.iterations * 10),
+            measure('rpc_decode_collision_info', decode_collision_info, args.iterations * 10),
+            measure('rpc_decode_image', decode_image, args.iterations)]
+
+
+# The forward pass of the network without TensorFlow.
+# If TensorFlow is available, the largest difference from the Q values of Keras is reported as well.
+def benchmark_numpy_inference(args, random_state):
+    packet = random_model_packet(random_state)
+    engine = NumpyInferenceEngine.from_packet(packet)
+    state = [random_frame(random_state) for _ in range(0, 4, 1)]
+    frames = np.stack([random_frame(random_state) for _ in range(0, args.batch_size, 1)])
+
+    results = [measure('numpy_predict_state', lambda: engine.predict_state(state), args.iterations),
+               measure('numpy_predict_states_batch', lambda: engine.predict_states(frames), max(1, args.iterations // 10), items_per_call=args.batch_size)]
+    results[0]['weight_bytes'] = engine.weight_bytes
+    results[0]['target_ms'] = NUMPY_INFERENCE_TARGET_MS
+    results[0]['meets_target'] = results[0]['p50_ms'] <= NUMPY_INFERENCE_TARGET_MS
+    if not results[0]['meets_target']:
+        print('  numpy_predict_state misses its {0:.1f} ms target with a p50 of {1:.3f} ms'.format(NUMPY_INFERENCE_TARGET_MS, results[0]['p50_ms']))
+
+    # The engine keeps the weights of a quantized artifact in their quantized dtype
+    for dtype in QUANTIZATION_DTYPES:
+        quantized_engine = NumpyInferenceEngine.from_packet(quantize_packet(packet, dtype))
+        result = measure('numpy_predict_state_{0}'.format(dtype), lambda: quantized_engine.predict_state(state), args.iterations)
+        result['weight_bytes'] = quantized_engine.weight_bytes
+        results.append(result)
+
+    try:
+        from rl_model import RlModel
+    except ImportError:
+        return results
+    model = RlModel(None, False)
+    model.from_packet(packet)
+    _, keras_q_values = model.predict_states(frames)
+    _, numpy_q_values = engine.predict_states(frames)
+    results[1]['max_abs_difference_from_keras'] = float(np.max(np.abs(keras_q_values - numpy_q_values)))
+    return results
+
+
+def benchmark_model(args, random_state):
+    try:
+        from rl_model import RlModel
+    except ImportError as e:
+        print('Skipping the model benchmarks, TensorFlow is not available: {0}'.format(e))
+        return []
+
+    model = RlModel(None, args.train_conv_layers)
+    memory = fill_replay_memory(PrioritizedReplayMemory(max(args.replay_size, args.batch_size), frame_dtype=np.uint8),
+                                max(args.replay_size, args.batch_size), random_state)
+    state = [random_frame(random_state) for _ in range(0, 4, 1)]
+    batches = memory.sample(1, args.batch_size)
+    packet = model.to_packet(get_target=True, as_lists=False)
+
+    frames = np.stack([random_frame(random_state) for _ in range(0, args.batch_size, 1)])
+    inference_service = InferenceService(model, args.batch_size)
+
+    # Many actor threads predicting through the inference service, which batches their requests
+    def predict_concurrently():
+        threads = [threading.Thread(target=lambda: [inference_service.predict_state(state) for _ in range(0, 10, 1)])
+                   for _ in range(0, args.inference_threads, 1)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    iterations = max(1, args.iterations // 10)
+    results = [measure('predict_state', lambda: model.predict_state(state), args.iterations),
+               measure('predict_states_batch', lambda: model.predict_states(frames), iterations, items_per_call=args.batch_size)]
+
+    inference_service.start()
+    try:
+        results.append(measure('inference_service', predict_concurrently, iterations, items_per_call=args.inference_threads * 10))
+    finally:
+        inference_service.stop()
+
+    results.append(measure('gradient_update', lambda: model.get_gradient_update_from_batches(batches, return_td_errors=True, as_lists=False),
+                           iterations, items_per_call=args.batch_size))
+    results.append(measure('to_packet', lambda: model.to_packet(get_target=True, as_lists=False), iterations))
+    results.append(measure('from_packet', lambda: model.from_packet(packet), iterations))
+    return results
+
+
+# Starts the simulator stand-in and waits until it answers
+def start_simulator(latency_ms, fps):
+    simulator = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'airsim_simulator.py'),
+                                  '--latency_ms', str(latency_ms), '--fps', str(fps)], stdout=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while True:
+        try:
+            car_client = CarClient()
+            car_client.ping()
+            return simulator, car_client
+        except Exception:
+            if (time.time() > deadline or simulator.poll() is not None):
+                simulator.kill()
+                raise RuntimeError('The simulator did not start')
+            time.sleep(0.2)
+
+
+# Drives episodes of the agent against the simulator, with the control loop of DistributedAgent itself.
+# The agent is given a client that records the time of every step, the time between two steps of an episode is one iteration of the loop:
+# choose an action, act, then crop the frame, compute the reward and store the transition.
+# The resets between the episodes are timed by the agent, and an episode is timed from the start of its reset to its end.
+# The first episode is a warm-up, after which epsilon is --end_to_end_epsilon, so by default the actions come from the model.
+def benchmark_end_to_end(args, random_state):
+    try:
+        from train_model import DistributedAgent
+    except ImportError as e:
+        print('Skipping the end-to-end benchmark, TensorFlow is not available: {0}'.format(e))
+        return []
+
+    if args.simulator_address:
+        simulator = None
+        address = args.simulator_address
+    else:
+        simulator, _ = start_simulator(args.simulator_latency_ms, args.simulator_fps)
+        address = '127.0.0.1:42451'
+
+    step_times = []
+
+    class TimedCarClient(CarClient):
+        def step(self, *step_args, **step_kwargs):
+            step_times.append(time.perf_counter())
+            return CarClient.step(self, *step_args, **step_kwargs)
+
+    try:
+        np.random.seed(args.seed)
+        agent = DistributedAgent(1, args.end_to_end_episode_sec, 1.0 - args.end_to_end_epsilon, args.end_to_end_epsilon, args.batch_size,
+                                 max(args.end_to_end_steps, 64), None, False, None, 'benchmark', airsim_address=address,
+                                 car_client_factory=TimedCarClient)
+        agent.run_episode()
+
+        step_latencies = []
+        episode_latencies = []
+        reset_latencies = []
+        for _ in range(0, args.end_to_end_max_episodes, 1):
+            del step_times[:]
+            start = time.perf_counter()
+            agent.run_episode()
+            episode_latencies.append(time.perf_counter() - start)
+
+            reset_stats = agent.get_episode_stats()['reset']
+            reset_latencies.append(reset_stats['last_stop_sec'] + reset_stats['last_warmup_sec'])
+            step_latencies.extend(np.diff(step_times))
+            if (len(step_latencies) >= args.end_to_end_steps):
+                break
+        if (len(step_latencies) == 0):
+            raise RuntimeError('No episode lasted more than one step in {0} episodes'.format(len(episode_latencies)))
+
+        stats = agent.get_episode_stats()
+        step_result = summarize('end_to_end_step', np.array(step_latencies), 1, 0)
+        step_result.update(stats['frame_capture'])
+        episode_result = summarize('end_to_end_episode', np.array(episode_latencies), 1, 0)
+        episode_result['episodes_per_hour'] = 3600.0 / episode_result['mean_ms'] * 1000
+        reset_result = summarize('end_to_end_episode_reset', np.array(reset_latencies), 1, 0)
+        reset_result.update(stats['reset'])
+        return [step_result, episode_result, reset_result]
+    finally:
+        if (simulator is not None):
+            simulator.kill()
+            simulator.wait()
+
+
+BENCHMARKS = [('reward', benchmark_reward),
+              ('replay', benchmark_replay),
+              ('prioritized_replay', benchmark_prioritized_replay),
+              ('packets', benchmark_packets),
+              ('rpc_decode', benchmark_rpc_decode),
+              ('numpy_inference', benchmark_numpy_inference),
+              ('model', benchmark_model),
+              ('end_to_end', benchmark_end_to_end)]
+
+
+def get_environment():
+    environment = {}
+    environment['timestamp'] = datetime.datetime.utcnow().isoformat()
+    environment['platform'] = platform.platform()
+    environment['processor'] = platform.processor()
+    environment['cpu_count'] = os.cpu_count()
+    environment['python'] = platform.python_version()
+    environment['numpy'] = np.__version__
+    try:
+        environment['git_commit'] = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        environment['git_commit'] = None
+    return environment
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the training and inference hot paths.')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--only', nargs='+', choices=[name for name, _ in BENCHMARKS], help='Only run these benchmarks')
+    parser.add_argument('--skip', nargs='+', default=[], choices=[name for name, _ in BENCHMARKS], help='Do not run these benchmarks')
+    parser.add_argument('--iterations', type=int, default=100)
+    parser.add_argument('--replay_size', type=int, default=2000)
+    parser.add_argument('--num_batches', type=int, default=10)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--train_conv_layers', action='store_true')
+    parser.add_argument('--inference_threads', type=int, default=8, help='The number of actor threads of the inference service benchmark')
+    parser.add_argument('--end_to_end_steps', type=int, default=200, help='The end-to-end benchmark drives episodes until it has timed this many steps')
+    parser.add_argument('--end_to_end_max_episodes', type=int, default=100)
+    parser.add_argument('--end_to_end_episode_sec', type=float, default=30, help='The max_epoch_runtime_sec of the agent')
+    parser.add_argument('--end_to_end_epsilon', type=float, default=0.0, help='The fraction of random actions after the warm-up episode')
+    parser.add_argument('--simulator_address', default=None, help='host:port of a running simulator. By default, airsim_simulator.py is started.')
+    parser.add_argument('--simulator_latency_ms', type=float, default=0.0)
+    parser.add_argument('--simulator_fps', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    results = get_environment()
+    results['args'] = vars(args)
+    results['benchmarks'] = []
+    for name, benchmark in BENCHMARKS:
+        if ((args.only and name not in args.only) or name in args.skip):
+            continue
+        print('Running {0}...'.format(name))
+        for result in benchmark(args, np.random.RandomState(args.seed)):
+            print('  {0}: {1:.1f} steps/sec, p50 {2:.3f} ms, p99 {3:.3f} ms, peak memory {4:.1f} MB'.format(
+                result['name'], result['steps_per_sec'], result['p50_ms'], result['p99_ms'], result['peak_memory_bytes'] / float(1 << 20)))
+            results['benchmarks'].append(result)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Results written to {0}'.format(args.output))
@@ -0,0 +1,116 @@
+import time
+
+import msgpackrpc
+
+from airsim_client import AirSimClientBase, Pose, Vector3r
+
+
+# Resets the car at the start of an episode, and captures the frames of the initial state.
+# simSetPose does not set the velocity, so after a crash the car keeps moving at its previous speed.
+# The car is braked until getCarState reports that it has stopped, then put back at the starting point and started rolling.
+# The warm-up ends as soon as enough frames are captured and the car is fast enough not to count as stopped.
+# Both waits poll the simulator instead of sleeping for a fixed time, and give up after a timeout.
+# If not a single frame was captured by then, reset and warm_up raise msgpackrpc.error.TimeoutError, which the agent handles by reconnecting.
+# The time spent in each wait is recorded, see get_stats.
+class EpisodeReset(object):
+    def __init__(self, car_client, car_controls, frame_capture, stopped_speed=0.1, min_start_speed=2.0,
+                 stop_timeout_sec=4.0, warmup_timeout_sec=5.0, poll_sec=0.02):
+        self.__car_client = car_client
+        self.__car_controls = car_controls
+        self.__frame_capture = frame_capture
+        self.__stopped_speed = float(stopped_speed)
+        self.__min_start_speed = float(min_start_speed)
+        self.__stop_timeout_sec = float(stop_timeout_sec)
+        self.__warmup_timeout_sec = float(warmup_timeout_sec)
+        self.__poll_sec = float(poll_sec)
+
+        self.num_resets = 0
+        self.num_stop_timeouts = 0
+        self.num_warmup_timeouts = 0
+        self.total_stop_sec = 0.0
+        self.total_warmup_sec = 0.0
+        self.last_stop_sec = 0.0
+        self.last_warmup_sec = 0.0
+
+    # The average time of a reset, braking and warm-up included
+    @property
+    def mean_reset_sec(self):
+        return (self.total_stop_sec + self.total_warmup_sec) / self.num_resets if self.num_resets > 0 else 0.0
+
+    def __set_controls(self, throttle, brake):
+        self.__car_controls.steering = 0
+        self.__car_controls.throttle = throttle
+        self.__car_controls.brake = brake
+        self.__car_client.setCarControls(self.__car_controls)
+
+    # Polls the car state until condition holds for it, or until deadline, a time.time() value, has passed.
+    # Returns whether the condition was met.
+    def __wait_for_car_state(self, condition, deadline):
+        while True:
+            if condition(self.__car_client.getCarState()):
+                return True
+            if (time.time() >= deadline):
+                return False
+            time.sleep(self.__poll_sec)
+
+    # Moves the car to the starting point, facing starting_direction, and returns the latest num_frames frames, oldest first.
+    # The frames are written into out if it is given.
+    def reset(self, starting_point, starting_direction, num_frames=4, out=None):
+        pose = Pose(Vector3r(starting_point[0], starting_point[1], starting_point[2]),
+                    AirSimClientBase.toQuaternion(starting_direction[0], starting_direction[1], starting_direction[2]))
+
+        # Brake at the starting point until the momentum of the previous episode has died
+        start_time = time.time()
+        self.__car_client.simSetPose(pose, True)
+        self.__set_controls(0, 1)
+        if not self.__wait_for_car_state(lambda car_state: car_state.speed <= self.__stopped_speed, start_time + self.__stop_timeout_sec):
+            self.num_stop_timeouts += 1
+            print('The car was still moving after {0} seconds of braking'.format(self.__stop_timeout_sec))
+
+        # The car may have slid while it was braking
+        self.__car_client.simSetPose(pose, True)
+        self.last_stop_sec = time.time() - start_time
+
+        frames = self.warm_up(num_frames, out)
+        self.num_resets += 1
+        self.total_stop_sec += self.last_stop_sec
+        self.total_warmup_sec += self.last_warmup_sec
+        return frames
+
+    # Starts the car rolling so it doesn't get stuck, and captures frames in the background until the state is full.
+    # Returns the latest num_frames frames, oldest first, written into out if it is given.
+    # With keep_capturing, the capture is left running for the caller to keep reading the latest frames.
+    def warm_up(self, num_frames=4, out=None, keep_capturing=False):
+        start_time = time.time()
+        deadline = start_time + self.__warmup_timeout_sec
+        self.__set_controls(1, 0)
+        self.__frame_capture.start()
+        try:
+            is_rolling = self.__wait_for_car_state(lambda car_state: car_state.speed >= self.__min_start_speed, deadline)
+            has_frames = self.__frame_capture.wait_for_frames(num_frames, max(0.0, deadline - time.time()))
+        except BaseException:
+            self.__frame_capture.stop()
+            raise
+        if not keep_capturing:
+            self.__frame_capture.stop()
+        if not (is_rolling and has_frames):
+            self.num_warmup_timeouts += 1
+            print('The warm-up timed out with {0} frames captured'.format(self.__frame_capture.num_captured))
+
+        # Without a single frame there is no initial state. Like a lost RPC, this makes the agent reconnect to AirSim.
+        if (self.__frame_capture.num_captured == 0):
+            self.__frame_capture.stop()
+            raise msgpackrpc.error.TimeoutError('No frame was captured in the {0} seconds of the warm-up'.format(self.__warmup_timeout_sec))
+        frames, _ = self.__frame_capture.latest(num_frames, out)
+        self.last_warmup_sec = time.time() - start_time
+        return frames
+
+    def get_stats(self):
+        stats = {}
+        stats['num_resets'] = self.num_resets
+        stats['num_stop_timeouts'] = self.num_stop_timeouts
+        stats['num_warmup_timeouts'] = self.num_warmup_timeouts
+        stats['last_stop_sec'] = self.last_stop_sec
+        stats['last_warmup_sec'] = self.last_warmup_sec
+        stats['mean_reset_sec'] = self.mean_reset_sec
+        return stats
@@ -0,0 +1,166 @@
+import threading
+import time
+
+import numpy as np
+
+from airsim_client import AirSimClientBase, AirSimImageType, ImageRequest
+
+
+# Captures camera frames from AirSim on a background thread, so that the controller never waits on an image RPC.
+# The thread polls simGetImages on its own client, msgpack-rpc clients cannot be shared between threads,
+# and crops each image into the next slot of a ring of preallocated frames.
+# The client is created by the first capture and reused by the next ones, until close() or an error of the capture closes it.
+# The controller reads the latest frames with latest(), which copies them out and only holds the lock for the copy.
+# Control and capture thus run at their own rates. Frames that the controller never read are counted as dropped,
+# and reads that did not get a frame newer than the previous read are counted as stale.
+class FrameCapture(object):
+    def __init__(self, client_factory, region=np.s_[76:135, 0:255, 0:3], frame_shape=(59, 255, 3), capacity=8, period_sec=0.0, camera_id=0):
+        if (int(capacity) < 2):
+            raise ValueError('The capture ring needs at least 2 frames, got {0}'.format(capacity))
+
+        self.__client_factory = client_factory
+        self.__client = None
+        self.__region = region
+        self.__capacity = int(capacity)
+        self.__period_sec = float(period_sec)
+        self.__image_requests = [ImageRequest(camera_id, AirSimImageType.Scene, False, False)]
+
+        self.__frames = np.zeros((self.__capacity,) + tuple(frame_shape), dtype=np.uint8)
+        self.__capture_times = np.zeros(self.__capacity, dtype=np.float64)
+
+        # The number of frames published so far. The newest frame is in the slot (num_captured - 1) % capacity.
+        # The thread writes the next frame into its slot without the lock, and only takes the lock to publish it.
+        self.__num_captured = 0
+        self.__condition = threading.Condition()
+        self.__thread = None
+        self.__stop_event = threading.Event()
+        self.__error = None
+
+        # The number of frames that had been captured at the last read
+        self.__last_read = 0
+        self.num_dropped = 0
+        self.num_stale = 0
+        self.num_reads = 0
+
+    @property
+    def num_captured(self):
+        return self.__num_captured
+
+    # The rate at which frames were captured, in frames per second
+    @property
+    def capture_rate(self):
+        with self.__condition:
+            if (self.__num_captured < 2):
+                return 0.0
+            newest = (self.__num_captured - 1) % self.__capacity
+            oldest_number = max(0, self.__num_captured - self.__capacity)
+            oldest = oldest_number % self.__capacity
+            elapsed = float(self.__capture_times[newest] - self.__capture_times[oldest])
+            return float(self.__num_captured - 1 - oldest_number) / elapsed if elapsed > 0 else 0.0
+
+    # Starts capturing. The frames of a previous run are discarded, but the counters keep accumulating.
+    def start(self):
+        if (self.__thread is not None):
+            raise RuntimeError('The frame capture is already running')
+        self.__stop_event.clear()
+        self.__error = None
+        self.__num_captured = 0
+        self.__last_read = 0
+        self.__thread = threading.Thread(target=self.__run, name='FrameCapture')
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    # Stops the thread and waits for it to finish its current capture.
+    # The frames that were captured stay readable.
+    def stop(self):
+        if (self.__thread is None):
+            return
+        self.__stop_event.set()
+        self.__thread.join()
+        self.__thread = None
+
+    # Stops capturing and closes the connection of the capture client
+    def close(self):
+        self.stop()
+        self.__close_client()
+
+    def __close_client(self):
+        if (self.__client is not None):
+            self.__client.client.close()
+            self.__client = None
+
+    def __run(self):
+        try:
+            if (self.__client is None):
+                self.__client = self.__client_factory()
+            client = self.__client
+            while not self.__stop_event.is_set():
+                start_time = time.time()
+                slot = self.__num_captured % self.__capacity
+                image_response = client.simGetImages(self.__image_requests)[0]
+                AirSimClientBase.copyImageRegion(image_response, self.__frames[slot], self.__region)
+
+                with self.__condition:
+                    self.__capture_times[slot] = time.time()
+                    self.__num_captured += 1
+                    self.__condition.notify_all()
+
+                if (self.__period_sec > 0):
+                    self.__stop_event.wait(max(0.0, self.__period_sec - (time.time() - start_time)))
+        except Exception as e:
+            # The connection may be broken, the next capture reconnects.
+            # The error is raised again in the controller by the next read.
+            self.__close_client()
+            with self.__condition:
+                self.__error = e
+                self.__condition.notify_all()
+
+    # Blocks until at least num_frames frames have been captured since the capture was started, or timeout_sec has passed.
+    # Returns whether the frames are available.
+    def wait_for_frames(self, num_frames, timeout_sec=None):
+        with self.__condition:
+            self.__condition.wait_for(lambda: self.__error is not None or self.__num_captured >= num_frames, timeout_sec)
+            if (self.__error is not None):
+                raise self.__error
+            return self.__num_captured >= num_frames
+
+    # Copies the latest num_frames frames, oldest first, into out, or a new array if out is None.
+    # Returns the frames and the age in seconds of the newest one.
+    # Never waits for a capture: if fewer frames than num_frames have been captured, the oldest available frame is repeated.
+    def latest(self, num_frames, out=None):
+        if (num_frames >= self.__capacity):
+            raise ValueError('Can read at most {0} frames from a ring of {1}, got {2}'.format(self.__capacity - 1, self.__capacity, num_frames))
+        if (out is None):
+            out = np.empty((num_frames,) + self.__frames.shape[1:], dtype=np.uint8)
+
+        with self.__condition:
+            if (self.__error is not None):
+                raise self.__error
+            num_captured = self.__num_captured
+            if (num_captured == 0):
+                raise RuntimeError('No frame has been captured yet')
+
+            # The slot after the newest frame may be written to while the frames are copied, but it is never read,
+            # since at most capacity - 1 frames are read.
+            numbers = np.maximum(np.arange(num_captured - num_frames, num_captured), 0)
+            slots = numbers % self.__capacity
+            np.take(self.__frames, slots, axis=0, out=out)
+            age = time.time() - self.__capture_times[slots[-1]]
+
+            # Frames between the previous read and the oldest frame of this one were never seen by the controller
+            self.num_reads += 1
+            self.num_dropped += max(0, int(numbers[0]) - self.__last_read)
+            if (num_captured == self.__last_read):
+                self.num_stale += 1
+            self.__last_read = num_captured
+
+        return out, age
+
+    def get_stats(self):
+        stats = {}
+        stats['num_captured'] = self.__num_captured
+        stats['num_reads'] = self.num_reads
+        stats['num_dropped'] = self.num_dropped
+        stats['num_stale'] = self.num_stale
+        stats['capture_rate'] = self.capture_rate
+        return stats
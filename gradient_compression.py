@@ -0,0 +1,116 @@
+import math
+
+import numpy as np
+
+
+# Compresses the per-layer weight updates that an agent sends to the trainer.
+# Layers whose update is all zeros, such as the frozen convolution layers when train_conv_layers is False, are sent as None.
+# Optionally, only the top_k_ratio largest entries of each layer are sent, as a sparse (indices, values) pair,
+# and the values are quantized to 8 or 16 bit integers with a per-layer scale and offset.
+# With error feedback, whatever was not sent (the entries dropped by top-k and the quantization error) is kept,
+# and added to the update of the next call, so that no part of the update is lost over time.
+class GradientCompressor(object):
+    def __init__(self, top_k_ratio=None, quantization_bits=None, error_feedback=True):
+        if (top_k_ratio is not None and not (0 < top_k_ratio <= 1)):
+            raise ValueError('top_k_ratio must be in (0, 1], got {0}'.format(top_k_ratio))
+        if (quantization_bits not in (None, 8, 16)):
+            raise ValueError('quantization_bits must be 8 or 16, got {0}'.format(quantization_bits))
+
+        self.__top_k_ratio = top_k_ratio
+        self.__quantization_bits = quantization_bits
+        self.__error_feedback = error_feedback and (top_k_ratio is not None or quantization_bits is not None)
+        self.__residuals = None
+
+    # Compresses a list of per-layer updates. Returns a list with one entry per layer, to be applied with apply_compressed_gradient.
+    def compress(self, gradients):
+        gradients = [np.asarray(g, dtype=np.float32) for g in gradients]
+        if self.__error_feedback:
+            if (self.__residuals is None):
+                self.__residuals = [np.zeros_like(g) for g in gradients]
+            gradients = [g + r for g, r in zip(gradients, self.__residuals)]
+
+        entries = []
+        for i, gradient in enumerate(gradients):
+            entry = self.__compress_layer(gradient)
+            if self.__error_feedback:
+                self.__residuals[i] = gradient - decompress_gradient(entry, gradient.shape)
+            entries.append(entry)
+        return entries
+
+    def __compress_layer(self, gradient):
+        if not np.any(gradient):
+            return None
+
+        if (self.__top_k_ratio is None):
+            if (self.__quantization_bits is None):
+                return gradient
+            entry = {'shape': list(gradient.shape)}
+            entry.update(quantize(gradient.reshape(-1), self.__quantization_bits))
+            return entry
+
+        flat = gradient.reshape(-1)
+        k = max(1, int(math.ceil(self.__top_k_ratio * flat.shape[0])))
+        if (k < flat.shape[0]):
+            indices = np.argpartition(np.abs(flat), flat.shape[0] - k)[flat.shape[0] - k:]
+        else:
+            indices = np.arange(flat.shape[0])
+        indices = np.sort(indices).astype(np.int32)
+
+        entry = {'shape': list(gradient.shape), 'indices': indices}
+        if (self.__quantization_bits is None):
+            entry['values'] = flat[indices]
+        else:
+            entry.update(quantize(flat[indices], self.__quantization_bits))
+        return entry
+
+
+# Linearly quantizes values to unsigned integers of the given number of bits, between the minimum and the maximum of the values
+def quantize(values, bits):
+    dtype = np.uint8 if bits == 8 else np.uint16
+    low = float(np.min(values))
+    high = float(np.max(values))
+    scale = (high - low) / float((1 << bits) - 1)
+    if (scale == 0):
+        quantized = np.zeros(values.shape, dtype=dtype)
+    else:
+        quantized = np.rint((values - low) / scale).astype(dtype)
+    return {'quantized': quantized, 'scale': scale, 'offset': low}
+
+
+def dequantize(entry):
+    return (np.asarray(entry['quantized']).astype(np.float32) * np.float32(entry['scale'])) + np.float32(entry['offset'])
+
+
+# Decompresses the entry of one layer into a dense array of the given shape.
+# Plain arrays and nested lists are returned as float32 arrays, so uncompressed updates can be passed through as well.
+def decompress_gradient(entry, shape):
+    if (entry is None):
+        return np.zeros(shape, dtype=np.float32)
+    if not isinstance(entry, dict):
+        return np.asarray(entry, dtype=np.float32).reshape(shape)
+
+    values = dequantize(entry) if ('quantized' in entry) else np.asarray(entry['values'], dtype=np.float32)
+    if ('indices' not in entry):
+        return values.reshape(shape)
+
+    dense = np.zeros(int(np.prod(shape)), dtype=np.float32)
+    dense[np.asarray(entry['indices'], dtype=np.int64)] = values
+    return dense.reshape(shape)
+
+
+# Adds a compressed update to an array of weights in place.
+# Skipped layers are not touched, and sparse updates only touch the entries that were sent.
+# Returns the sum of the absolute values of the update.
+def apply_compressed_gradient(weights, entry, scale=1.0):
+    if (entry is None):
+        return 0.0
+
+    if (isinstance(entry, dict) and 'indices' in entry):
+        values = dequantize(entry) if ('quantized' in entry) else np.asarray(entry['values'], dtype=np.float32)
+        values = values * np.float32(scale)
+        weights.flat[np.asarray(entry['indices'], dtype=np.int64)] += values
+        return float(np.sum(np.abs(values)))
+
+    update = decompress_gradient(entry, weights.shape) * np.float32(scale)
+    weights += update
+    return float(np.sum(np.abs(update)))
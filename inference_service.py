@@ -0,0 +1,110 @@
+import queue
+import threading
+import time
+
+import numpy as np
+
+
+# A request queued with the inference service. The caller waits on done until the worker has filled in the action and Q value.
+class InferenceRequest(object):
+    __slots__ = ('frame', 'done', 'action', 'q_value', 'error')
+
+    def __init__(self, frame):
+        self.frame = frame
+        self.done = threading.Event()
+        self.action = None
+        self.q_value = None
+        self.error = None
+
+
+# Batches the predictions of many actor threads into single forward passes of the model.
+# predict_state has the interface of RlModel.predict_state, so an actor can use the service in place of the model.
+# A worker thread takes the first waiting request, then keeps collecting requests until it has max_batch_size of them,
+# or max_delay_sec has passed since the first one. The batch is predicted with model.predict_states in a single call.
+# Since Keras has a large fixed overhead per call, the throughput grows almost linearly with the batch size.
+class InferenceService(object):
+    def __init__(self, model, max_batch_size=32, max_delay_sec=0.002, frame_shape=(59, 255, 3)):
+        self.__model = model
+        self.__max_batch_size = int(max_batch_size)
+        self.__max_delay_sec = float(max_delay_sec)
+        self.__requests = queue.Queue()
+        self.__batch = np.zeros((self.__max_batch_size,) + tuple(frame_shape), dtype=np.uint8)
+        self.__thread = None
+        self.__running = False
+
+        self.num_requests = 0
+        self.num_batches = 0
+
+    # The average number of requests per forward pass
+    @property
+    def mean_batch_size(self):
+        return float(self.num_requests) / self.num_batches if self.num_batches > 0 else 0.0
+
+    def start(self):
+        if (self.__thread is not None):
+            raise RuntimeError('The inference service is already running')
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__run, name='InferenceService')
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    # Stops the worker once the requests already queued have been answered
+    def stop(self):
+        if (self.__thread is None):
+            return
+        self.__running = False
+        self.__requests.put(None)
+        self.__thread.join()
+        self.__thread = None
+
+    # Predicts the action with the highest Q value for a state, waiting for the batch that the state is part of.
+    # Like RlModel.predict_state, only the latest frame of the state is used.
+    def predict_state(self, observation):
+        if not self.__running:
+            raise RuntimeError('The inference service is not running')
+        request = InferenceRequest(observation[-1])
+        self.__requests.put(request)
+        request.done.wait()
+        if (request.error is not None):
+            raise request.error
+        return (request.action, request.q_value)
+
+    def __run(self):
+        while True:
+            request = self.__requests.get()
+            if (request is None):
+                return
+
+            # Collect more requests until the batch is full or the oldest request has waited long enough
+            requests = [request]
+            deadline = time.time() + self.__max_delay_sec
+            while (len(requests) < self.__max_batch_size):
+                try:
+                    request = self.__requests.get(timeout=max(0.0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                if (request is None):
+                    # Answer the batch before stopping
+                    self.__requests.put(None)
+                    break
+                requests.append(request)
+
+            self.__predict(requests)
+
+    def __predict(self, requests):
+        num_requests = len(requests)
+        try:
+            for i in range(0, num_requests, 1):
+                self.__batch[i] = requests[i].frame
+            actions, q_values = self.__model.predict_states(self.__batch[:num_requests])
+            for i in range(0, num_requests, 1):
+                requests[i].action = actions[i]
+                requests[i].q_value = q_values[i]
+        except Exception as e:
+            for request in requests:
+                request.error = e
+
+        self.num_requests += num_requests
+        self.num_batches += 1
+        for request in requests:
+            request.done.set()
@@ -0,0 +1,191 @@
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from tensor_packet import load_checkpoint
+
+
+# A packet with this key is a quantized artifact written by quantize_model.py, whose value is 'int8' or 'float16'
+QUANTIZATION_KEY = 'quantization'
+
+# The size of the float32 buffer that int8 and float16 kernels are converted into, a block of rows at a time
+KERNEL_BLOCK_ELEMENTS = 1 << 16
+
+
+# Converts the action model of a quantized artifact back to float32 weights, for RlModel.
+# int8 tensors are stored as {'quantized': int8 array, 'scale': float32 scale of each output channel}, biases are kept as float32.
+def dequantize_weights(packet):
+    weights = []
+    for w in packet['action_model']:
+        if isinstance(w, dict):
+            w = np.asarray(w['quantized'], dtype=np.float32) * np.asarray(w['scale'], dtype=np.float32)
+        weights.append(np.asarray(w, dtype=np.float32))
+    return weights
+
+
+# Runs the forward pass of the RlModel network with NumPy only, for driving without TensorFlow.
+# The network is three blocks of a 3x3 'same' convolution with a relu and a 2x2 max pooling, then Dense(128) and Dense(5), both linear.
+# Dropout does nothing at inference time, so it is left out.
+# The weights are the action_model list of RlModel.to_packet, in the Keras layouts: (3, 3, in, out) kernels and (in, out) dense matrices.
+#
+# Each convolution is a single matrix product: the 3x3 patches of the zero-padded input are gathered with a strided view
+# into a preallocated im2col matrix, and multiplied by the flattened kernel.
+# All of the intermediate activations are preallocated for each batch size, so a prediction does not allocate any large array.
+# A single frame takes a few milliseconds on a desktop CPU, about 32 million multiply-adds, most of them in the convolutions.
+# That is well within the 100 ms control period, but short of the sub-millisecond target: the numpy_inference benchmark records the gap.
+#
+# The kernels of a quantized artifact stay in memory as int8 or float16, the activations are float32.
+# NumPy has no fast int8 or float16 matrix product, so such a kernel is multiplied a block of rows at a time,
+# each block being converted into a small float32 buffer first. The per-channel scales of int8 kernels are applied to the product.
+class NumpyInferenceEngine(object):
+    def __init__(self, weights, input_shape=(59, 255, 3)):
+        self.__input_shape = tuple(input_shape)
+        self.__angle_values = [-1, -0.5, 0, 0.5, 1]
+
+        self.__conv_layers = []
+        self.__dense_layers = []
+        for i in range(0, len(weights), 2):
+            kernel, scale = self.__load_kernel(weights[i])
+            bias = np.ascontiguousarray(weights[i + 1], dtype=np.float32)
+            if (kernel.ndim == 4):
+                if (self.__dense_layers):
+                    raise ValueError('Convolutions must come before the dense layers')
+                kernel_height, kernel_width, in_channels, out_channels = kernel.shape
+                self.__conv_layers.append((kernel.reshape(kernel_height * kernel_width * in_channels, out_channels), scale, bias, kernel_height, kernel_width))
+            else:
+                self.__dense_layers.append((kernel, scale, bias))
+
+        self.__kernel_block = np.empty(KERNEL_BLOCK_ELEMENTS, dtype=np.float32)
+        self.__buffers = {}
+
+    # Returns a kernel in the dtype it is kept in, and the scale of each of its output channels, or None if it is not int8.
+    # An int8 kernel is given as {'quantized': int8 array, 'scale': float32 scales}, as quantize_model.py writes it.
+    @staticmethod
+    def __load_kernel(kernel):
+        if isinstance(kernel, dict):
+            return np.ascontiguousarray(kernel['quantized'], dtype=np.int8), np.ascontiguousarray(kernel['scale'], dtype=np.float32)
+        kernel = np.asarray(kernel)
+        if (kernel.dtype == np.float16):
+            return np.ascontiguousarray(kernel), None
+        return np.ascontiguousarray(kernel, dtype=np.float32), None
+
+    # The packet is either a model packet from RlModel.to_packet, or a quantized one from quantize_model.py
+    @staticmethod
+    def from_packet(packet):
+        return NumpyInferenceEngine(packet['action_model'])
+
+    # The number of bytes taken by the weights of the network
+    @property
+    def weight_bytes(self):
+        num_bytes = 0
+        for layer in self.__conv_layers + self.__dense_layers:
+            num_bytes += sum(w.nbytes for w in layer if isinstance(w, np.ndarray))
+        return num_bytes
+
+    # Loads the action model of a checkpoint written by the agent or the trainer, or of a quantized artifact
+    @staticmethod
+    def from_checkpoint(path):
+        return NumpyInferenceEngine.from_packet(load_checkpoint(path)['model'])
+
+    # Allocates the activations of every layer for a batch size.
+    # The product of a kernel that is converted in several blocks also gets a buffer for the partial products.
+    def __allocate(self, batch_size):
+        buffers = []
+        height, width, channels = self.__input_shape
+        for kernel, _, _, kernel_height, kernel_width in self.__conv_layers:
+            padded = np.zeros((batch_size, height + kernel_height - 1, width + kernel_width - 1, channels), dtype=np.float32)
+            columns = np.empty((batch_size, height, width, kernel_height, kernel_width, channels), dtype=np.float32)
+            activations = np.empty((batch_size, height, width, kernel.shape[1]), dtype=np.float32)
+            partial = self.__allocate_partial(kernel, batch_size * height * width)
+            height, width, channels = height // 2, width // 2, kernel.shape[1]
+            pooled = np.empty((batch_size, height, width, channels), dtype=np.float32)
+            buffers.append((padded, columns, activations, partial, pooled))
+
+        dense_buffers = [(np.empty((batch_size, kernel.shape[1]), dtype=np.float32), self.__allocate_partial(kernel, batch_size))
+                         for kernel, _, _ in self.__dense_layers]
+        return buffers, dense_buffers
+
+    def __allocate_partial(self, kernel, num_rows):
+        if (kernel.dtype == np.float32 or kernel.size <= self.__kernel_block.shape[0]):
+            return None
+        return np.empty((num_rows, kernel.shape[1]), dtype=np.float32)
+
+    # Computes inputs x kernel + bias into out, where kernel is float32, float16 or int8 with the scale of each output channel
+    def __dot(self, inputs, kernel, scale, bias, out, partial):
+        if (kernel.dtype == np.float32):
+            np.dot(inputs, kernel, out=out)
+        else:
+            block_rows = max(1, self.__kernel_block.shape[0] // kernel.shape[1])
+            for start in range(0, kernel.shape[0], block_rows):
+                stop = min(start + block_rows, kernel.shape[0])
+                block = self.__kernel_block[:(stop - start) * kernel.shape[1]].reshape(stop - start, kernel.shape[1])
+                np.copyto(block, kernel[start:stop], casting='unsafe')
+                if (start == 0):
+                    np.dot(inputs[:, start:stop], block, out=out)
+                else:
+                    np.dot(inputs[:, start:stop], block, out=partial)
+                    out += partial
+            if (scale is not None):
+                out *= scale
+        out += bias
+
+    # Returns the Q values of a batch of frames, with shape (batch_size, 5).
+    # The returned array is reused by the next call with the same batch size.
+    def predict_q_values(self, frames):
+        frames = np.asarray(frames)
+        if (frames.ndim == 3):
+            frames = frames[np.newaxis]
+        batch_size = frames.shape[0]
+        if batch_size not in self.__buffers:
+            self.__buffers[batch_size] = self.__allocate(batch_size)
+        conv_buffers, dense_buffers = self.__buffers[batch_size]
+
+        layer_input = frames
+        for (kernel, scale, bias, kernel_height, kernel_width), (padded, columns, activations, partial, pooled) in zip(self.__conv_layers, conv_buffers):
+            # 'same' padding, the border of the padded buffer stays zero
+            pad_top = (kernel_height - 1) // 2
+            pad_left = (kernel_width - 1) // 2
+            height, width = layer_input.shape[1], layer_input.shape[2]
+            padded[:, pad_top:pad_top + height, pad_left:pad_left + width, :] = layer_input
+
+            # im2col: a view of every kernel_height x kernel_width patch, copied into the columns matrix
+            strides = padded.strides
+            patches = as_strided(padded, shape=columns.shape, strides=(strides[0], strides[1], strides[2], strides[1], strides[2], strides[3]), writeable=False)
+            np.copyto(columns, patches)
+
+            flat_activations = activations.reshape(-1, kernel.shape[1])
+            self.__dot(columns.reshape(flat_activations.shape[0], -1), kernel, scale, bias, flat_activations, partial)
+            np.maximum(flat_activations, 0, out=flat_activations)
+
+            # 2x2 max pooling with 'valid' padding drops the last row and column of odd sizes
+            pooled_height, pooled_width = pooled.shape[1], pooled.shape[2]
+            rows = activations[:, :2 * pooled_height]
+            np.maximum(rows[:, 0::2, 0:2 * pooled_width:2], rows[:, 0::2, 1:2 * pooled_width:2], out=pooled)
+            np.maximum(pooled, rows[:, 1::2, 0:2 * pooled_width:2], out=pooled)
+            np.maximum(pooled, rows[:, 1::2, 1:2 * pooled_width:2], out=pooled)
+            layer_input = pooled
+
+        # Keras flattens in (height, width, channels) order, which is the memory order of the pooled activations
+        layer_input = layer_input.reshape(batch_size, -1)
+        for (kernel, scale, bias), (output, partial) in zip(self.__dense_layers, dense_buffers):
+            self.__dot(layer_input, kernel, scale, bias, output, partial)
+            layer_input = output
+        return layer_input
+
+    # The same as RlModel.predict_states: the best action and its Q value for each of a batch of latest frames
+    def predict_states(self, frames):
+        predicted_qs = self.predict_q_values(frames)
+        predicted_states = np.argmax(predicted_qs, axis=1)
+        return (predicted_states, predicted_qs[np.arange(predicted_qs.shape[0]), predicted_states].copy())
+
+    # The same as RlModel.predict_state: only the latest frame of the state is used
+    def predict_state(self, observation):
+        predicted_qs = self.predict_q_values(observation[-1])
+        predicted_state = int(np.argmax(predicted_qs[0]))
+        return (predicted_state, float(predicted_qs[0][predicted_state]))
+
+    # The same controller as RlModel.state_to_control_signals
+    def state_to_control_signals(self, state, car_state):
+        if car_state.speed > 9:
+            return (self.__angle_values[state], 0, 1)
+        else:
+            return (self.__angle_values[state], 1, 0)
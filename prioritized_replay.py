@@ -0,0 +1,131 @@
+import numpy as np
+
+from replay_memory import ReplayMemory
+
+
+# A binary segment tree where every internal node holds the sum of the priorities below it.
+# Leaves are indexed by the slots of the replay memory. Updates and prefix-sum searches are O(log N),
+# and both are vectorized over arrays of slots so that a whole set of minibatches is processed at once.
+class SumTree(object):
+    def __init__(self, capacity):
+        self.__capacity = int(capacity)
+        self.__num_leaves = 1
+        while (self.__num_leaves < self.__capacity):
+            self.__num_leaves *= 2
+        self.__depth = int(np.log2(self.__num_leaves))
+
+        # Node 1 is the root, the children of node i are 2i and 2i+1. The leaves start at num_leaves.
+        self.__tree = np.zeros(2 * self.__num_leaves, dtype=np.float64)
+
+    @property
+    def capacity(self):
+        return self.__capacity
+
+    @property
+    def total(self):
+        return self.__tree[1]
+
+    # Returns the priorities stored at the given slots
+    def get(self, slots):
+        return self.__tree[np.asarray(slots, dtype=np.int64) + self.__num_leaves]
+
+    # Sets the priorities of the given slots and recomputes the sums on the path to the root
+    def update(self, slots, priorities):
+        # A single slot is updated on every insert, walk up the tree without the overhead of array operations
+        if np.isscalar(slots):
+            node = int(slots) + self.__num_leaves
+            self.__tree[node] = priorities
+            while (node > 1):
+                node //= 2
+                self.__tree[node] = self.__tree[2 * node] + self.__tree[(2 * node) + 1]
+            return
+
+        nodes = np.atleast_1d(np.asarray(slots, dtype=np.int64)) + self.__num_leaves
+        self.__tree[nodes] = priorities
+
+        for _ in range(0, self.__depth, 1):
+            nodes = np.unique(nodes // 2)
+            self.__tree[nodes] = self.__tree[2 * nodes] + self.__tree[(2 * nodes) + 1]
+
+    # Finds the slot at which the running sum of priorities crosses each of the given values
+    def find(self, values):
+        values = np.array(values, dtype=np.float64)
+
+        # Keep the values strictly below the total so that rounding errors cannot walk past the last non-empty leaf
+        np.clip(values, 0, np.nextafter(self.total, 0), out=values)
+
+        nodes = np.ones(values.shape, dtype=np.int64)
+        for _ in range(0, self.__depth, 1):
+            left_sums = self.__tree[2 * nodes]
+            go_right = values >= left_sums
+            values -= left_sums * go_right
+            nodes = (2 * nodes) + go_right
+
+        return nodes - self.__num_leaves
+
+
+# A replay memory that samples transitions in proportion to their priority, as described in "Prioritized Experience Replay" (Schaul et al.).
+# New transitions get the highest priority seen so far, so that each one is trained on at least once.
+# After training, the priorities are replaced by the absolute TD errors of the sampled transitions.
+class PrioritizedReplayMemory(ReplayMemory):
+    def __init__(self, capacity=None, alpha=0.6, beta=0.4, priority_epsilon=1e-3, **kwargs):
+        super(PrioritizedReplayMemory, self).__init__(capacity, **kwargs)
+        self.__alpha = float(alpha)
+        self.__beta = float(beta)
+        self.__priority_epsilon = float(priority_epsilon)
+        self.__max_priority = 1.0
+        self.__tree = SumTree(self.capacity)
+
+    @property
+    def beta(self):
+        return self.__beta
+
+    # The importance-sampling exponent is usually annealed towards 1 over the course of training
+    @beta.setter
+    def beta(self, value):
+        self.__beta = float(value)
+
+    def _transition_added(self, slot):
+        self.__tree.update(slot, self.__max_priority ** self.__alpha)
+
+    def _transition_removed(self, slot):
+        self.__tree.update(slot, 0)
+
+    # Samples num_batches minibatches of batch_size transitions.
+    # Each minibatch is stratified: the total priority is split into batch_size equal segments and one transition is drawn from each.
+    # The returned dict also contains the slots of the transitions in 'indices', to be passed back to update_priorities,
+    # and the normalized importance-sampling weights in 'weights'.
+    def sample(self, num_batches, batch_size, sample_randomly=False):
+        if sample_randomly:
+            return super(PrioritizedReplayMemory, self).sample(num_batches, batch_size, True)
+
+        if (batch_size > len(self)):
+            raise ValueError('Cannot sample {0} transitions from a memory of {1}'.format(batch_size, len(self)))
+
+        total = self.__tree.total
+        segment_starts = np.arange(0, batch_size, 1, dtype=np.float64)
+        values = (segment_starts + np.random.random_sample((num_batches, batch_size))) * (total / batch_size)
+        slots = self.__tree.find(values.ravel())
+
+        # Importance-sampling weights correct for the bias introduced by the non-uniform sampling.
+        # They are normalized by the largest weight in the sample, so they only ever scale the updates down.
+        probabilities = self.__tree.get(slots) / total
+        weights = np.power(len(self) * probabilities, -self.__beta)
+        weights /= np.max(weights)
+
+        experiences = self._get_slots(slots)
+        experiences['indices'] = slots
+        experiences['weights'] = weights.astype(np.float32)
+        return experiences
+
+    # Replaces the priorities of previously sampled transitions with their new TD errors.
+    # Transitions that have been evicted since they were sampled have a priority of zero and are left alone.
+    def update_priorities(self, indices, td_errors):
+        indices = np.asarray(indices, dtype=np.int64)
+        priorities = np.abs(np.asarray(td_errors, dtype=np.float64)) + self.__priority_epsilon
+        if (priorities.size == 0):
+            return
+        self.__max_priority = max(self.__max_priority, float(np.max(priorities)))
+
+        is_live = self.__tree.get(indices) > 0
+        self.__tree.update(indices[is_live], np.power(priorities[is_live], self.__alpha))
@@ -0,0 +1,101 @@
+import argparse
+import os
+
+import numpy as np
+
+from numpy_inference import NumpyInferenceEngine, QUANTIZATION_KEY
+from tensor_packet import load_checkpoint, save_checkpoint
+
+
+# Exports a trained checkpoint as a smaller artifact for driving on CPU-only machines with run_model.py --engine numpy.
+# With int8, every kernel is quantized symmetrically with one scale per output channel, and the biases are kept as float32.
+# With float16, every tensor is stored as float16.
+# The artifact is a checkpoint in the tensor_packet format, which NumpyInferenceEngine.from_checkpoint loads like any other.
+# NumpyInferenceEngine keeps the loaded weights as int8 or float16, so the artifact is smaller on disk, to transfer and in memory.
+# Optionally, the argmax agreement with the float model is checked on recorded frames.
+
+QUANTIZATION_DTYPES = ['int8', 'float16']
+
+
+# Quantizes a kernel to int8, with the scale of each output channel (the last axis) set by its largest absolute weight
+def quantize_per_channel(kernel):
+    kernel = np.asarray(kernel, dtype=np.float32)
+    max_abs = np.max(np.abs(kernel.reshape(-1, kernel.shape[-1])), axis=0)
+    scale = np.where(max_abs > 0, max_abs / 127.0, 1.0).astype(np.float32)
+    quantized = np.clip(np.rint(kernel / scale), -127, 127).astype(np.int8)
+    return {'quantized': quantized, 'scale': scale}
+
+
+# Quantizes the action model of a model packet, returning the packet of the artifact
+def quantize_packet(packet, dtype):
+    if (dtype not in QUANTIZATION_DTYPES):
+        raise ValueError('dtype must be one of {0}, got {1}'.format(QUANTIZATION_DTYPES, dtype))
+
+    weights = []
+    for w in packet['action_model']:
+        w = np.asarray(w, dtype=np.float32)
+        if (dtype == 'float16'):
+            weights.append(w.astype(np.float16))
+        elif (w.ndim > 1):
+            weights.append(quantize_per_channel(w))
+        else:
+            weights.append(w)
+
+    quantized_packet = {}
+    quantized_packet[QUANTIZATION_KEY] = dtype
+    quantized_packet['action_model'] = weights
+    return quantized_packet
+
+
+# Reads frames saved with np.save, either single (59, 255, 3) frames or stacks of them
+def load_frames(paths):
+    frames = []
+    for path in paths:
+        array = np.load(path)
+        frames.append(array[np.newaxis] if array.ndim == 3 else array)
+    return np.concatenate(frames).astype(np.uint8)
+
+
+# Compares the predictions of the quantized engine with those of the float engine on the frames.
+# Returns the fraction of frames where both choose the same action, and the largest difference between their Q values.
+def check_agreement(float_engine, quantized_engine, frames, batch_size=32):
+    num_agreeing = 0
+    max_q_difference = 0.0
+    for start in range(0, frames.shape[0], batch_size):
+        batch = frames[start:start + batch_size]
+        float_q_values = float_engine.predict_q_values(batch).copy()
+        quantized_q_values = quantized_engine.predict_q_values(batch)
+        num_agreeing += int(np.sum(np.argmax(float_q_values, axis=1) == np.argmax(quantized_q_values, axis=1)))
+        max_q_difference = max(max_q_difference, float(np.max(np.abs(float_q_values - quantized_q_values))))
+
+    agreement = {}
+    agreement['num_frames'] = int(frames.shape[0])
+    agreement['argmax_agreement'] = float(num_agreeing) / frames.shape[0]
+    agreement['max_q_difference'] = max_q_difference
+    return agreement
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Exports a trained checkpoint as a quantized artifact for run_model.py --engine numpy.')
+    parser.add_argument('checkpoint_path', help='A checkpoint written by the agent or the trainer, or a legacy JSON checkpoint')
+    parser.add_argument('output_path')
+    parser.add_argument('--dtype', choices=QUANTIZATION_DTYPES, default='int8')
+    parser.add_argument('--frames', nargs='+', default=[], help='.npy files of recorded (59, 255, 3) uint8 frames, to check the agreement on')
+    parser.add_argument('--min_agreement', type=float, default=None, help='Fail if the argmax agreement is lower than this')
+    args = parser.parse_args()
+
+    packet = load_checkpoint(args.checkpoint_path)['model']
+    checkpoint = {}
+    checkpoint['model'] = quantize_packet(packet, args.dtype)
+
+    if args.frames:
+        frames = load_frames(args.frames)
+        agreement = check_agreement(NumpyInferenceEngine.from_packet(packet), NumpyInferenceEngine.from_packet(checkpoint['model']), frames)
+        print('Argmax agreement with the float model on {0} frames: {1:.2%}, largest Q value difference: {2:.6f}'.format(
+            agreement['num_frames'], agreement['argmax_agreement'], agreement['max_q_difference']))
+        checkpoint['agreement'] = agreement
+        if (args.min_agreement is not None and agreement['argmax_agreement'] < args.min_agreement):
+            raise SystemExit('The agreement is below {0:.2%}, the artifact was not written'.format(args.min_agreement))
+
+    save_checkpoint(args.output_path, checkpoint)
+    print('Wrote {0} ({1} bytes, the checkpoint is {2} bytes)'.format(args.output_path, os.path.getsize(args.output_path), os.path.getsize(args.checkpoint_path)))
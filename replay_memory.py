@@ -0,0 +1,282 @@
+import numpy as np
+
+
+# Above this many random keys, sample_index_matrix switches from exact key sampling to rejection sampling
+MAX_SAMPLING_KEYS = 1 << 22
+
+
+# Draws a (num_batches, batch_size) matrix of indices into [0, population_size) in a single vectorized call.
+# The indices are unique within each batch, but not across batches.
+# If probabilities are given, they weight the draw in the same way as np.random.choice(replace=False, p=probabilities).
+# Like np.random.choice, it raises ValueError if fewer than batch_size probabilities are nonzero.
+def sample_index_matrix(population_size, num_batches, batch_size, probabilities=None, max_redraws=32):
+    if (batch_size > population_size):
+        raise ValueError('Cannot sample {0} unique indices from a population of {1}'.format(batch_size, population_size))
+
+    if (probabilities is not None):
+        probabilities = np.asarray(probabilities, dtype=np.float64)
+        num_nonzero = int(np.count_nonzero(probabilities))
+        if (batch_size > num_nonzero):
+            raise ValueError('Cannot sample {0} unique indices when only {1} probabilities are nonzero'.format(batch_size, num_nonzero))
+
+    # For small populations, give every member of every batch a random key and keep the batch_size smallest keys.
+    # With exponential keys scaled by the probabilities, this is exact weighted sampling without replacement.
+    if (num_batches * population_size <= MAX_SAMPLING_KEYS):
+        if (probabilities is None):
+            keys = np.random.random_sample((num_batches, population_size))
+        else:
+            with np.errstate(divide='ignore'):
+                keys = np.random.standard_exponential((num_batches, population_size)) / probabilities
+        if (batch_size == population_size):
+            return np.argsort(keys, axis=1)
+        return np.argpartition(keys, batch_size - 1, axis=1)[:, :batch_size]
+
+    # For large populations collisions are rare, so draw with replacement and redraw only the batches that contain a duplicate.
+    if (probabilities is None):
+        draw = lambda num_rows: np.random.randint(0, population_size, size=(num_rows, batch_size))
+    else:
+        cdf = np.cumsum(probabilities)
+        cdf /= cdf[-1]
+        draw = lambda num_rows: np.minimum(np.searchsorted(cdf, np.random.random_sample((num_rows, batch_size)), side='right'), population_size - 1)
+
+    indices = draw(num_batches)
+    for _ in range(0, max_redraws, 1):
+        sorted_indices = np.sort(indices, axis=1)
+        has_duplicates = np.any(sorted_indices[:, 1:] == sorted_indices[:, :-1], axis=1)
+        if not np.any(has_duplicates):
+            return indices
+        indices[has_duplicates] = draw(int(np.count_nonzero(has_duplicates)))
+
+    # Heavily skewed probabilities can keep producing duplicates. Fall back to drawing those batches one at a time.
+    sorted_indices = np.sort(indices, axis=1)
+    for row in np.nonzero(np.any(sorted_indices[:, 1:] == sorted_indices[:, :-1], axis=1))[0]:
+        indices[row] = np.random.choice(population_size, size=batch_size, replace=False, p=probabilities)
+    return indices
+
+
+# A fixed-capacity replay memory backed by preallocated numpy arrays.
+# Each captured frame is stored once in a ring buffer of frames. A transition only records the id of the frame that was observed after the action,
+# the pre and post states are the state_length frames that end just before and at that frame. They are stacked only when a batch is read.
+# Both ring buffers are written in place, so inserting is O(1) and the oldest data is overwritten once the memory is full.
+# The arrays are created with allocate(shape, dtype), always in the same order, which can place them in shared memory.
+class ReplayMemory(object):
+    def __init__(self, capacity=None, frame_shape=(59, 255, 3), frame_dtype=np.float64, state_length=4, frame_capacity=None, capacity_bytes=None,
+                 allocate=np.zeros):
+        self.__frame_shape = tuple(frame_shape)
+        self.__frame_dtype = np.dtype(frame_dtype)
+        self.__state_length = int(state_length)
+
+        # The capacity can either be given as a number of transitions or as a memory budget in bytes.
+        if (capacity_bytes is not None):
+            capacity = int(capacity_bytes) // self.bytes_per_transition(self.__frame_shape, self.__frame_dtype)
+        if (capacity is None or int(capacity) <= 0):
+            raise ValueError('Replay memory capacity must be positive, got {0}'.format(capacity))
+        self.__capacity = int(capacity)
+
+        # Every episode stores state_length frames before its first transition.
+        # Keep some headroom so that those frames do not evict transitions before the transition buffer is full.
+        if (frame_capacity is None):
+            frame_capacity = self.default_frame_capacity(self.__capacity, self.__state_length)
+        if (int(frame_capacity) <= self.__state_length):
+            raise ValueError('frame_capacity must be larger than state_length ({0}), got {1}'.format(self.__state_length, frame_capacity))
+        self.__frame_capacity = int(frame_capacity)
+
+        self.__frames = allocate((self.__frame_capacity,) + self.__frame_shape, dtype=self.__frame_dtype)
+        self.__post_frame_ids = allocate(self.__capacity, dtype=np.int64)
+        self.__actions = allocate(self.__capacity, dtype=np.int32)
+        self.__rewards = allocate(self.__capacity, dtype=np.float32)
+        self.__predicted_rewards = allocate(self.__capacity, dtype=np.float32)
+        self.__is_not_terminal = allocate(self.__capacity, dtype=np.uint8)
+
+        # The car position, speed and collision flag after each action are kept so that rewards can be recomputed later
+        self.__positions = allocate((self.__capacity, 2), dtype=np.float32)
+        self.__speeds = allocate(self.__capacity, dtype=np.float32)
+        self.__has_collided = allocate(self.__capacity, dtype=np.uint8)
+
+        # Frame ids increase monotonically, the slot of a frame is its id modulo the frame capacity.
+        self.__num_frames = 0
+        self.__episode_frames = 0
+
+        # The view returned by next_frame_view, if the frame it points to has not been added yet
+        self.__next_frame_view = None
+
+        # The slot of the oldest transition, and the number of valid transitions in the memory.
+        self.__start_index = 0
+        self.__size = 0
+
+    @staticmethod
+    def default_frame_capacity(capacity, state_length=4):
+        return capacity + (capacity // 8) + state_length + 1
+
+    # The approximate number of bytes that a single transition occupies, including its share of the frame buffer
+    @staticmethod
+    def bytes_per_transition(frame_shape=(59, 255, 3), frame_dtype=np.float64):
+        frame_bytes = int(np.prod(frame_shape)) * np.dtype(frame_dtype).itemsize
+        scalar_bytes = np.dtype(np.int64).itemsize + np.dtype(np.int32).itemsize + (5 * np.dtype(np.float32).itemsize) + (2 * np.dtype(np.uint8).itemsize)
+        return frame_bytes + (frame_bytes // 8) + scalar_bytes
+
+    @property
+    def capacity(self):
+        return self.__capacity
+
+    @property
+    def frame_capacity(self):
+        return self.__frame_capacity
+
+    @property
+    def nbytes(self):
+        return self.__frames.nbytes + self.__post_frame_ids.nbytes + self.__actions.nbytes + self.__rewards.nbytes \
+            + self.__predicted_rewards.nbytes + self.__is_not_terminal.nbytes + self.__positions.nbytes + self.__speeds.nbytes + self.__has_collided.nbytes
+
+    # The fraction of the memory that has been filled.
+    # This reaches 1 once either the transitions or the frames have wrapped around.
+    @property
+    def fill_ratio(self):
+        return min(1.0, max(float(self.__size) / self.__capacity, float(self.__num_frames) / self.__frame_capacity))
+
+    def __len__(self):
+        return self.__size
+
+    # The counters that locate the data in the arrays.
+    # A memory whose arrays are shared with another one can take over its contents by loading its counters.
+    @property
+    def counters(self):
+        return (self.__num_frames, self.__episode_frames, self.__start_index, self.__size)
+
+    def load_counters(self, counters):
+        self.__num_frames, self.__episode_frames, self.__start_index, self.__size = [int(c) for c in counters]
+
+    # Removes the transitions that reference the frame slot that is about to be overwritten
+    def __evict_frame_slot(self, frame_id):
+        oldest_kept_frame_id = frame_id - self.__frame_capacity + 1
+        while (self.__size > 0 and self.__post_frame_ids[self.__start_index] - self.__state_length < oldest_kept_frame_id):
+            self.__remove_oldest_transition()
+
+    def __remove_oldest_transition(self):
+        self._transition_removed(self.__start_index)
+        self.__start_index = (self.__start_index + 1) % self.__capacity
+        self.__size -= 1
+
+    def __add_frame(self, frame):
+        frame_id = self.__num_frames
+        self.__evict_frame_slot(frame_id)
+        # A frame that was captured straight into its slot is already in place
+        if (frame is not self.__next_frame_view):
+            self.__frames[frame_id % self.__frame_capacity] = frame
+        self.__next_frame_view = None
+        self.__num_frames += 1
+        self.__episode_frames += 1
+        return frame_id
+
+    # Returns a writable view of the slot that the next added frame will be stored in.
+    # A frame can be captured directly into the view and then passed to add or start_episode, which will not copy it again.
+    # The transitions that reference the slot are evicted first, so that they never see a partially written frame.
+    def next_frame_view(self):
+        frame_id = self.__num_frames
+        self.__evict_frame_slot(frame_id)
+        self.__next_frame_view = self.__frames[frame_id % self.__frame_capacity]
+        return self.__next_frame_view
+
+    # Starts a new episode with the initial state.
+    # The state_length frames are stored so that the first transition of the episode can reference them.
+    def start_episode(self, initial_frames):
+        if (len(initial_frames) != self.__state_length):
+            raise ValueError('Expected {0} initial frames, got {1}'.format(self.__state_length, len(initial_frames)))
+
+        self.__episode_frames = 0
+        for frame in initial_frames:
+            self.__add_frame(frame)
+
+    # Adds a single transition to the memory.
+    # The pre state is the current state of the episode, the post state is the same state shifted by the newly observed frame.
+    # The position, speed and collision flag of the car after the action are only used to relabel the rewards.
+    def add(self, post_frame, action, reward, predicted_reward, is_not_terminal=1, position=(0, 0), speed=0, has_collided=False):
+        if (self.__episode_frames < self.__state_length):
+            raise RuntimeError('start_episode must be called before adding transitions')
+
+        frame_id = self.__add_frame(post_frame)
+
+        if (self.__size == self.__capacity):
+            self.__remove_oldest_transition()
+
+        index = (self.__start_index + self.__size) % self.__capacity
+        self.__post_frame_ids[index] = frame_id
+        self.__actions[index] = action
+        self.__rewards[index] = reward
+        self.__predicted_rewards[index] = predicted_reward
+        self.__is_not_terminal[index] = is_not_terminal
+        self.__positions[index] = position
+        self.__speeds[index] = speed
+        self.__has_collided[index] = has_collided
+        self.__size += 1
+        self._transition_added(index)
+
+    # Called with the slot of every transition that is added to the memory.
+    # Subclasses can override this to keep per-slot bookkeeping in sync.
+    def _transition_added(self, slot):
+        pass
+
+    # Called with the slot of every transition that is evicted from the memory
+    def _transition_removed(self, slot):
+        pass
+
+    # Marks the most recently added transition as the end of an episode
+    def mark_last_terminal(self):
+        if (self.__size > 0):
+            self.__is_not_terminal[(self.__start_index + self.__size - 1) % self.__capacity] = 0
+
+    # Converts logical indices (0 is the oldest transition) into slots of the transition ring buffer
+    def __to_slots(self, indices):
+        return (np.asarray(indices, dtype=np.int64) + self.__start_index) % self.__capacity
+
+    # Returns the transitions at the given logical indices as a dict of arrays.
+    # The pre and post states are assembled from the frame buffer here, they share all but one of their frames.
+    def get(self, indices):
+        return self._get_slots(self.__to_slots(indices))
+
+    # Returns the transitions stored in the given slots of the transition ring buffer
+    def _get_slots(self, slots):
+        frame_ids = self.__post_frame_ids[slots][:, np.newaxis] + np.arange(-self.__state_length, 1, dtype=np.int64)
+        frames = self.__frames[frame_ids % self.__frame_capacity]
+
+        experiences = {}
+        experiences['pre_states'] = frames[:, :self.__state_length]
+        experiences['post_states'] = frames[:, 1:]
+        experiences['actions'] = self.__actions[slots]
+        experiences['rewards'] = self.__rewards[slots]
+        experiences['predicted_rewards'] = self.__predicted_rewards[slots]
+        experiences['is_not_terminal'] = self.__is_not_terminal[slots]
+        return experiences
+
+    # Samples num_batches minibatches of batch_size transitions and returns them concatenated into a dict of arrays.
+    # If sample_randomly is False, transitions are weighted by their surprise factor,
+    # which is the difference between the predicted and the actual reward.
+    def sample(self, num_batches, batch_size, sample_randomly=True):
+        probabilities = None
+        if not sample_randomly:
+            surprise_factor = np.abs(self.field('rewards').astype(np.float64) - self.field('predicted_rewards'))
+            surprise_factor_normalizer = np.sum(surprise_factor)
+            # Sample uniformly until enough transitions have a surprise to fill a batch
+            if (np.count_nonzero(surprise_factor) >= batch_size):
+                probabilities = surprise_factor / surprise_factor_normalizer
+
+        indices = sample_index_matrix(self.__size, num_batches, batch_size, probabilities)
+        return self.get(indices.ravel())
+
+    # Returns a copy of a per-transition field for all of the valid transitions, oldest first
+    def field(self, field_name):
+        values = {'actions': self.__actions,
+                  'rewards': self.__rewards,
+                  'predicted_rewards': self.__predicted_rewards,
+                  'is_not_terminal': self.__is_not_terminal,
+                  'positions': self.__positions,
+                  'speeds': self.__speeds,
+                  'has_collided': self.__has_collided}[field_name]
+        return values[self.__to_slots(np.arange(self.__size))]
+
+    # Recomputes the rewards of every transition in the memory with the given RewardFunction.
+    # This is used after tuning the reward parameters. The episode boundaries are left unchanged.
+    def relabel_rewards(self, reward_function):
+        slots = self.__to_slots(np.arange(self.__size))
+        rewards, _ = reward_function.compute_rewards(self.__positions[slots], self.__speeds[slots], self.__has_collided[slots])
+        self.__rewards[slots] = rewards
@@ -0,0 +1,61 @@
+import numpy as np
+
+from road_map import SegmentGrid, load_reward_segments
+
+
+#Define some constant parameters for the reward function
+THRESH_DIST = 3.5                # The maximum distance from the center of the road to compute the reward function
+DISTANCE_DECAY_RATE = 1.2        # The rate at which the reward decays for the distance function
+MIN_SPEED = 2                    # Below this speed the car is considered stopped, and the reward is always zero
+
+
+# Computes the reward of the car based on its distance to the nearest road center line.
+# The segments are held in a SegmentGrid so that distances, rewards and off-road flags can be computed for many positions in one call,
+# in roughly constant time per position even on large maps.
+# This is used by the agent for every control step, and to relabel a whole replay memory when the parameters are tuned.
+class RewardFunction(object):
+    def __init__(self, segments, thresh_dist=THRESH_DIST, distance_decay_rate=DISTANCE_DECAY_RATE, min_speed=MIN_SPEED, cell_size=None):
+        self.thresh_dist = float(thresh_dist)
+        self.distance_decay_rate = float(distance_decay_rate)
+        self.min_speed = float(min_speed)
+
+        self.__index = SegmentGrid(segments, cell_size)
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        return cls(load_reward_segments(path), **kwargs)
+
+    @property
+    def segments(self):
+        return self.__index.segments
+
+    # Computes the distance from each of the (N, 2) points to the nearest segment
+    def distances(self, points):
+        return self.__index.distances(points)
+
+    # Computes the rewards and the off-road flags for (N, 2) car positions.
+    # The distance component is the exponential of the distance to the nearest center line.
+    # If the speeds or the collision flags are given, stopped or collided cars get a reward of zero and are flagged as off the road.
+    def compute_rewards(self, points, speeds=None, has_collided=None):
+        distances = self.distances(points)
+        rewards = np.exp(-(distances * self.distance_decay_rate))
+        is_off_road = distances > self.thresh_dist
+
+        is_done = np.zeros(distances.shape, dtype=bool)
+        if (speeds is not None):
+            is_done |= np.asarray(speeds).reshape(-1) < self.min_speed
+        if (has_collided is not None):
+            is_done |= np.asarray(has_collided, dtype=bool).reshape(-1)
+
+        rewards[is_done] = 0.0
+        is_off_road |= is_done
+        return rewards, is_off_road
+
+    # Computes the reward and the off-road flag for a single car position
+    def compute_reward(self, point, speed, has_collided):
+        # If the car has collided or stopped, the reward is always zero
+        if (has_collided or speed < self.min_speed):
+            return 0.0, True
+
+        rewards, is_off_road = self.compute_rewards(point)
+        return float(rewards[0]), bool(is_off_road[0])
@@ -1,12 +1,13 @@
 import numpy as np
 import threading
 
+from gradient_compression import apply_compressed_gradient
+
 import tensorflow.compat.v1 as tf
 tf.disable_v2_behavior()
 
 from tensorflow.keras.models import Model, clone_model
 from tensorflow.keras.layers import Conv2D, MaxPooling2D, Dropout, Flatten, Dense, Input
-from tensorflow.keras.optimizers import Adam
 from tensorflow.keras.initializers import random_normal
 import keras.backend as K
 
@@ -17,6 +18,13 @@ session = tf.Session(config=config)
 K.set_session(session)
 
 
+# Converts uint8 frames into the float32 input of the network.
+# Frames are stored as uint8 everywhere else, so this is the only place where they are converted.
+# The pixel values are kept in [0, 255], which is the range the pretrained weights expect.
+def frames_to_model_input(frames):
+    return np.asarray(frames, dtype=np.float32)
+
+
 # A wrapper class for the DQN model
 class RlModel():
     def __init__(self, weights_path, train_conv_layers):
@@ -42,12 +50,9 @@ class RlModel():
         img_stack=Dropout(0.2)(img_stack)
         output = Dense(self.__nb_actions, name='rl_output', kernel_initializer=random_normal(stddev=0.01))(img_stack)
 
-        opt = Adam()
-
+        # The model is not compiled: it is only trained by the fused step of __build_train_step, which has its own Adam optimizer
         self.__action_model = Model(inputs=[pic_input], outputs=output)
 
-        self.__action_model.compile(optimizer=opt, loss='mean_squared_error')
-        
         # If we are using pretrained weights for the conv layers, load them and verify the first layer.
         if (weights_path is not None and len(weights_path) > 0):
             self.__action_model.load_weights(weights_path, by_name=True)
@@ -58,122 +63,197 @@ class RlModel():
         self.__target_model = clone_model(self.__action_model)
 
         self.__target_context = tf.compat.v1.get_default_graph()
+
+        # The methods that use the weights hold the lock, so a model can be shared between the actor and learner threads
         self.__model_lock = threading.Lock()
 
-    # A helper function to read in the model from a JSON packet.
+        # The training step is only built by the first training call, the models of the trainer and of the actors never train
+        self.__train_op = None
+
+    # Builds the fused training step, which computes the Bellman targets, the loss, its gradients and an Adam update in a single session call.
+    # The loss is the same as the compiled one: the mean squared error over the 5 outputs, where only the action taken has a label,
+    # weighted by the importance-sampling weight of each example.
+    # Adam is done in the graph, so the step returns the change of each weight directly, and the agent does not have to snapshot the weights.
+    def __build_train_step(self, learning_rate=0.001, beta_1=0.9, beta_2=0.999, epsilon=1e-7):
+        self.__train_pre_states = tf.placeholder(tf.float32, shape=(None, 59, 255, 3))
+        self.__train_post_states = tf.placeholder(tf.float32, shape=(None, 59, 255, 3))
+        self.__train_actions = tf.placeholder(tf.int32, shape=(None,))
+        self.__train_rewards = tf.placeholder(tf.float32, shape=(None,))
+        self.__train_is_not_terminal = tf.placeholder(tf.float32, shape=(None,))
+        self.__train_sample_weights = tf.placeholder(tf.float32, shape=(None,))
+
+        # Apply the Bellman equation, with the labels of the actions that were taken
+        q_values = self.__action_model(self.__train_pre_states, training=True)
+        q_futures = self.__target_model(self.__train_post_states, training=False)
+        q_labels = tf.stop_gradient(self.__train_rewards + (self.__gamma * self.__train_is_not_terminal * tf.reduce_max(q_futures, axis=1)))
+        q_taken = tf.reduce_sum(q_values * tf.one_hot(self.__train_actions, self.__nb_actions), axis=1)
+        self.__train_td_errors = q_labels - q_taken
+        loss = tf.reduce_mean(self.__train_sample_weights * tf.square(self.__train_td_errors)) / self.__nb_actions
+
+        # The layers that are not trained keep a zero update, so the update still has an entry for every weight
+        trainable_ids = set(id(w) for w in self.__action_model.trainable_weights)
+        self.__train_trainable = [id(w) in trainable_ids for w in self.__action_model.weights]
+        trainable_weights = [w for w in self.__action_model.weights if id(w) in trainable_ids]
+        gradients = tf.gradients(loss, trainable_weights)
+
+        step = tf.Variable(0.0, trainable=False)
+        moments = [tf.Variable(tf.zeros(w.shape), trainable=False) for w in trainable_weights]
+        velocities = [tf.Variable(tf.zeros(w.shape), trainable=False) for w in trainable_weights]
+        new_step = tf.assign_add(step, 1.0)
+        step_size = learning_rate * tf.sqrt(1.0 - tf.pow(beta_2, new_step)) / (1.0 - tf.pow(beta_1, new_step))
+
+        self.__train_deltas = []
+        for gradient, m, v in zip(gradients, moments, velocities):
+            new_m = tf.assign(m, (beta_1 * m) + ((1.0 - beta_1) * gradient))
+            new_v = tf.assign(v, (beta_2 * v) + ((1.0 - beta_2) * tf.square(gradient)))
+            self.__train_deltas.append(-step_size * new_m / (tf.sqrt(new_v) + epsilon))
+
+        # The weights are only moved once every gradient has been computed from the current weights
+        with tf.control_dependencies(self.__train_deltas + [self.__train_td_errors]):
+            self.__train_op = tf.group(*[tf.assign_add(w, delta) for w, delta in zip(trainable_weights, self.__train_deltas)])
+
+        tf.compat.v1.keras.backend.get_session().run(tf.variables_initializer([step] + moments + velocities))
+
+    # A helper function to read in the model from a packet.
     # This is used both to read the file from disk and from a network packet
+    # The weights can be nested lists from a JSON packet, or float32 arrays from a binary packet, which are used without copying.
+    # A delta packet has None in place of the layers that did not change, those layers keep their current weights.
     def from_packet(self, packet):
-        with self.__action_context.as_default():
-            self.__action_model.set_weights([np.array(w) for w in packet['action_model']])
-            self.__action_context = tf.compat.v1.get_default_graph()
-        if 'target_model' in packet:
-            with self.__target_context.as_default():
-                self.__target_model.set_weights([np.array(w) for w in packet['target_model']])
-                self.__target_context = tf.compat.v1.get_default_graph()
+        with self.__model_lock:
+            with self.__action_context.as_default():
+                self.__action_model.set_weights(self.__merge_weights(self.__action_model, packet['action_model']))
+                self.__action_context = tf.compat.v1.get_default_graph()
+            if 'target_model' in packet:
+                with self.__target_context.as_default():
+                    self.__target_model.set_weights(self.__merge_weights(self.__target_model, packet['target_model']))
+                    self.__target_context = tf.compat.v1.get_default_graph()
 
-    # A helper function to write the model to a JSON packet.
+    # Converts the weights of a packet to arrays, filling the layers missing from a delta packet with the current weights of the model
+    def __merge_weights(self, model, weights):
+        current_weights = model.get_weights() if any(w is None for w in weights) else None
+        return [current_weights[i] if w is None else np.asarray(w, dtype=np.float32) for i, w in enumerate(weights)]
+
+    # A helper function to write the model to a packet.
     # This is used to send the model across the network from the trainer to the agent
-    def to_packet(self, get_target = True):
-        packet = {}
-        with self.__action_context.as_default():
-            packet['action_model'] = [w.tolist() for w in self.__action_model.get_weights()]
-            self.__action_context = tf.compat.v1.get_default_graph()
-        if get_target:
-            with self.__target_context.as_default():
-                packet['target_model'] = [w.tolist() for w in self.__target_model.get_weights()]
+    # With as_lists, the weights are nested lists that can be serialized to JSON. Otherwise they are float32 arrays for a binary packet.
+    def to_packet(self, get_target = True, as_lists = True):
+        with self.__model_lock:
+            convert = (lambda w: w.tolist()) if as_lists else (lambda w: np.asarray(w, dtype=np.float32))
+            packet = {}
+            with self.__action_context.as_default():
+                packet['action_model'] = [convert(w) for w in self.__action_model.get_weights()]
+                self.__action_context = tf.compat.v1.get_default_graph()
+            if get_target:
+                with self.__target_context.as_default():
+                    packet['target_model'] = [convert(w) for w in self.__target_model.get_weights()]
 
-        return packet
+            return packet
 
     # Updates the model with the supplied gradients
     # This is used by the trainer to accept a training iteration update from the agent
-    def update_with_gradient(self, gradients, should_update_critic):
-        with self.__action_context.as_default():
-            action_weights = self.__action_model.get_weights()
-            if (len(action_weights) != len(gradients)):
-                raise ValueError('len of action_weights is {0}, but len gradients is {1}'.format(len(action_weights), len(gradients)))
+    # The gradients can be dense arrays or lists, or the per-layer entries produced by GradientCompressor.
+    # They are multiplied by scale before being applied.
+    def update_with_gradient(self, gradients, should_update_critic, scale=1.0):
+        with self.__model_lock:
+            with self.__action_context.as_default():
+                action_weights = self.__action_model.get_weights()
+                if (len(action_weights) != len(gradients)):
+                    raise ValueError('len of action_weights is {0}, but len gradients is {1}'.format(len(action_weights), len(gradients)))
             
-            dx = 0
-            for i in range(0, len(action_weights), 1):
-                action_weights[i] += gradients[i]
-                dx += np.sum(np.sum(np.abs(gradients[i])))
-            print('Moved weights {0}'.format(dx))
-            self.__action_model.set_weights(action_weights)
-            self.__action_context = tf.compat.v1.get_default_graph()
-
-            if (should_update_critic):
-                with self.__target_context.as_default():
-                    self.__target_model.set_weights([np.array(w, copy=True) for w in action_weights])
+                dx = 0
+                for i in range(0, len(action_weights), 1):
+                    dx += apply_compressed_gradient(action_weights[i], gradients[i], scale)
+                print('Moved weights {0}'.format(dx))
+                self.__action_model.set_weights(action_weights)
+                self.__action_context = tf.compat.v1.get_default_graph()
+
+                if (should_update_critic):
+                    with self.__target_context.as_default():
+                        self.__target_model.set_weights([np.array(w, copy=True) for w in action_weights])
 
             
     def update_critic(self):
-        with self.__target_context.as_default():
-            self.__target_model.set_weights([np.array(w, copy=True) for w in self.__action_model.get_weights()])
+        with self.__model_lock:
+            with self.__target_context.as_default():
+                self.__target_model.set_weights([np.array(w, copy=True) for w in self.__action_model.get_weights()])
     
             
     # Given a set of training data, trains the model and determine the gradients.
     # The agent will use this to compute the model updates to send to the trainer
-    def get_gradient_update_from_batches(self, batches):
-        pre_states = np.array(batches['pre_states'])
-        post_states = np.array(batches['post_states'])
-        rewards = np.array(batches['rewards'])
-        actions = list(batches['actions'])
-        is_not_terminal = np.array(batches['is_not_terminal'])
-        
-        # For now, our model only takes a single image in as input. 
-        # Only read in the last image from each set of examples
-        pre_states = pre_states[:, 3, :, :, :]
-        post_states = post_states[:, 3, :, :, :]
-        
-        # We only have labels for the action that the agent actually took.
-        # To prevent the model from training the other actions, figure out what the model currently predicts for each input.
-        # Then, the gradients with respect to those outputs will always be zero.
-        with self.__action_context.as_default():
-            labels = self.__action_model.predict([pre_states], batch_size=32)
-        
-        # Find out what the target model will predict for each post-decision state.
-        with self.__target_context.as_default():
-            q_futures = self.__target_model.predict([post_states], batch_size=32)
+    # The update of each weight is the sum of the changes made by the fused training step, one Adam step per minibatch of 32 examples.
+    # If the batches come from a prioritized replay memory, their importance-sampling weights are applied to the loss.
+    # If return_td_errors is set, the TD error of each example is returned as well, to be used as its new priority.
+    # With as_lists, the gradients are nested lists for JSON. Otherwise they are float32 arrays for a binary packet.
+    def get_gradient_update_from_batches(self, batches, return_td_errors=False, as_lists=True, batch_size=32):
+        with self.__model_lock:
+            # For now, our model only takes a single image in as input. 
+            # Only read in the last image from each set of examples
+            pre_states = frames_to_model_input(np.asarray(batches['pre_states'])[:, 3])
+            post_states = frames_to_model_input(np.asarray(batches['post_states'])[:, 3])
+            actions = np.asarray(batches['actions'], dtype=np.int32)
+            rewards = np.asarray(batches['rewards'], dtype=np.float32)
+            is_not_terminal = np.asarray(batches['is_not_terminal'], dtype=np.float32)
+            num_examples = actions.shape[0]
+            sample_weights = batches.get('weights', None)
+            sample_weights = np.ones(num_examples, dtype=np.float32) if sample_weights is None else np.asarray(sample_weights, dtype=np.float32)
 
-        # Apply the Bellman equation
-        q_futures_max = np.max(q_futures, axis=1)
-        q_labels = (q_futures_max * is_not_terminal * self.__gamma) + rewards
-        
-        # Update the label only for the actions that were actually taken.
-        for i in range(0, len(actions), 1):
-            labels[i][actions[i]] = q_labels[i]
-
-        # Perform a training iteration.
-        with self.__action_context.as_default():
-            original_weights = [np.array(w, copy=True) for w in self.__action_model.get_weights()]
-            self.__action_model.fit([pre_states], labels, epochs=1, batch_size=32, verbose=1)
-            
-            # Compute the gradients
-            new_weights = self.__action_model.get_weights()
-            gradients = []
-            dx = 0
-            for i in range(0, len(original_weights), 1):
-                gradients.append(new_weights[i] - original_weights[i])
-                dx += np.sum(np.sum(np.abs(new_weights[i]-original_weights[i])))
+            if (self.__train_op is None):
+                with self.__action_context.as_default():
+                    self.__build_train_step()
+
+            session = tf.compat.v1.keras.backend.get_session()
+            gradients = [np.zeros(w.shape, dtype=np.float32) for w in self.__action_model.weights]
+            trainable_gradients = [g for g, trainable in zip(gradients, self.__train_trainable) if trainable]
+            td_errors = np.empty(num_examples, dtype=np.float32)
 
-        # Numpy arrays are not JSON serializable by default
-        return [w.tolist() for w in gradients]
+            # Perform a training iteration.
+            with self.__action_context.as_default():
+                for start in range(0, num_examples, batch_size):
+                    end = min(start + batch_size, num_examples)
+                    feed_dict = {self.__train_pre_states: pre_states[start:end],
+                                 self.__train_post_states: post_states[start:end],
+                                 self.__train_actions: actions[start:end],
+                                 self.__train_rewards: rewards[start:end],
+                                 self.__train_is_not_terminal: is_not_terminal[start:end],
+                                 self.__train_sample_weights: sample_weights[start:end]}
+                    deltas, td_errors[start:end], _ = session.run([self.__train_deltas, self.__train_td_errors, self.__train_op], feed_dict=feed_dict)
+                    for gradient, delta in zip(trainable_gradients, deltas):
+                        gradient += delta
+
+            # Numpy arrays are not JSON serializable by default
+            if as_lists:
+                gradients = [w.tolist() for w in gradients]
+            if return_td_errors:
+                return gradients, td_errors
+            return gradients
 
     # Performs a state prediction given the model input
     def predict_state(self, observation):
-        if (type(observation) == type([])):
-            observation = np.array(observation)
-        
         # Our model only predicts on a single state.
         # Take the latest image
-        observation = observation[3, :, :, :]
+        observation = frames_to_model_input(observation[3])
         observation = observation.reshape(1, 59,255,3)
-        with self.__action_context.as_default():
-            predicted_qs = self.__action_model.predict([observation])
+        with self.__model_lock:
+            with self.__action_context.as_default():
+                predicted_qs = self.__action_model.predict([observation])
 
         # Select the action with the highest Q value
         predicted_state = np.argmax(predicted_qs)
         return (predicted_state, predicted_qs[0][predicted_state])
 
+    # Performs the state predictions for a batch of states, given the latest frame of each one.
+    # The whole batch is a single forward pass, see InferenceService.
+    # Returns the action with the highest Q value, and that Q value, for each state.
+    def predict_states(self, frames):
+        frames = frames_to_model_input(frames)
+        with self.__model_lock:
+            with self.__action_context.as_default():
+                predicted_qs = self.__action_model.predict_on_batch(frames)
+
+        predicted_qs = np.asarray(predicted_qs)
+        predicted_states = np.argmax(predicted_qs, axis=1)
+        return (predicted_states, predicted_qs[np.arange(predicted_qs.shape[0]), predicted_states])
+
     # Convert the current state to control signals to drive the car.
     # As we are only predicting steering angle, we will use a simple controller to keep the car at a constant speed
     def state_to_control_signals(self, state, car_state):
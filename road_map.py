@@ -0,0 +1,193 @@
+import io
+
+import numpy as np
+
+
+# The number of point-to-segment distances computed at once. Larger queries are processed in chunks to bound memory.
+MAX_DISTANCES_PER_CHUNK = 1 << 20
+
+# The largest number of cells in a SegmentGrid, the cell size is increased if a map would need more
+MAX_GRID_CELLS = 1 << 20
+
+# Maps with at most this many segments are searched by brute force, which is faster than the grid for them
+MAX_BRUTE_FORCE_SEGMENTS = 128
+
+# A SegmentGrid with fewer cells than this does not build a coarser grid, it falls back to brute force instead
+MIN_COARSENED_CELLS = 256
+
+# The position of the car's start in unreal coordinates (cm). AirSim positions are relative to it, in meters.
+CAR_START_COORDS = (12961.722656, 6660.329102)
+
+
+# Loads the center lines used by the reward function.
+# Each line of the file holds a segment as four tab separated values: x1, y1, x2, y2.
+# Returns an (N, 2, 2) array of segments.
+def load_reward_segments(path):
+    return np.loadtxt(path, delimiter='\t', ndmin=2, dtype=np.float64)[:, 0:4].reshape(-1, 2, 2)
+
+
+# Loads the road lines used to pick starting points.
+# Each line of the file holds a segment as two tab separated points: x1,y1<tab>x2,y2.
+# Returns an (N, 2, 2) array of segments, in the coordinates of the file.
+def load_road_segments(path):
+    with open(path, 'r') as f:
+        text = f.read().replace('\t', ',')
+    return np.loadtxt(io.StringIO(text), delimiter=',', ndmin=2, dtype=np.float64)[:, 0:4].reshape(-1, 2, 2)
+
+
+# Converts segments from unreal coordinates to the AirSim coordinates of the car
+def to_car_coordinates(segments):
+    return (np.asarray(segments, dtype=np.float64) - np.array(CAR_START_COORDS)) / 100
+
+
+# Computes the distance from each point to the nearest of the given segments, by brute force.
+# The segments are given as start points, direction vectors and inverse squared lengths (0 for degenerate segments).
+def nearest_segment_distances(points, starts, directions, inverse_length_squared):
+    distances = np.empty(points.shape[0], dtype=np.float64)
+
+    chunk_size = max(1, MAX_DISTANCES_PER_CHUNK // max(1, starts.shape[0]))
+    for chunk_start in range(0, points.shape[0], chunk_size):
+        chunk = points[chunk_start:chunk_start + chunk_size]
+
+        # Project each point onto each segment, clamping the projection to the segment
+        offsets = chunk[:, np.newaxis, :] - starts[np.newaxis, :, :]
+        t = np.einsum('nmk,mk->nm', offsets, directions) * inverse_length_squared
+        np.clip(t, 0, 1, out=t)
+
+        deltas = offsets - (t[:, :, np.newaxis] * directions[np.newaxis, :, :])
+        squared_distances = np.einsum('nmk,nmk->nm', deltas, deltas)
+        distances[chunk_start:chunk_start + chunk_size] = np.sqrt(np.min(squared_distances, axis=1))
+
+    return distances
+
+
+# A uniform grid over a set of 2D segments that answers nearest-segment distance queries.
+# Every segment is registered in each cell that its bounding box overlaps. For each cell, the segments registered in the 3x3 block
+# of cells around it are precomputed. Any segment closer to a point than one cell size is in that block,
+# so a query only needs to look at a handful of candidates. Points whose nearest candidate is further away are passed on to a coarser grid,
+# and a brute force search is only used once the grid is too coarse to help.
+class SegmentGrid(object):
+    def __init__(self, segments, cell_size=None, coarsening_factor=4):
+        segments = np.asarray(segments, dtype=np.float64).reshape(-1, 2, 2)
+        if (segments.shape[0] == 0):
+            raise ValueError('A SegmentGrid needs at least one segment')
+
+        self.__starts = np.ascontiguousarray(segments[:, 0, :])
+        self.__directions = np.ascontiguousarray(segments[:, 1, :] - segments[:, 0, :])
+        length_squared = np.sum(self.__directions * self.__directions, axis=1)
+
+        # Degenerate segments are single points, the projection parameter is always 0 for them.
+        self.__inverse_length_squared = np.zeros_like(length_squared)
+        np.divide(1.0, length_squared, out=self.__inverse_length_squared, where=length_squared > 0)
+
+        segment_mins = np.minimum(segments[:, 0, :], segments[:, 1, :])
+        segment_maxs = np.maximum(segments[:, 0, :], segments[:, 1, :])
+        extent = np.max(segment_maxs, axis=0) - np.min(segment_mins, axis=0)
+
+        # By default, aim for about one segment per cell
+        if (cell_size is None):
+            cell_size = max(np.max(extent) / np.sqrt(segments.shape[0]), 1e-6)
+        cell_size = float(cell_size)
+        while (np.prod(np.floor(extent / cell_size) + 3) > MAX_GRID_CELLS):
+            cell_size *= 2
+        self.__cell_size = cell_size
+
+        # Leave a margin of one cell around the map, so that points just off the map are still answered by the grid
+        self.__origin = np.min(segment_mins, axis=0) - cell_size
+        self.__shape = (np.floor(extent / cell_size).astype(np.int64) + 3)
+
+        self.__candidates = None
+        self.__coarse_grid = None
+        if (segments.shape[0] <= MAX_BRUTE_FORCE_SEGMENTS):
+            return
+
+        self.__build(segment_mins, segment_maxs)
+
+        # Points far from any segment are answered by a coarser grid over the same segments
+        if (np.prod(self.__shape) > MIN_COARSENED_CELLS and coarsening_factor > 1):
+            self.__coarse_grid = SegmentGrid(segments, cell_size * coarsening_factor, coarsening_factor)
+
+    # Builds the padded (num_cells, max_candidates) table of the segments near each cell, with -1 as padding
+    def __build(self, segment_mins, segment_maxs):
+        nx, ny = int(self.__shape[0]), int(self.__shape[1])
+        min_cells = self.__to_cells(segment_mins)
+        max_cells = self.__to_cells(segment_maxs)
+
+        # Register each segment in every cell covered by its bounding box, grown by one cell in each direction for the 3x3 neighbourhood
+        first_cells = np.maximum(min_cells - 1, 0)
+        widths = np.minimum(max_cells + 2, self.__shape) - first_cells
+        counts = widths[:, 0] * widths[:, 1]
+
+        segment_ids = np.repeat(np.arange(counts.shape[0], dtype=np.int64), counts)
+        ranks = np.arange(segment_ids.shape[0], dtype=np.int64) - np.repeat(np.cumsum(counts) - counts, counts)
+        column_counts = widths[segment_ids, 1]
+        xs = first_cells[segment_ids, 0] + (ranks // column_counts)
+        ys = first_cells[segment_ids, 1] + (ranks % column_counts)
+        cell_ids = (xs * ny) + ys
+
+        order = np.argsort(cell_ids, kind='stable')
+        cell_ids = cell_ids[order]
+        segment_ids = segment_ids[order]
+
+        counts = np.bincount(cell_ids, minlength=nx * ny)
+        offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        ranks = np.arange(cell_ids.shape[0]) - offsets[cell_ids]
+
+        self.__candidates = np.full((nx * ny, max(1, int(np.max(counts)))), -1, dtype=np.int32)
+        self.__candidates[cell_ids, ranks] = segment_ids
+
+    def __to_cells(self, points):
+        return np.floor((points - self.__origin) / self.__cell_size).astype(np.int64)
+
+    @property
+    def cell_size(self):
+        return self.__cell_size
+
+    @property
+    def num_segments(self):
+        return self.__starts.shape[0]
+
+    @property
+    def segments(self):
+        return np.stack([self.__starts, self.__starts + self.__directions], axis=1)
+
+    # Computes the distance from each of the (N, 2) points to the nearest segment
+    def distances(self, points):
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        if (self.__candidates is None):
+            return nearest_segment_distances(points, self.__starts, self.__directions, self.__inverse_length_squared)
+
+        distances = np.full(points.shape[0], np.inf)
+
+        cells = self.__to_cells(points)
+        in_grid = np.all((cells >= 0) & (cells < self.__shape), axis=1)
+
+        grid_indices = np.nonzero(in_grid)[0]
+        grid_cells = cells[grid_indices, 0] * self.__shape[1] + cells[grid_indices, 1]
+        chunk_size = max(1, MAX_DISTANCES_PER_CHUNK // self.__candidates.shape[1])
+        for chunk_start in range(0, grid_indices.shape[0], chunk_size):
+            chunk_indices = grid_indices[chunk_start:chunk_start + chunk_size]
+            candidates = self.__candidates[grid_cells[chunk_start:chunk_start + chunk_size]]
+            is_candidate = candidates >= 0
+            candidates = np.maximum(candidates, 0)
+
+            # Project each point onto each of its candidate segments, clamping the projection to the segment
+            offsets = points[chunk_indices, np.newaxis, :] - self.__starts[candidates]
+            directions = self.__directions[candidates]
+            t = np.einsum('nmk,nmk->nm', offsets, directions) * self.__inverse_length_squared[candidates]
+            np.clip(t, 0, 1, out=t)
+
+            deltas = offsets - (t[:, :, np.newaxis] * directions)
+            squared_distances = np.einsum('nmk,nmk->nm', deltas, deltas)
+            squared_distances[~is_candidate] = np.inf
+            distances[chunk_indices] = np.sqrt(np.min(squared_distances, axis=1))
+
+        # The grid is only exact within one cell size of a point, the rest are searched with a coarser grid or by brute force
+        needs_fallback = distances > self.__cell_size
+        if np.any(needs_fallback):
+            if (self.__coarse_grid is not None):
+                distances[needs_fallback] = self.__coarse_grid.distances(points[needs_fallback])
+            else:
+                distances[needs_fallback] = nearest_segment_distances(points[needs_fallback], self.__starts, self.__directions, self.__inverse_length_squared)
+
+        return distances
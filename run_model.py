@@ -1,66 +1,93 @@
 from airsim_client import *
-from rl_model import RlModel
+from tensor_packet import load_checkpoint
+from numpy_inference import NumpyInferenceEngine, QUANTIZATION_KEY, dequantize_weights
+from episode_reset import EpisodeReset
+from frame_capture import FrameCapture
+from inference_service import InferenceService
+import argparse
+import threading
 import numpy as np
-import time
-import json
-import datetime
 
+# The part of the scene that the model looks at
+IMAGE_REGION = np.s_[76:135, 0:255, 0:3]
 
+# The longest time to wait for the car to start rolling and for the first frames to be captured
+WARMUP_TIMEOUT_SEC = 5
 
-def get_image(car_client):
-    image_response = car_client.simGetImages([ImageRequest(0, AirSimImageType.Scene, False, False)])[0]
-    image1d = np.frombuffer(image_response.image_data_uint8, dtype=np.uint8)
-    image_rgba = image1d.reshape(image_response.height, image_response.width, 4)
 
-    return image_rgba[76:135,0:255,0:3].astype(float)
-
-
-def append_to_ring_buffer(item, buffer, buffer_size):
-    if (len(buffer) >= buffer_size):
-        buffer = buffer[1:]
-    buffer.append(item)
-    return buffer
-
-
-if __name__ == '__main__':
-
-    model = RlModel(None, False)
-
-    with open('trained_model.json', 'r') as f:
-        checkpoint_data = json.loads(f.read())
-        model.from_packet(checkpoint_data['model'])
-
-    car_client = CarClient()
+# Drives the car of the simulator at host:port with the model.
+# The predictions come from predictor, which is either the model itself or an InferenceService shared with the other cars.
+# The model is an RlModel or a NumpyInferenceEngine.
+def drive(model, predictor, host, port):
+    car_client = CarClient(host, port)
     car_client.confirmConnection()
     car_client.enableApiControl(True)
     car_controls = CarControls()
-    print('Connected!')
+    print('Connected to {0}:{1}!'.format(host, port))
 
-    state_buffer = []
+    # The frames are captured on a background thread, so the control loop never waits for an image
     state_buffer_len = 4
+    state_buffer = np.zeros((state_buffer_len, 59, 255, 3), dtype=np.uint8)
+    frame_capture = FrameCapture(lambda: CarClient(host, port), IMAGE_REGION)
 
-    print('Running car for a few seconds...')
-    car_controls.steering = 0
-    car_controls.throttle = 1
-    car_controls.brake = 0
-    car_client.setCarControls(car_controls)
-    stop_run_time =datetime.datetime.now() + datetime.timedelta(seconds=2)
-    while(datetime.datetime.now() < stop_run_time):
-        time.sleep(0.01)
-        state_buffer = append_to_ring_buffer(get_image(car_client), state_buffer, state_buffer_len)
+    # Start the car rolling, until it is fast enough and the state buffer is full
+    print('Running car until it is rolling...')
+    episode_reset = EpisodeReset(car_client, car_controls, frame_capture, warmup_timeout_sec=WARMUP_TIMEOUT_SEC)
+    state_buffer = episode_reset.warm_up(state_buffer_len, state_buffer, keep_capturing=True)
 
     print('Running model')
+    observation = car_client.observe(image_requests=[])
     while(True):
-        state_buffer = append_to_ring_buffer(get_image(car_client), state_buffer, state_buffer_len)
-        next_state, dummy = model.predict_state(state_buffer)
-        next_control_signal = model.state_to_control_signals(next_state, car_client.getCarState())
+        state_buffer, frame_age = frame_capture.latest(state_buffer_len, state_buffer)
+        next_state, dummy = predictor.predict_state(state_buffer)
+        next_control_signal = model.state_to_control_signals(next_state, observation.car_state)
 
         car_controls.steering = next_control_signal[0]
         car_controls.throttle = next_control_signal[1]
         car_controls.brake = next_control_signal[2]
 
-        print('State = {0}, steering = {1}, throttle = {2}, brake = {3}'.format(next_state, car_controls.steering, car_controls.throttle, car_controls.brake))
+        print('{0}:{1} State = {2}, steering = {3}, throttle = {4}, brake = {5}, frame age = {6:.3f} sec'.format(
+            host, port, next_state, car_controls.steering, car_controls.throttle, car_controls.brake, frame_age))
 
-        car_client.setCarControls(car_controls)
+        # Send the controls and get the car state 0.1 seconds later, in a single round trip
+        observation = car_client.step(car_controls, 0.1, image_requests=[])
 
-        time.sleep(0.1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Drives one or more cars with a trained model.')
+    # The checkpoint can be a binary checkpoint written by the agent, a legacy JSON checkpoint, or an artifact written by quantize_model.py
+    parser.add_argument('checkpoint_path', nargs='?', default='trained_model.json')
+    parser.add_argument('--engine', choices=['numpy', 'tensorflow'], default='numpy',
+                        help='numpy runs the network without TensorFlow, tensorflow runs it with RlModel')
+    parser.add_argument('--airsim_addresses', nargs='+', default=['127.0.0.1:42451'], help='host:port of each simulator to drive')
+    parser.add_argument('--max_batch_size', type=int, default=32, help='With several simulators, the most predictions batched together')
+    parser.add_argument('--max_batch_delay_ms', type=float, default=2.0, help='With several simulators, the longest a prediction waits for a batch')
+    args = parser.parse_args()
+
+    checkpoint_data = load_checkpoint(args.checkpoint_path)
+    if (args.engine == 'numpy'):
+        model = NumpyInferenceEngine.from_packet(checkpoint_data['model'])
+    else:
+        # Only import TensorFlow when it is used
+        from rl_model import RlModel
+        model = RlModel(None, False)
+        packet = checkpoint_data['model']
+        if (QUANTIZATION_KEY in packet):
+            packet = {'action_model': dequantize_weights(packet)}
+        model.from_packet(packet)
+
+    addresses = [address.rsplit(':', 1) for address in args.airsim_addresses]
+    if (len(addresses) == 1):
+        drive(model, model, addresses[0][0], int(addresses[0][1]))
+    else:
+        # One thread per car, the predictions of all of the cars are batched by the inference service
+        inference_service = InferenceService(model, args.max_batch_size, args.max_batch_delay_ms / 1000.0)
+        inference_service.start()
+        threads = []
+        for host, port in addresses:
+            thread = threading.Thread(target=drive, args=(model, inference_service, host, int(port)))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,248 @@
+import struct
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from replay_memory import ReplayMemory, sample_index_matrix
+from tensor_packet import ALIGNMENT, dumps_packet, loads_packet
+
+
+# A replay memory shared by several actor processes and one learner, on a single host.
+# Each actor owns a partition, a ReplayMemory whose arrays live in a block of multiprocessing.shared_memory.
+# Only the actor writes to its partition, so actors never wait for each other, and the learner samples across all of the partitions.
+# Each partition has a lock, held by the actor while it updates the partition and by the learner while it samples from it.
+# Priorities are not shared, so the learner samples uniformly or by surprise factor, like ReplayMemory.sample.
+
+
+# Lays arrays out one after another in a shared memory block, each aligned to ALIGNMENT bytes.
+# Without a buffer, it only measures the size of the block, returning read-only placeholder arrays that take no memory.
+class SharedMemoryAllocator(object):
+    def __init__(self, buffer=None):
+        self.__buffer = buffer
+        self.nbytes = 0
+
+    def __call__(self, shape, dtype=np.float64):
+        shape = tuple(np.atleast_1d(shape))
+        dtype = np.dtype(dtype)
+        offset = (self.nbytes + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+        self.nbytes = offset + (int(np.prod(shape, dtype=np.int64)) * dtype.itemsize)
+        if (self.__buffer is None):
+            return np.broadcast_to(np.zeros((), dtype=dtype), shape)
+        return np.ndarray(shape, dtype=dtype, buffer=self.__buffer, offset=offset)
+
+
+# A partition of a SharedReplayMemory.
+# In the actor, it is used like a ReplayMemory: start_episode, next_frame_view, add and mark_last_terminal.
+# The counters of the ReplayMemory are published to the shared block after every change, and loaded by the learner before it reads.
+class SharedReplayPartition(object):
+    def __init__(self, name, capacity, lock, frame_shape=(59, 255, 3), frame_dtype=np.uint8, state_length=4, create=False):
+        self.__spec = {'name': name, 'capacity': capacity, 'lock': lock, 'frame_shape': tuple(frame_shape),
+                       'frame_dtype': np.dtype(frame_dtype).str, 'state_length': state_length}
+        self.__lock = lock
+
+        allocator = SharedMemoryAllocator()
+        self.__layout(allocator)
+        self.__shared_memory = shared_memory.SharedMemory(name=name, create=create, size=allocator.nbytes if create else 0)
+        self.__memory, self.__counters = self.__layout(SharedMemoryAllocator(self.__shared_memory.buf))
+
+    def __layout(self, allocator):
+        spec = self.__spec
+        memory = ReplayMemory(spec['capacity'], spec['frame_shape'], spec['frame_dtype'], spec['state_length'], allocate=allocator)
+        counters = allocator(len(memory.counters), dtype=np.int64)
+        return memory, counters
+
+    # The arguments that attach another process to this partition
+    @property
+    def spec(self):
+        return dict(self.__spec)
+
+    @property
+    def capacity(self):
+        return self.__memory.capacity
+
+    @property
+    def fill_ratio(self):
+        with self.__lock:
+            self.__memory.load_counters(self.__counters)
+            return self.__memory.fill_ratio
+
+    def __len__(self):
+        with self.__lock:
+            self.__memory.load_counters(self.__counters)
+            return len(self.__memory)
+
+    def __publish_counters(self):
+        self.__counters[:] = self.__memory.counters
+
+    def start_episode(self, initial_frames):
+        with self.__lock:
+            self.__memory.start_episode(initial_frames)
+            self.__publish_counters()
+
+    # The slot is evicted before the view is returned, so the frame can be written without the lock
+    def next_frame_view(self):
+        with self.__lock:
+            view = self.__memory.next_frame_view()
+            self.__publish_counters()
+            return view
+
+    def add(self, post_frame, action, reward, predicted_reward, is_not_terminal=1, position=(0, 0), speed=0, has_collided=False):
+        with self.__lock:
+            self.__memory.add(post_frame, action, reward, predicted_reward, is_not_terminal, position, speed, has_collided)
+            self.__publish_counters()
+
+    def mark_last_terminal(self):
+        with self.__lock:
+            self.__memory.mark_last_terminal()
+
+    # Takes the lock of the partition for a read by the learner.
+    # Returns the number of transitions, and the surprise factor of each one if by_surprise is set.
+    # The lock is held until end_read, so the actor cannot shift the transitions between the draw of the indices and the read.
+    def begin_read(self, by_surprise):
+        self.__lock.acquire()
+        try:
+            self.__memory.load_counters(self.__counters)
+            surprise_factor = None
+            if by_surprise:
+                surprise_factor = np.abs(self.__memory.field('rewards').astype(np.float64) - self.__memory.field('predicted_rewards'))
+            return len(self.__memory), surprise_factor
+        except BaseException:
+            self.__lock.release()
+            raise
+
+    # Returns the transitions at the given logical indices, if any, and releases the lock taken by begin_read
+    def end_read(self, indices=None):
+        try:
+            if (indices is None):
+                return None
+            return self.__memory.get(indices)
+        finally:
+            self.__lock.release()
+
+    def close(self):
+        self.__memory = None
+        self.__counters = None
+        self.__shared_memory.close()
+
+    def unlink(self):
+        self.__shared_memory.unlink()
+
+
+# The replay memory of the learner, made of one partition per actor.
+# The partitions are created here, and each actor process attaches to its own with SharedReplayPartition(**partition_spec(i)).
+class SharedReplayMemory(object):
+    def __init__(self, num_partitions, partition_capacity, context, frame_shape=(59, 255, 3), frame_dtype=np.uint8, state_length=4, name_prefix=None):
+        name_prefix = name_prefix or 'atl_replay_{0}'.format(np.random.randint(1 << 30))
+        self.__partitions = []
+        try:
+            for i in range(0, num_partitions, 1):
+                self.__partitions.append(SharedReplayPartition('{0}_{1}'.format(name_prefix, i), partition_capacity, context.Lock(),
+                                                               frame_shape, frame_dtype, state_length, create=True))
+        except Exception:
+            self.close()
+            raise
+
+    def partition_spec(self, index):
+        return self.__partitions[index].spec
+
+    @property
+    def capacity(self):
+        return sum(partition.capacity for partition in self.__partitions)
+
+    # The partitions fill at the rate of their actors, the memory is full once all of them are
+    @property
+    def fill_ratio(self):
+        return min(partition.fill_ratio for partition in self.__partitions)
+
+    def __len__(self):
+        return sum(len(partition) for partition in self.__partitions)
+
+    # Samples num_batches minibatches of batch_size transitions across all of the partitions, like ReplayMemory.sample.
+    # Every partition stays locked from the read of its size until its transitions are copied out, as the agent holds its replay lock while sampling.
+    # The locks are always taken in the same order, and an actor only ever holds the lock of its own partition.
+    def sample(self, num_batches, batch_size, sample_randomly=True):
+        reading = []
+        try:
+            snapshots = []
+            for partition in self.__partitions:
+                snapshots.append(partition.begin_read(not sample_randomly))
+                reading.append(partition)
+            sizes = np.array([size for size, _ in snapshots], dtype=np.int64)
+            offsets = np.concatenate([[0], np.cumsum(sizes)])
+
+            probabilities = None
+            if not sample_randomly:
+                surprise_factor = np.concatenate([surprise for _, surprise in snapshots])
+                surprise_factor_normalizer = np.sum(surprise_factor)
+                # Sample uniformly until enough transitions have a surprise to fill a batch
+                if (np.count_nonzero(surprise_factor) >= batch_size):
+                    probabilities = surprise_factor / surprise_factor_normalizer
+
+            indices = sample_index_matrix(int(offsets[-1]), num_batches, batch_size, probabilities).ravel()
+            partition_indices = np.searchsorted(offsets, indices, side='right') - 1
+
+            experiences = {}
+            for p, partition in enumerate(self.__partitions):
+                positions = np.nonzero(partition_indices == p)[0]
+                reading.remove(partition)
+                if (positions.shape[0] == 0):
+                    partition.end_read()
+                    continue
+                partition_experiences = partition.end_read(indices[positions] - offsets[p])
+                for key, values in partition_experiences.items():
+                    if key not in experiences:
+                        experiences[key] = np.empty((indices.shape[0],) + values.shape[1:], dtype=values.dtype)
+                    experiences[key][positions] = values
+            return experiences
+        finally:
+            for partition in reading:
+                partition.end_read()
+
+    # Detaches from the shared memory and frees it. The actors must have stopped.
+    def close(self):
+        for partition in self.__partitions:
+            partition.close()
+            partition.unlink()
+        self.__partitions = []
+
+
+# The latest weights of the learner, in a shared memory block that the actors poll.
+# The block holds the version, the length of the packet, and the packet in the tensor_packet format.
+class SharedWeights(object):
+    HEADER_FORMAT = '<qq'
+
+    def __init__(self, name, nbytes, lock, create=False):
+        self.__spec = {'name': name, 'nbytes': nbytes, 'lock': lock}
+        self.__lock = lock
+        self.__header_size = struct.calcsize(self.HEADER_FORMAT)
+        self.__shared_memory = shared_memory.SharedMemory(name=name, create=create, size=self.__header_size + nbytes if create else 0)
+        self.__nbytes = int(nbytes)
+
+    @property
+    def spec(self):
+        return dict(self.__spec)
+
+    # Publishes a packet, such as RlModel.to_packet(get_target=False, as_lists=False) with the epsilon of the trainer
+    def publish(self, packet):
+        data = dumps_packet(packet)
+        if (len(data) > self.__nbytes):
+            raise ValueError('The packet takes {0} bytes, but only {1} were reserved'.format(len(data), self.__nbytes))
+        with self.__lock:
+            version, _ = struct.unpack_from(self.HEADER_FORMAT, self.__shared_memory.buf, 0)
+            self.__shared_memory.buf[self.__header_size:self.__header_size + len(data)] = data
+            struct.pack_into(self.HEADER_FORMAT, self.__shared_memory.buf, 0, version + 1, len(data))
+
+    # Returns the latest packet and its version, or None and the same version if nothing newer than version was published
+    def get_if_newer(self, version):
+        with self.__lock:
+            latest_version, length = struct.unpack_from(self.HEADER_FORMAT, self.__shared_memory.buf, 0)
+            if (latest_version == version):
+                return None, version
+            data = bytes(self.__shared_memory.buf[self.__header_size:self.__header_size + length])
+        return loads_packet(data), latest_version
+
+    def close(self):
+        self.__shared_memory.close()
+
+    def unlink(self):
+        self.__shared_memory.unlink()
@@ -0,0 +1,171 @@
+import json
+import os
+import struct
+import time
+
+import numpy as np
+
+
+# A binary container for packets that hold numpy arrays, such as the weights returned by RlModel.to_packet.
+# The layout is:
+#   8 bytes     MAGIC
+#   8 bytes     little-endian length of the header
+#   header      UTF-8 JSON with the structure of the packet and the name, dtype, shape and offset of every tensor
+#   tensors     the raw tensor buffers, each aligned to ALIGNMENT bytes from the start of the packet
+# Arrays in the packet are replaced by {"__tensor__": name} in the JSON structure, everything else is stored in the JSON as is.
+# Decoding wraps the buffers with np.frombuffer, so a packet read through np.memmap is loaded without copying any tensor.
+MAGIC = b'ATLPKT\x00\x01'
+ALIGNMENT = 64
+TENSOR_KEY = '__tensor__'
+
+_HEADER_LENGTH_FORMAT = '<Q'
+
+
+# Rounds an offset up to the next multiple of ALIGNMENT
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+# Replaces the arrays in a packet by tensor references, collecting the arrays in the tensors list
+def _flatten(value, name, tensors):
+    if isinstance(value, np.ndarray):
+        tensors.append((name, np.ascontiguousarray(value)))
+        return {TENSOR_KEY: name}
+    if isinstance(value, dict):
+        return {str(k): _flatten(v, '{0}/{1}'.format(name, k) if name else str(k), tensors) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_flatten(v, '{0}/{1}'.format(name, i), tensors) for i, v in enumerate(value)]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+# Replaces the tensor references in a decoded structure by the arrays they point to
+def _unflatten(value, tensors):
+    if isinstance(value, dict):
+        if (len(value) == 1 and TENSOR_KEY in value):
+            return tensors[value[TENSOR_KEY]]
+        return {k: _unflatten(v, tensors) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_unflatten(v, tensors) for v in value]
+    return value
+
+
+# Encodes a packet into a list of buffers that, concatenated, form the binary packet.
+# The tensors are not copied, so the buffers can be written out one after the other.
+def encode_packet(packet):
+    tensors = []
+    structure = _flatten(packet, '', tensors)
+
+    tensor_headers = []
+    offset = 0
+    for name, tensor in tensors:
+        offset = _align(offset)
+        tensor_headers.append({'name': name, 'dtype': tensor.dtype.str, 'shape': list(tensor.shape), 'offset': offset, 'nbytes': tensor.nbytes})
+        offset += tensor.nbytes
+
+    header = json.dumps({'structure': structure, 'tensors': tensor_headers}).encode('utf-8')
+    data_start = _align(len(MAGIC) + struct.calcsize(_HEADER_LENGTH_FORMAT) + len(header))
+    prefix = MAGIC + struct.pack(_HEADER_LENGTH_FORMAT, len(header)) + header
+
+    buffers = [prefix + (b'\x00' * (data_start - len(prefix)))]
+    position = 0
+    for tensor_header, (_, tensor) in zip(tensor_headers, tensors):
+        if (tensor_header['offset'] > position):
+            buffers.append(b'\x00' * (tensor_header['offset'] - position))
+        buffers.append(memoryview(tensor.reshape(-1)).cast('B'))
+        position = tensor_header['offset'] + tensor_header['nbytes']
+
+    return buffers
+
+
+# Encodes a packet into a single bytes object
+def dumps_packet(packet):
+    return b''.join(encode_packet(packet))
+
+
+# Returns true if the buffer starts with the magic bytes of a binary packet
+def is_packet(buffer):
+    return bytes(memoryview(buffer)[0:len(MAGIC)]) == MAGIC
+
+
+# Decodes a binary packet. The returned arrays are read-only views into the buffer.
+def loads_packet(buffer):
+    if not is_packet(buffer):
+        raise ValueError('Not a binary tensor packet')
+
+    header_length_start = len(MAGIC)
+    header_start = header_length_start + struct.calcsize(_HEADER_LENGTH_FORMAT)
+    header_length = struct.unpack(_HEADER_LENGTH_FORMAT, bytes(memoryview(buffer)[header_length_start:header_start]))[0]
+    header = json.loads(bytes(memoryview(buffer)[header_start:header_start + header_length]).decode('utf-8'))
+    data_start = _align(header_start + header_length)
+
+    tensors = {}
+    for tensor_header in header['tensors']:
+        dtype = np.dtype(tensor_header['dtype'])
+        shape = tuple(tensor_header['shape'])
+        count = int(np.prod(shape, dtype=np.int64))
+        tensor = np.frombuffer(buffer, dtype=dtype, count=count, offset=data_start + tensor_header['offset'])
+        tensors[tensor_header['name']] = tensor.reshape(shape)
+
+    return _unflatten(header['structure'], tensors)
+
+
+# Writes a checkpoint to disk in the binary packet format.
+# The file is written next to its destination and then renamed, so a crash never leaves a truncated checkpoint behind.
+def save_checkpoint(path, checkpoint):
+    temp_path = '{0}.tmp'.format(path)
+    with open(temp_path, 'wb') as f:
+        for buffer in encode_packet(checkpoint):
+            f.write(buffer)
+    os.replace(temp_path, path)
+
+
+# Writes the checkpoints of a training run as <batch_count>.ckpt files in a directory.
+# A checkpoint is due once interval_sec seconds have passed since the previous one, so callers check is_due() before building it.
+# If keep_last is given, only the keep_last newest checkpoints written by this writer are kept on disk.
+class CheckpointWriter(object):
+    def __init__(self, directory, interval_sec=0, keep_last=None):
+        if (keep_last is not None and int(keep_last) < 1):
+            raise ValueError('keep_last must be at least 1, got {0}'.format(keep_last))
+        self.__directory = directory
+        self.__interval_sec = float(interval_sec)
+        self.__keep_last = int(keep_last) if keep_last is not None else None
+        self.__last_save_time = None
+        self.__paths = []
+
+    def is_due(self):
+        return (self.__last_save_time is None or time.time() - self.__last_save_time >= self.__interval_sec)
+
+    def save(self, batch_count, checkpoint):
+        if not os.path.isdir(self.__directory):
+            os.makedirs(self.__directory)
+
+        path = os.path.join(self.__directory, '{0}.ckpt'.format(batch_count))
+        print('Checkpointing to {0}'.format(path))
+        save_checkpoint(path, checkpoint)
+        self.__last_save_time = time.time()
+
+        if path in self.__paths:
+            self.__paths.remove(path)
+        self.__paths.append(path)
+        if (self.__keep_last is not None):
+            while (len(self.__paths) > self.__keep_last):
+                old_path = self.__paths.pop(0)
+                if os.path.exists(old_path):
+                    os.remove(old_path)
+        return path
+
+
+# Reads a checkpoint from disk.
+# Binary checkpoints are memory-mapped, so the tensors are only paged in when they are used.
+# Legacy checkpoints, which are JSON files with the weights as nested lists, are still supported.
+def load_checkpoint(path):
+    with open(path, 'rb') as f:
+        magic = f.read(len(MAGIC))
+
+    if (magic == MAGIC):
+        return loads_packet(np.memmap(path, dtype=np.uint8, mode='r'))
+
+    with open(path, 'r') as f:
+        return json.loads(f.read())
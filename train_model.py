@@ -1,31 +1,95 @@
 import time
 import math
 import numpy as np
-import json
 import os
 import sys
-import requests
-import copy
 import datetime
+import multiprocessing
+import threading
 
-from airsim_client import msgpackrpc, CarClient, CarControls, Pose, Vector3r, ImageRequest, AirSimImageType, AirSimClientBase
+from airsim_client import msgpackrpc, CarClient, CarControls, AirSimClientBase
+from episode_reset import EpisodeReset
+from frame_capture import FrameCapture
 from rl_model import RlModel
+from replay_memory import ReplayMemory
+from prioritized_replay import PrioritizedReplayMemory
+from shared_replay import SharedReplayMemory, SharedReplayPartition, SharedWeights
+from reward_function import RewardFunction
+from road_map import load_road_segments, to_car_coordinates
+from gradient_compression import GradientCompressor
+from tensor_packet import CheckpointWriter, dumps_packet
+from wire_protocol import fetch_latest_model, post_packet
+
+
+# The part of the scene that the model looks at
+IMAGE_REGION = np.s_[76:135, 0:255, 0:3]
+FRAME_SHAPE = (59, 255, 3)
+
+# The time between sending the controls of an action and observing its outcome
+CONTROL_PERIOD_SEC = 0.01
+
+# An episode ends when the car is slower than this, so the warm-up of the next one lasts until the car is at least this fast
+MIN_EPISODE_SPEED = 2
+
+# The longest times that a reset waits for the car to stop, and for the initial state to be captured while the car starts rolling
+RESET_STOP_TIMEOUT_SEC = 4
+WARMUP_TIMEOUT_SEC = 5
+
+# The room left in the shared weights block for the packet to grow, such as the epsilon of the trainer
+SHARED_WEIGHTS_SLACK_BYTES = 1 << 16
+
+
+# The entry point of the actor processes started by the learner in multi-actor mode
+def run_actor(agent_kwargs):
+    DistributedAgent(**agent_kwargs).start()
 
 
 # A class that represents the agent that will drive the vehicle, train the model, and send the gradient updates to the trainer.
 class DistributedAgent(object):
     def __init__(self, batch_update_frequency, max_epoch_runtime_sec, per_iter_epsilon_reduction, min_epsilon, batch_size
-                             , replay_memory_size, weights_path, train_conv_layers, airsim_path, experiment_name):
+                             , replay_memory_size, weights_path, train_conv_layers, airsim_path, experiment_name, replay_memory_bytes=None, prioritized_replay=False,
+                             trainer_address=None, gradient_top_k_ratio=None, gradient_quantization_bits=None,
+                             actor_learner=False, learner_batches_per_iteration=10, publish_every_batches=50, learner_checkpoint_interval_sec=300,
+                             airsim_address=None, actor_airsim_addresses=None, shared_replay_partition=None, shared_weights=None,
+                             car_client_factory=CarClient):
 
 
         print('Starting time: {0}'.format(datetime.datetime.utcnow()), file=sys.stderr)
         self.__model_buffer = None
         self.__model = None
+
+        # In actor-learner mode, the actor drives with its own copy of the model while the learner trains self.__model on another thread.
+        # The learner publishes its weights to the actor every publish_every_batches batches.
+        # Otherwise, both are the same model and the agent alternates between driving and training.
+        self.__actor_learner = actor_learner
+        self.__actor_model = None
+        self.__learner_batches_per_iteration = int(learner_batches_per_iteration)
+        self.__publish_every_batches = int(publish_every_batches)
+        self.__published_lock = threading.Lock()
+        self.__published_packet = None
+        self.__published_version = 0
+        self.__actor_version = 0
+        self.__last_publish_batch_count = 0
+        self.__learner_error = None
+
+        # The learner of the actor-learner and multi-actor modes trains without pause, so it checkpoints at most every learner_checkpoint_interval_sec.
+        # Otherwise, the agent checkpoints with every update of the critic, which happens at most once per epoch.
+        checkpoint_interval_sec = learner_checkpoint_interval_sec if (actor_learner or actor_airsim_addresses is not None) else 0
+        self.__checkpoint_writer = CheckpointWriter(os.path.join('checkpoint', experiment_name), checkpoint_interval_sec)
+
+        # In multi-actor mode, this agent is the learner, and it starts one actor process per simulator in actor_airsim_addresses.
+        # The actors write to their partition of a shared replay memory, and load the weights that the learner publishes in shared_weights.
+        # The actor processes are agents created with their shared_replay_partition and shared_weights specs.
+        self.__actor_airsim_addresses = actor_airsim_addresses
+        self.__shared_replay_partition = shared_replay_partition
+        self.__shared_weights = SharedWeights(**shared_weights) if shared_weights is not None else None
         self.__airsim_started = False
         self.__per_iter_epsilon_reduction = float(per_iter_epsilon_reduction)
         self.__min_epsilon = float(min_epsilon)
         self.__max_epoch_runtime_sec = float(max_epoch_runtime_sec)
         self.__replay_memory_size = int(replay_memory_size)
+        self.__replay_memory_bytes = replay_memory_bytes
+        self.__prioritized_replay = prioritized_replay
         self.__batch_size = int(batch_size)
         self.__experiment_name = experiment_name
         self.__train_conv_layers = train_conv_layers
@@ -43,8 +107,16 @@ class DistributedAgent(object):
 
         self.__airsim_path = airsim_path
 
+        # The host:port of the simulator, by default AirSim on this machine
+        self.__airsim_address = airsim_address
+
+        # Creates the clients of the simulator from its host and port, benchmark.py passes one that times the steps
+        self.__car_client_factory = car_client_factory
+
         self.__car_client = None
         self.__car_controls = None
+        self.__frame_capture = None
+        self.__episode_reset = None
 
         self.__minibatch_dir = os.path.join('minibatches')
         self.__output_model_dir = os.path.join('models')
@@ -54,9 +126,33 @@ class DistributedAgent(object):
         self.__last_model_file = ''
 
         self.__possible_ip_addresses = []
-        self.__trainer_ip_address = None
+        # The host:port of the parameter server started by trainer.py. Without it, the agent trains on its own.
+        self.__trainer_address = trainer_address
+        self.__model_version = None
+
+        # The updates sent to the trainer can be sparsified and quantized, see GradientCompressor
+        self.__gradient_compressor = GradientCompressor(gradient_top_k_ratio, gradient_quantization_bits)
+
+        # The replay memory is preallocated, so its size can be given either in experiences or in bytes.
+        # The actor and the learner share it, all of the calls that read or modify it hold the replay lock.
+        self.__replay_lock = threading.Lock()
+        replay_memory_class = PrioritizedReplayMemory if self.__prioritized_replay else ReplayMemory
+        if (self.__actor_airsim_addresses is not None):
+            # Created once the actors are started
+            if self.__prioritized_replay:
+                print('Priorities are not shared between processes, the shared replay memory is sampled uniformly')
+                self.__prioritized_replay = False
+            self.__experiences = None
+        elif (self.__shared_replay_partition is not None):
+            self.__experiences = SharedReplayPartition(**self.__shared_replay_partition)
+        elif (self.__replay_memory_bytes is not None):
+            self.__experiences = replay_memory_class(frame_dtype=np.uint8, capacity_bytes=self.__replay_memory_bytes)
+        else:
+            self.__experiences = replay_memory_class(self.__replay_memory_size, frame_dtype=np.uint8)
 
-        self.__experiences = {}
+        # The initial state of an episode, before it is stored in the replay memory.
+        # Frames are kept as uint8, they are only converted to float when a batch is fed to the model.
+        self.__warmup_frames = np.zeros((4,) + FRAME_SHAPE, dtype=np.uint8)
 
         self.__init_road_points()
         self.__init_reward_points()
@@ -65,11 +161,43 @@ class DistributedAgent(object):
     def start(self):
         self.__run_function()
 
+    # Drives a single episode without training, and returns the number of actions taken.
+    # Used by benchmark.py to time the control loop against a simulator.
+    def run_episode(self, always_random=False):
+        if (self.__model is None):
+            self.__model = RlModel(self.__weights_path, self.__train_conv_layers)
+            self.__actor_model = self.__model
+        if (self.__car_client is None):
+            self.__connect_to_airsim()
+        _, num_actions = self.__run_airsim_epoch(always_random)
+        return num_actions
+
+    # The statistics of the episode resets and of the frame capture, since the agent connected to AirSim
+    def get_episode_stats(self):
+        stats = {}
+        stats['reset'] = self.__episode_reset.get_stats()
+        stats['frame_capture'] = self.__frame_capture.get_stats()
+        return stats
+
     # The function that will be run during training.
     # It will initialize the connection to the trainer, start AirSim, and continuously run training iterations.
     def __run_function(self):
 
         self.__model = RlModel(self.__weights_path, self.__train_conv_layers)
+        self.__actor_model = self.__model
+
+        # An actor process only drives, with the weights published by the learner
+        if (self.__shared_replay_partition is not None):
+            self.__run_actor_process()
+            return
+
+        # In distributed mode, start from the trainer's copy of the model
+        if (self.__trainer_address is not None):
+            self.__get_latest_model()
+
+        if (self.__actor_airsim_addresses is not None):
+            self.__run_multi_actor_learner()
+            return
 
         # Connect to the AirSim exe
         self.__connect_to_airsim()
@@ -79,8 +207,8 @@ class DistributedAgent(object):
             print('Running Airsim Epoch.')
             try:
                 self.__run_airsim_epoch(True)
-                percent_full = 100.0 * len(self.__experiences['actions'])/self.__replay_memory_size
-                print('Replay memory now contains {0} members. ({1}% full)'.format(len(self.__experiences['actions']), percent_full))
+                percent_full = 100.0 * self.__experiences.fill_ratio
+                print('Replay memory now contains {0} members. ({1}% full)'.format(len(self.__experiences), percent_full))
 
                 if (percent_full >= 100.0):
                     break
@@ -88,6 +216,10 @@ class DistributedAgent(object):
                 print('Lost connection to AirSim while fillling replay memory. Attempting to reconnect.')
                 self.__connect_to_airsim()
 
+        if self.__actor_learner:
+            self.__run_actor_learner()
+            return
+
         while True:
             try:
                 if (self.__model is not None):
@@ -102,24 +234,180 @@ class DistributedAgent(object):
 
                         print('Sampling Experiences.')
                         # Sample experiences from the replay memory
-                        sampled_experiences = self.__sample_experiences(experiences, frame_count, True)
+                        sampled_experiences = self.__sample_experiences(experiences, frame_count, not self.__prioritized_replay)
 
                         self.__num_batches_run += frame_count
                         
                         # If we successfully sampled, train on the collected minibatches and send the gradients to the trainer node
                         if (len(sampled_experiences) > 0):
+                            print('Training on sampled experiences.')
+                            gradients = self.__train_on_experiences(sampled_experiences)
+
                             print('Publishing AirSim Epoch.')
-                            self.__publish_batch_and_update_model(frame_count)
+                            self.__publish_batch_and_update_model(frame_count, gradients)
 
             except msgpackrpc.error.TimeoutError:
                 print('Lost connection to AirSim. Attempting to reconnect.')
                 self.__connect_to_airsim()
 
+    # Drives and trains at the same time.
+    # The learner thread keeps sampling the replay memory and training, while this thread keeps driving and adding to it.
+    def __run_actor_learner(self):
+        self.__actor_model = RlModel(self.__weights_path, self.__train_conv_layers)
+        self.__actor_model.from_packet(self.__model.to_packet(get_target=False, as_lists=False))
+
+        # Keras builds the prediction and training functions on their first use.
+        # Use both models once on this thread, so that the threads never add to the graph at the same time.
+        self.__actor_model.predict_state(self.__warmup_frames)
+        self.__run_learner_iteration()
+
+        learner = threading.Thread(target=self.__run_learner, name='Learner')
+        learner.daemon = True
+        learner.start()
+
+        while True:
+            if (self.__learner_error is not None):
+                raise self.__learner_error
+            try:
+                print('Running Airsim Epoch.')
+                self.__run_airsim_epoch(False)
+            except msgpackrpc.error.TimeoutError:
+                print('Lost connection to AirSim. Attempting to reconnect.')
+                self.__connect_to_airsim()
+
+    # Starts one actor process per simulator, then trains on the experiences they collect.
+    # The processes are spawned rather than forked, so that each one starts its own TensorFlow session.
+    def __run_multi_actor_learner(self):
+        context = multiprocessing.get_context('spawn')
+        num_actors = len(self.__actor_airsim_addresses)
+        self.__experiences = SharedReplayMemory(num_actors, max(1, self.__replay_memory_size // num_actors), context, FRAME_SHAPE, np.uint8)
+
+        packet = self.__model.to_packet(get_target=False, as_lists=False)
+        self.__shared_weights = SharedWeights('{0}_weights_{1}'.format(self.__experiment_name, os.getpid()), len(dumps_packet(packet)) + SHARED_WEIGHTS_SLACK_BYTES,
+                                              context.Lock(), create=True)
+        self.__shared_weights.publish(packet)
+
+        processes = []
+        try:
+            for i, address in enumerate(self.__actor_airsim_addresses):
+                agent_kwargs = {}
+                agent_kwargs['batch_update_frequency'] = self.__batch_update_frequency
+                agent_kwargs['max_epoch_runtime_sec'] = self.__max_epoch_runtime_sec
+                agent_kwargs['per_iter_epsilon_reduction'] = self.__per_iter_epsilon_reduction
+                agent_kwargs['min_epsilon'] = self.__min_epsilon
+                agent_kwargs['batch_size'] = self.__batch_size
+                agent_kwargs['replay_memory_size'] = self.__replay_memory_size
+                agent_kwargs['weights_path'] = self.__weights_path
+                agent_kwargs['train_conv_layers'] = self.__train_conv_layers
+                agent_kwargs['airsim_path'] = self.__airsim_path
+                agent_kwargs['experiment_name'] = '{0}_actor{1}'.format(self.__experiment_name, i)
+                agent_kwargs['airsim_address'] = address
+                agent_kwargs['shared_replay_partition'] = self.__experiences.partition_spec(i)
+                agent_kwargs['shared_weights'] = self.__shared_weights.spec
+
+                process = context.Process(target=run_actor, args=(agent_kwargs,), name='Actor{0}'.format(i))
+                process.daemon = True
+                process.start()
+                processes.append(process)
+
+            # Like the single agent, start training once the replay memory has been filled
+            while (self.__experiences.fill_ratio < 1.0):
+                if not all(process.is_alive() for process in processes):
+                    raise RuntimeError('An actor process exited while filling the replay memory')
+                print('Replay memory now contains {0} members. ({1}% full)'.format(len(self.__experiences), 100.0 * self.__experiences.fill_ratio))
+                time.sleep(10)
+
+            while True:
+                if not all(process.is_alive() for process in processes):
+                    raise RuntimeError('An actor process exited')
+                self.__run_learner_iteration()
+        finally:
+            for process in processes:
+                process.terminate()
+                process.join()
+            self.__experiences.close()
+            self.__shared_weights.close()
+            self.__shared_weights.unlink()
+
+    # Drives episodes into the partition of the shared replay memory, randomly until the partition is full
+    def __run_actor_process(self):
+        self.__connect_to_airsim()
+        always_random = True
+        while True:
+            try:
+                self.__run_airsim_epoch(always_random)
+                always_random = always_random and (self.__experiences.fill_ratio < 1.0)
+            except msgpackrpc.error.TimeoutError:
+                print('Lost connection to AirSim. Attempting to reconnect.')
+                self.__connect_to_airsim()
+
+    def __run_learner(self):
+        try:
+            while True:
+                self.__run_learner_iteration()
+        except Exception as e:
+            # The actor raises the error at the start of its next epoch
+            self.__learner_error = e
+            raise
+
+    # Trains on learner_batches_per_iteration minibatches and sends the update to the trainer, or updates the critic.
+    # The learner publishes its weights to the actor every publish_every_batches batches.
+    def __run_learner_iteration(self):
+        num_batches = self.__learner_batches_per_iteration
+        with self.__replay_lock:
+            sampled_experiences = self.__sample_experiences(self.__experiences, num_batches, not self.__prioritized_replay)
+
+        # The priorities are updated after training, by which time the actor may have overwritten some of the sampled transitions.
+        # Those transitions then get the priority of the old ones, which is soon corrected when they are sampled.
+        gradients = self.__train_on_experiences(sampled_experiences)
+        self.__num_batches_run += num_batches
+        self.__publish_batch_and_update_model(num_batches, gradients)
+
+        if (self.__num_batches_run >= self.__last_publish_batch_count + self.__publish_every_batches):
+            packet = self.__model.to_packet(get_target=False, as_lists=False)
+            if (self.__shared_weights is not None):
+                # The actor processes follow the epsilon of the trainer, otherwise they anneal their own
+                if (self.__trainer_address is not None):
+                    packet['epsilon'] = self.__epsilon
+                self.__shared_weights.publish(packet)
+            else:
+                with self.__published_lock:
+                    self.__published_packet = packet
+                    self.__published_version += 1
+            self.__last_publish_batch_count = self.__num_batches_run
+
+    # Loads the weights last published by the learner into the model of the actor, if it does not have them yet
+    def __refresh_actor_model(self):
+        if (self.__shared_weights is not None):
+            packet, version = self.__shared_weights.get_if_newer(self.__actor_version)
+            if (packet is not None):
+                self.__actor_model.from_packet(packet)
+                self.__actor_version = version
+                if ('epsilon' in packet):
+                    self.__epsilon = packet['epsilon']
+            return
+        if (self.__actor_model is self.__model):
+            return
+        with self.__published_lock:
+            packet = self.__published_packet
+            version = self.__published_version
+        if (version != self.__actor_version):
+            self.__actor_model.from_packet(packet)
+            self.__actor_version = version
+
     def __connect_to_airsim(self):
-        self.__car_client = CarClient()
+        host, port = self.__airsim_address.rsplit(':', 1) if self.__airsim_address is not None else ('', 42451)
+        self.__car_client = self.__car_client_factory(host, int(port))
         self.__car_client.confirmConnection()
         self.__car_client.enableApiControl(True)
         self.__car_controls = CarControls()
+
+        # The frames of the initial state are captured in the background, on a connection of their own
+        if (self.__frame_capture is not None):
+            self.__frame_capture.close()
+        self.__frame_capture = FrameCapture(lambda: self.__car_client_factory(host, int(port)), IMAGE_REGION, FRAME_SHAPE)
+        self.__episode_reset = EpisodeReset(self.__car_client, self.__car_controls, self.__frame_capture, min_start_speed=MIN_EPISODE_SPEED,
+                                            stop_timeout_sec=RESET_STOP_TIMEOUT_SEC, warmup_timeout_sec=WARMUP_TIMEOUT_SEC)
         print('Connected!')
 
     # Appends a sample to a ring buffer.
@@ -139,48 +427,26 @@ class DistributedAgent(object):
         starting_points, starting_direction = self.__get_next_starting_point()
         
         # Initialize the state buffer.
-        # For now, save 4 images at 0.01 second intervals.
         state_buffer_len = 4
-        state_buffer = []
-        wait_delta_sec = 0.01
-
-        print('Getting Pose')
-        self.__car_client.simSetPose(Pose(Vector3r(starting_points[0], starting_points[1], starting_points[2]), AirSimClientBase.toQuaternion(starting_direction[0], starting_direction[1], starting_direction[2])), True)
-
-        # Currently, simSetPose does not allow us to set the velocity. 
-        # So, if we crash and call simSetPose, the car will be still moving at its previous velocity.
-        # We need the car to stop moving, so push the brake and wait for a few seconds.
-        print('Waiting for momentum to die')
-        self.__car_controls.steering = 0
-        self.__car_controls.throttle = 0
-        self.__car_controls.brake = 1
-        self.__car_client.setCarControls(self.__car_controls)
-        time.sleep(4)
-        
+
+        # Stop the car at the starting point and start it rolling, polling the simulator rather than sleeping.
+        # The state buffer is initialized with the latest frames captured while the car was rolling.
         print('Resetting')
-        self.__car_client.simSetPose(Pose(Vector3r(starting_points[0], starting_points[1], starting_points[2]), AirSimClientBase.toQuaternion(starting_direction[0], starting_direction[1], starting_direction[2])), True)
-
-        #Start the car rolling so it doesn't get stuck
-        print('Running car for a few seconds...')
-        self.__car_controls.steering = 0
-        self.__car_controls.throttle = 1
-        self.__car_controls.brake = 0
-        self.__car_client.setCarControls(self.__car_controls)
-        
-        # While the car is rolling, start initializing the state buffer
-        stop_run_time =datetime.datetime.now() + datetime.timedelta(seconds=2)
-        while(datetime.datetime.now() < stop_run_time):
-            time.sleep(wait_delta_sec)
-            state_buffer = self.__append_to_ring_buffer(self.__get_image(), state_buffer, state_buffer_len)
+        state_frames = self.__episode_reset.reset(starting_points, starting_direction, state_buffer_len, self.__warmup_frames)
+        state_buffer = list(state_frames)
+        print('Reset: {0}'.format(self.__episode_reset.get_stats()))
+        print('Frame capture: {0}'.format(self.__frame_capture.get_stats()))
         done = False
 
-        # records the state we go to
-        actions = []
-        pre_states = []
-        post_states = []
-        rewards = []
-        predicted_rewards = []
-        car_state = self.__car_client.getCarState()
+        # The replay memory stores each frame once, starting with the frames of the initial state.
+        with self.__replay_lock:
+            self.__experiences.start_episode(state_buffer)
+
+        # records the number of actions taken during this run
+        num_actions = 0
+        observation = self.__car_client.observe()
+        car_state = observation.car_state
+        collision_info = observation.collision_info
 
         start_time = datetime.datetime.utcnow()
         end_time = start_time + datetime.timedelta(seconds=self.__max_epoch_runtime_sec)
@@ -190,7 +456,6 @@ class DistributedAgent(object):
         
         # Main data collection loop
         while not done:
-            collision_info = self.__car_client.getCollisionInfo()
             utc_now = datetime.datetime.utcnow()
             
             # Check for terminal conditions:
@@ -199,7 +464,7 @@ class DistributedAgent(object):
             # 3) The run has been running for longer than max_epoch_runtime_sec. 
             #       This constraint is so the model doesn't end up having to churn through huge chunks of data, slowing down training
             # 4) The car has run off the road
-            if (collision_info.has_collided or car_state.speed < 2 or utc_now > end_time or far_off):
+            if (collision_info.has_collided or car_state.speed < MIN_EPISODE_SPEED or utc_now > end_time or far_off):
                 print('Start time: {0}, end time: {1}'.format(start_time, utc_now), file=sys.stderr)
                 if (utc_now > end_time):
                     print('timed out.')
@@ -210,55 +475,53 @@ class DistributedAgent(object):
 
                 # The Agent should occasionally pick random action instead of best action
                 do_greedy = np.random.random_sample()
-                pre_state = copy.deepcopy(state_buffer)
+                # Frames are never modified once captured, so the state only needs a shallow copy
+                pre_state = list(state_buffer)
                 if (do_greedy < self.__epsilon or always_random):
                     num_random += 1
-                    next_state = self.__model.get_random_state()
+                    next_state = self.__actor_model.get_random_state()
                     predicted_reward = 0
                     
                 else:
-                    next_state, predicted_reward = self.__model.predict_state(pre_state)
+                    self.__refresh_actor_model()
+                    next_state, predicted_reward = self.__actor_model.predict_state(pre_state)
                     print('Model predicts {0}'.format(next_state))
 
-                # Convert the selected state to a control signal
-                next_control_signals = self.__model.state_to_control_signals(next_state, self.__car_client.getCarState())
+                # Convert the selected state to a control signal, based on the last observed car state
+                next_control_signals = self.__actor_model.state_to_control_signals(next_state, car_state)
 
-                # Take the action
+                # Take the action, wait for a short period of time and observe the outcome.
+                # The step is pipelined, so the controls, image, car state and collision info cost a single round trip.
                 self.__car_controls.steering = next_control_signals[0]
                 self.__car_controls.throttle = next_control_signals[1]
                 self.__car_controls.brake = next_control_signals[2]
-                self.__car_client.setCarControls(self.__car_controls)
-                
-                # Wait for a short period of time to see outcome
-                time.sleep(wait_delta_sec)
-
-                # Observe outcome and compute reward from action
-                state_buffer = self.__append_to_ring_buffer(self.__get_image(), state_buffer, state_buffer_len)
-                car_state = self.__car_client.getCarState()
-                collision_info = self.__car_client.getCollisionInfo()
-                reward, far_off = self.__compute_reward(collision_info, car_state)
+                observation = self.__car_client.step(self.__car_controls, CONTROL_PERIOD_SEC)
+
+                # Compute reward from action
+                # The frame is cropped straight into the replay memory slot that it will be stored in.
+                # The transitions that referenced the slot are evicted first, so the learner never reads it while it is written.
+                with self.__replay_lock:
+                    frame = self.__experiences.next_frame_view()
+                image = AirSimClientBase.copyImageRegion(observation.images[0], frame, IMAGE_REGION)
+                state_buffer = self.__append_to_ring_buffer(image, state_buffer, state_buffer_len)
+                car_state = observation.car_state
+                collision_info = observation.collision_info
+                car_position = self.__get_car_position(car_state)
+                reward, far_off = self.__compute_reward(collision_info, car_state, car_position)
                 
-                # Add the experience to the set of examples from this iteration
-                pre_states.append(pre_state)
-                post_states.append(state_buffer)
-                rewards.append(reward)
-                predicted_rewards.append(predicted_reward)
-                actions.append(next_state)
+                # Add the experience to the replay memory
+                with self.__replay_lock:
+                    self.__experiences.add(image, next_state, reward, predicted_reward,
+                                           position=car_position, speed=car_state.speed, has_collided=collision_info.has_collided)
+                num_actions += 1
 
         # Only the last state is a terminal state.
-        is_not_terminal = [1 for i in range(0, len(actions)-1, 1)]
-        is_not_terminal.append(0)
-        
-        # Add all of the states from this iteration to the replay memory
-        self.__add_to_replay_memory('pre_states', pre_states)
-        self.__add_to_replay_memory('post_states', post_states)
-        self.__add_to_replay_memory('actions', actions)
-        self.__add_to_replay_memory('rewards', rewards)
-        self.__add_to_replay_memory('predicted_rewards', predicted_rewards)
-        self.__add_to_replay_memory('is_not_terminal', is_not_terminal)
-
-        print('Percent random actions: {0}'.format(num_random / max(1, len(actions))))
-        print('Num total actions: {0}'.format(len(actions)))
+        if (num_actions > 0):
+            with self.__replay_lock:
+                self.__experiences.mark_last_terminal()
+
+        print('Percent random actions: {0}'.format(num_random / max(1, num_actions)))
+        print('Num total actions: {0}'.format(num_actions))
         
         # If we are in the main loop, reduce the epsilon parameter so that the model will be called more often
         # Note: this will be overwritten by the trainer's epsilon if running in distributed mode
@@ -266,160 +529,88 @@ class DistributedAgent(object):
             self.__epsilon -= self.__per_iter_epsilon_reduction
             self.__epsilon = max(self.__epsilon, self.__min_epsilon)
         
-        return self.__experiences, len(actions)
-
-    # Adds a set of examples to the replay memory
-    def __add_to_replay_memory(self, field_name, data):
-        if field_name not in self.__experiences:
-            self.__experiences[field_name] = data
-        else:
-            self.__experiences[field_name] += data
-            start_index = max(0, len(self.__experiences[field_name]) - self.__replay_memory_size)
-            self.__experiences[field_name] = self.__experiences[field_name][start_index:]
+        return self.__experiences, num_actions
 
     # Sample experiences from the replay memory
+    # One minibatch is generated for each frame of the run, all of them are drawn in a single vectorized call.
     def __sample_experiences(self, experiences, frame_count, sample_randomly):
-        sampled_experiences = {}
-        sampled_experiences['pre_states'] = []
-        sampled_experiences['post_states'] = []
-        sampled_experiences['actions'] = []
-        sampled_experiences['rewards'] = []
-        sampled_experiences['predicted_rewards'] = []
-        sampled_experiences['is_not_terminal'] = []
-
-        # Compute the surprise factor, which is the difference between the predicted an the actual Q value for each state.
-        # We can use that to weight examples so that we are more likely to train on examples that the model got wrong.
-        suprise_factor = np.abs(np.array(experiences['rewards'], dtype=np.dtype(float)) - np.array(experiences['predicted_rewards'], dtype=np.dtype(float)))
-        suprise_factor_normalizer = np.sum(suprise_factor)
-        suprise_factor /= float(suprise_factor_normalizer)
-
-        # Generate one minibatch for each frame of the run
-        for _ in range(0, frame_count, 1):
-            if sample_randomly:
-                idx_set = set(np.random.choice(list(range(0, suprise_factor.shape[0], 1)), size=(self.__batch_size), replace=False))
-            else:
-                idx_set = set(np.random.choice(list(range(0, suprise_factor.shape[0], 1)), size=(self.__batch_size), replace=False, p=suprise_factor))
-        
-            sampled_experiences['pre_states'] += [experiences['pre_states'][i] for i in idx_set]
-            sampled_experiences['post_states'] += [experiences['post_states'][i] for i in idx_set]
-            sampled_experiences['actions'] += [experiences['actions'][i] for i in idx_set]
-            sampled_experiences['rewards'] += [experiences['rewards'][i] for i in idx_set]
-            sampled_experiences['predicted_rewards'] += [experiences['predicted_rewards'][i] for i in idx_set]
-            sampled_experiences['is_not_terminal'] += [experiences['is_not_terminal'][i] for i in idx_set]
-            
-        return sampled_experiences
-        
-     
+        return experiences.sample(frame_count, self.__batch_size, sample_randomly)
+
+    # Trains the model on the sampled minibatches.
+    # With prioritized replay, the TD errors of the sampled experiences become their new priorities.
+    def __train_on_experiences(self, sampled_experiences):
+        gradients, td_errors = self.__model.get_gradient_update_from_batches(sampled_experiences, return_td_errors=True, as_lists=False)
+        if self.__prioritized_replay:
+            with self.__replay_lock:
+                self.__experiences.update_priorities(sampled_experiences['indices'], td_errors)
+        return gradients
+
     # Train the model on minibatches and post to the trainer node.
     # The trainer node will respond with the latest version of the model that will be used in further data generation iterations.
-    def __publish_batch_and_update_model(self, batches_count):
-        # Train and get the gradients
+    # Without a trainer node, the agent updates its own critic and writes the checkpoints.
+    def __publish_batch_and_update_model(self, batches_count, gradients):
+        if (self.__trainer_address is not None):
+            update = {}
+            update['gradients'] = self.__gradient_compressor.compress(gradients)
+            update['model_version'] = self.__model_version
+            update['batch_count'] = batches_count
+            response = post_packet(self.__trainer_address, 'gradient_update', update)
+            # The local model was already moved by training. If the trainer dropped the update, its layers may not have changed since
+            # the version the agent has, so download the whole model rather than a delta.
+            if not response['accepted']:
+                print('The trainer dropped the update, it was {0} versions old'.format(response['staleness']))
+                self.__model_version = None
+
+            # The trainer anneals epsilon for all of the agents
+            self.__epsilon = response['epsilon']
+            self.__get_latest_model()
+            return
 
         if (self.__num_batches_run > self.__batch_update_frequency + self.__last_checkpoint_batch_count):
             self.__model.update_critic()
 
-            checkpoint = {}
-            checkpoint['model'] = self.__model.to_packet(get_target=True)
-            checkpoint['batch_count'] = batches_count
-            checkpoint_str = json.dumps(checkpoint)
-
-            checkpoint_dir = os.path.join('checkpoint', self.__experiment_name)
-
-            if not os.path.isdir(checkpoint_dir):
-                os.makedirs(checkpoint_dir)
-
-            file_name = os.path.join(checkpoint_dir,'{0}.json'.format(self.__num_batches_run))
-            with open(file_name, 'w') as f:
-                print('Checkpointing to {0}'.format(file_name))
-                f.write(checkpoint_str)
+            # Checkpoints are written as raw float32 buffers, which can be memory-mapped when they are loaded
+            if self.__checkpoint_writer.is_due():
+                checkpoint = {}
+                checkpoint['model'] = self.__model.to_packet(get_target=True, as_lists=False)
+                checkpoint['batch_count'] = batches_count
+                self.__checkpoint_writer.save(self.__num_batches_run, checkpoint)
 
             self.__last_checkpoint_batch_count = self.__num_batches_run
                 
     # Gets the latest model from the trainer node
+    # The model is transferred in the binary packet format if the trainer supports it, and as JSON otherwise.
+    # Once the agent has a model, only the layers that changed since its version are downloaded.
     def __get_latest_model(self):
         print('Getting latest model from parameter server...')
-        response = requests.get('http://{0}:80/latest'.format(self.__trainer_ip_address)).json()
+        response = fetch_latest_model(self.__trainer_address, since_version=self.__model_version)
         self.__model.from_packet(response)
+        self.__model_version = response.get('version', None)
+        if ('epsilon' in response):
+            self.__epsilon = response['epsilon']
 
-    # Gets an image from AirSim
-    def __get_image(self):
-        image_response = self.__car_client.simGetImages([ImageRequest(0, AirSimImageType.Scene, False, False)])[0]
-        image1d = np.fromstring(image_response.image_data_uint8, dtype=np.uint8)
-        image_rgba = image1d.reshape(image_response.height, image_response.width, 4)
-
-        return image_rgba[76:135,0:255,0:3].astype(float)
+    # Gets the x and y coordinates of the car
+    def __get_car_position(self, car_state):
+        position = car_state.kinematics_true.position
+        return (position.x_val, position.y_val)
 
     # Computes the reward functinon based on the car position.
-    def __compute_reward(self, collision_info, car_state):
-        #Define some constant parameters for the reward function
-        THRESH_DIST = 3.5                # The maximum distance from the center of the road to compute the reward function
-        DISTANCE_DECAY_RATE = 1.2        # The rate at which the reward decays for the distance function
-        CENTER_SPEED_MULTIPLIER = 2.0    # The ratio at which we prefer the distance reward to the speed reward
-
-        # If the car has collided, the reward is always zero
-        if (collision_info.has_collided):
-            return 0.0, True
-        
-        # If the car is stopped, the reward is always zero
-        speed = car_state.speed
-        if (speed < 2):
-            return 0.0, True
-        
-        #Get the car position
-        position_key = bytes('position', encoding='utf8')
-        x_val_key = bytes('x_val', encoding='utf8')
-        y_val_key = bytes('y_val', encoding='utf8')
-
-        car_point = np.array([car_state.kinematics_true[position_key][x_val_key], car_state.kinematics_true[position_key][y_val_key], 0])
-        
-        # Distance component is exponential distance to nearest line
-        distance = 999
-        
-        #Compute the distance to the nearest center line
-        for line in self.__reward_points:
-            local_distance = 0
-            length_squared = ((line[0][0]-line[1][0])**2) + ((line[0][1]-line[1][1])**2)
-            if (length_squared != 0):
-                t = max(0, min(1, np.dot(car_point-line[0], line[1]-line[0]) / length_squared))
-                proj = line[0] + (t * (line[1]-line[0]))
-                local_distance = np.linalg.norm(proj - car_point)
-            
-            distance = min(local_distance, distance)
-            
-        distance_reward = math.exp(-(distance * DISTANCE_DECAY_RATE))
-        
-        return distance_reward, distance > THRESH_DIST
+    # The reward is the exponential distance to the nearest center line, and zero if the car has collided or stopped.
+    def __compute_reward(self, collision_info, car_state, car_position):
+        return self.__reward_function.compute_reward(car_position, car_state.speed, collision_info.has_collided)
 
     # Initializes the points used for determining the starting point of the vehicle
     def __init_road_points(self):
-        self.__road_points = []
-        car_start_coords = [12961.722656, 6660.329102, 0]
-
-        with open('road_lines.txt', 'r') as f:
-            for line in f:
-                points = line.split('\t')
-                first_point = np.array([float(p) for p in points[0].split(',')] + [0])
-                second_point = np.array([float(p) for p in points[1].split(',')] + [0])
-                self.__road_points.append(tuple((first_point, second_point)))
-
         # Points in road_points.txt are in unreal coordinates
         # But car start coordinates are not the same as unreal coordinates
-        for point_pair in self.__road_points:
-            for point in point_pair:
-                point[0] -= car_start_coords[0]
-                point[1] -= car_start_coords[1]
-                point[0] /= 100
-                point[1] /= 100
-              
+        road_segments = to_car_coordinates(load_road_segments('road_lines.txt'))
+
+        # The z coordinate is always zero
+        self.__road_points = np.concatenate([road_segments, np.zeros(road_segments.shape[0:2] + (1,))], axis=2)
+
     # Initializes the points used for determining the optimal position of the vehicle during the reward function
     def __init_reward_points(self):
-        self.__reward_points = []
-        with open('reward_points.txt', 'r') as f:
-            for line in f:
-                point_values = line.split('\t')
-                first_point = np.array([float(point_values[0]), float(point_values[1]), 0])
-                second_point = np.array([float(point_values[2]), float(point_values[3]), 0])
-                self.__reward_points.append(tuple((first_point, second_point)))
+        self.__reward_function = RewardFunction.from_file('reward_points.txt')
 
     # Randomly selects a starting point on the road
     # Used for initializing an iteration of data generation from AirSim
@@ -475,6 +666,15 @@ if __name__ == '__main__':
     min_epsilon = 0.1
     batch_size = 32
     replay_memory_size = 50
+    prioritized_replay = False         # True to sample by priority (prioritized experience replay) instead of uniformly
+    trainer_address = None             # e.g. '127.0.0.1:80' to train against a parameter server started with trainer.py
+    gradient_top_k_ratio = None        # e.g. 0.01 to only send the largest 1% of each layer's update to the trainer
+    gradient_quantization_bits = None  # 8 or 16 to quantize the update sent to the trainer
+    actor_learner = False              # Train on a separate thread while driving, instead of alternating between the two
+    learner_batches_per_iteration = 10
+    publish_every_batches = 50         # How often the learner sends its weights to the actor, in batches
+    learner_checkpoint_interval_sec = 300  # The least time between two checkpoints of the learner
+    actor_airsim_addresses = None      # e.g. ['127.0.0.1:42451', '127.0.0.1:42452'] to drive one actor process per simulator
     weights_path = "pretrain_model_weights.h5"
     train_conv_layers = False
     airsim_path = "/AD_Cookbook_AirSim"
@@ -482,5 +682,10 @@ if __name__ == '__main__':
 
     # Start the training
     agent = DistributedAgent(batch_update_frequency, max_epoch_runtime_sec, per_iter_epsilon_reduction, min_epsilon, batch_size
-                             , replay_memory_size, weights_path, train_conv_layers, airsim_path, experiment_name)
+                             , replay_memory_size, weights_path, train_conv_layers, airsim_path, experiment_name, prioritized_replay=prioritized_replay,
+                             trainer_address=trainer_address, gradient_top_k_ratio=gradient_top_k_ratio,
+                             gradient_quantization_bits=gradient_quantization_bits, actor_learner=actor_learner,
+                             learner_batches_per_iteration=learner_batches_per_iteration, publish_every_batches=publish_every_batches,
+                             learner_checkpoint_interval_sec=learner_checkpoint_interval_sec,
+                             actor_airsim_addresses=actor_airsim_addresses)
     agent.start()
@@ -0,0 +1,169 @@
+import argparse
+import datetime
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from rl_model import RlModel
+from tensor_packet import CheckpointWriter
+from wire_protocol import accepts_binary, decode_body, encode_body, ModelVersionTracker, SINCE_VERSION_PARAM
+
+
+# The parameter server that the agents send their gradient updates to.
+# It owns the reference copy of the model, applies the updates from all of the agents, updates the critic,
+# anneals epsilon, and serves the latest model to the agents.
+class ParameterServer(object):
+    def __init__(self, weights_path, train_conv_layers, batch_update_frequency, per_iter_epsilon_reduction, min_epsilon,
+                 max_staleness, experiment_name, checkpoint_interval_sec=300, keep_checkpoints=5):
+        self.__model = RlModel(weights_path, train_conv_layers)
+        self.__batch_update_frequency = int(batch_update_frequency)
+        self.__per_iter_epsilon_reduction = float(per_iter_epsilon_reduction)
+        self.__min_epsilon = float(min_epsilon)
+        self.__max_staleness = int(max_staleness)
+        self.__experiment_name = experiment_name
+
+        # The checkpoints are written with a critic update, at most every checkpoint_interval_sec, and only the last keep_checkpoints are kept
+        self.__checkpoint_writer = CheckpointWriter(os.path.join('checkpoint', experiment_name), checkpoint_interval_sec, keep_checkpoints)
+
+        self.__epsilon = 1.0
+        self.__num_batches_run = 0
+        self.__last_critic_update_batch_count = 0
+        self.__num_updates_applied = 0
+        self.__num_updates_rejected = 0
+
+        # The model is shared by all of the request handler threads
+        self.__lock = threading.Lock()
+        self.__versions = ModelVersionTracker()
+        self.__versions.update(self.__model.to_packet(get_target=True, as_lists=False))
+
+    # Returns the latest model, with only the layers that changed after since_version if it is given.
+    # The current epsilon is broadcast to the agents along with the model.
+    def get_latest(self, since_version=None):
+        with self.__lock:
+            packet = self.__versions.delta_packet(since_version)
+            packet['epsilon'] = self.__epsilon
+            return packet
+
+    # Applies a gradient update sent by an agent.
+    # The update was computed against the model version the agent had. If other updates have been applied since then, the update is stale.
+    # Stale updates are scaled down by 1 / (1 + staleness), and updates that are more than max_staleness versions old are dropped.
+    def apply_update(self, update):
+        with self.__lock:
+            agent_version = update.get('model_version', None)
+            staleness = 0 if agent_version is None else max(0, self.__versions.version - int(agent_version))
+
+            response = {'staleness': staleness}
+            if (staleness > self.__max_staleness):
+                self.__num_updates_rejected += 1
+                print('Rejected update that is {0} versions old'.format(staleness))
+                response['accepted'] = False
+            else:
+                scale = 1.0 / (1.0 + staleness)
+
+                # The target network is refreshed every batch_update_frequency batches
+                self.__num_batches_run += int(update.get('batch_count', 0))
+                should_update_critic = (self.__num_batches_run > self.__batch_update_frequency + self.__last_critic_update_batch_count)
+
+                self.__model.update_with_gradient(update['gradients'], should_update_critic, scale)
+                self.__num_updates_applied += 1
+
+                # Each update corresponds to an epoch of one agent, which is when the agent would reduce its own epsilon
+                self.__epsilon = max(self.__epsilon - self.__per_iter_epsilon_reduction, self.__min_epsilon)
+
+                packet = self.__model.to_packet(get_target=True, as_lists=False)
+                self.__versions.update(packet)
+
+                if should_update_critic:
+                    self.__last_critic_update_batch_count = self.__num_batches_run
+                    if self.__checkpoint_writer.is_due():
+                        self.__checkpoint(packet)
+
+                response['accepted'] = True
+
+            response['epsilon'] = self.__epsilon
+            response['version'] = self.__versions.version
+            return response
+
+    def get_status(self):
+        with self.__lock:
+            status = {}
+            status['version'] = self.__versions.version
+            status['epsilon'] = self.__epsilon
+            status['num_batches_run'] = self.__num_batches_run
+            status['num_updates_applied'] = self.__num_updates_applied
+            status['num_updates_rejected'] = self.__num_updates_rejected
+            return status
+
+    def __checkpoint(self, packet):
+        checkpoint = {}
+        checkpoint['model'] = packet
+        checkpoint['batch_count'] = self.__num_batches_run
+        self.__checkpoint_writer.save(self.__num_batches_run, checkpoint)
+
+
+# Serves the parameter server over HTTP.
+#   GET  /latest[?since=<version>]  the latest model and epsilon
+#   POST /gradient_update           applies a gradient update, returns whether it was accepted and the new epsilon
+#   GET  /status                    counters for monitoring
+# Bodies are binary tensor packets if the client accepts them, and JSON otherwise.
+class ParameterServerRequestHandler(BaseHTTPRequestHandler):
+    parameter_server = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if (url.path == '/latest'):
+            query = parse_qs(url.query)
+            since_version = int(query[SINCE_VERSION_PARAM][0]) if SINCE_VERSION_PARAM in query else None
+            self.__respond(self.parameter_server.get_latest(since_version))
+        elif (url.path == '/status'):
+            self.__respond(self.parameter_server.get_status())
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if (url.path == '/gradient_update'):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            update = decode_body(body, self.headers.get('Content-Type'))
+            self.__respond(self.parameter_server.apply_update(update))
+        else:
+            self.send_error(404)
+
+    def __respond(self, packet):
+        body, content_type = encode_body(packet, accepts_binary(self.headers.get('Accept')))
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Only log errors, the agents poll the server continuously
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs the parameter server that the distributed agents train against.')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=80)
+    parser.add_argument('--weights_path', default='pretrain_model_weights.h5')
+    parser.add_argument('--train_conv_layers', action='store_true')
+    parser.add_argument('--batch_update_frequency', type=int, default=10)
+    parser.add_argument('--per_iter_epsilon_reduction', type=float, default=0.003)
+    parser.add_argument('--min_epsilon', type=float, default=0.1)
+    parser.add_argument('--max_staleness', type=int, default=8)
+    parser.add_argument('--experiment_name', default='rl_run_distributed')
+    parser.add_argument('--checkpoint_interval_sec', type=float, default=300, help='The least time between two checkpoints')
+    parser.add_argument('--keep_checkpoints', type=int, default=5, help='The number of most recent checkpoints kept on disk')
+    args = parser.parse_args()
+
+    print('Starting time: {0}'.format(datetime.datetime.utcnow()), file=sys.stderr)
+    ParameterServerRequestHandler.parameter_server = ParameterServer(args.weights_path, args.train_conv_layers, args.batch_update_frequency,
+                                                                     args.per_iter_epsilon_reduction, args.min_epsilon, args.max_staleness,
+                                                                     args.experiment_name, args.checkpoint_interval_sec, args.keep_checkpoints)
+
+    server = ThreadingHTTPServer((args.host, args.port), ParameterServerRequestHandler)
+    print('Parameter server listening on {0}:{1}'.format(args.host, args.port))
+    server.serve_forever()
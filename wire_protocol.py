@@ -0,0 +1,137 @@
+import json
+
+import numpy as np
+import requests
+
+from tensor_packet import dumps_packet, loads_packet
+
+
+# The HTTP content types of the two encodings of a packet.
+# Agents list the binary encoding first in their Accept header. A trainer that does not know about it answers with JSON,
+# and a response is always decoded according to its Content-Type, so either side can fall back to JSON.
+# Agents stop posting binary bodies to a trainer that answers with JSON or rejects them.
+BINARY_CONTENT_TYPE = 'application/x-tensor-packet'
+JSON_CONTENT_TYPE = 'application/json'
+ACCEPT_HEADER = '{0}, {1};q=0.5'.format(BINARY_CONTENT_TYPE, JSON_CONTENT_TYPE)
+
+# The query parameter with which an agent asks for the layers that changed after the version it already has
+SINCE_VERSION_PARAM = 'since'
+
+# The statuses with which a trainer that only knows JSON rejects a binary body
+UNSUPPORTED_BODY_STATUSES = (400, 415)
+
+# Whether the trainer at each address supports the binary encoding, learned from its responses.
+# A trainer answers in binary when the Accept header allows it, so a JSON answer means that it only knows JSON.
+_binary_support = {}
+
+
+# Converts the arrays in a packet to nested lists, so that it can be serialized to JSON
+def to_json_compatible(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, dict):
+        return {k: to_json_compatible(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_json_compatible(v) for v in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+# Returns true if the Accept header of a request allows the binary encoding
+def accepts_binary(accept_header):
+    if not accept_header:
+        return False
+    return any(part.split(';')[0].strip() == BINARY_CONTENT_TYPE for part in accept_header.split(','))
+
+
+# Encodes a packet for an HTTP body. Returns the body and its content type.
+def encode_body(packet, binary):
+    if binary:
+        return dumps_packet(packet), BINARY_CONTENT_TYPE
+    return json.dumps(to_json_compatible(packet)).encode('utf-8'), JSON_CONTENT_TYPE
+
+
+def is_binary_content_type(content_type):
+    return content_type is not None and content_type.split(';')[0].strip() == BINARY_CONTENT_TYPE
+
+
+# Decodes an HTTP body according to its content type.
+# Tensors of a binary body are returned as arrays, those of a JSON body as nested lists.
+def decode_body(body, content_type):
+    if is_binary_content_type(content_type):
+        return loads_packet(body)
+    return json.loads(body.decode('utf-8') if isinstance(body, (bytes, bytearray)) else body)
+
+
+# Keeps a version number for each layer of a model packet, so that only the layers that changed need to be sent.
+# Every call to update bumps the global version. A layer takes the new version only if its weights differ from the previous packet.
+class ModelVersionTracker(object):
+    def __init__(self):
+        self.__version = 0
+        self.__packet = None
+        self.__layer_versions = {}
+
+    @property
+    def version(self):
+        return self.__version
+
+    # Records a new packet from RlModel.to_packet(as_lists=False)
+    def update(self, packet):
+        self.__version += 1
+        for field_name, layers in packet.items():
+            previous_layers = self.__packet.get(field_name) if self.__packet is not None else None
+            versions = self.__layer_versions.get(field_name)
+            if (previous_layers is None or versions is None or len(previous_layers) != len(layers)):
+                self.__layer_versions[field_name] = [self.__version] * len(layers)
+                continue
+            for i in range(0, len(layers), 1):
+                if not np.array_equal(previous_layers[i], layers[i]):
+                    versions[i] = self.__version
+        self.__packet = {field_name: [np.array(w, copy=True) for w in layers] for field_name, layers in packet.items()}
+
+    # Returns the latest packet with the layers that have not changed since since_version replaced by None.
+    # RlModel.from_packet keeps its current weights for those layers.
+    def delta_packet(self, since_version=None):
+        if (self.__packet is None):
+            raise ValueError('No model has been recorded yet')
+
+        packet = {}
+        for field_name, layers in self.__packet.items():
+            versions = self.__layer_versions[field_name]
+            if (since_version is None or since_version > self.__version):
+                packet[field_name] = list(layers)
+            else:
+                packet[field_name] = [w if (versions[i] > since_version) else None for i, w in enumerate(layers)]
+        packet['version'] = self.__version
+        return packet
+
+
+# Downloads the latest model from the trainer.
+# If since_version is given, only the layers that changed after that version are sent, the others are None.
+def fetch_latest_model(address, since_version=None, timeout=None):
+    params = {}
+    if (since_version is not None):
+        params[SINCE_VERSION_PARAM] = since_version
+
+    response = requests.get('http://{0}/latest'.format(address), params=params, headers={'Accept': ACCEPT_HEADER}, timeout=timeout)
+    response.raise_for_status()
+    _binary_support[address] = is_binary_content_type(response.headers.get('Content-Type'))
+    return decode_body(response.content, response.headers.get('Content-Type'))
+
+
+# Sends a packet to the trainer and returns the decoded response.
+# With binary, the packet is sent in the binary encoding unless the trainer answered a previous request with JSON.
+# If the trainer rejects the binary body, the packet is sent again as JSON, and so are the next ones.
+def post_packet(address, path, packet, binary=True, timeout=None):
+    binary = binary and _binary_support.get(address, True)
+    body, content_type = encode_body(packet, binary)
+    response = requests.post('http://{0}/{1}'.format(address, path), data=body,
+                             headers={'Content-Type': content_type, 'Accept': ACCEPT_HEADER}, timeout=timeout)
+    if (binary and response.status_code in UNSUPPORTED_BODY_STATUSES):
+        print('The trainer at {0} rejected a binary packet with status {1}, falling back to JSON'.format(address, response.status_code))
+        _binary_support[address] = False
+        return post_packet(address, path, packet, False, timeout)
+    response.raise_for_status()
+    _binary_support[address] = is_binary_content_type(response.headers.get('Content-Type'))
+    return decode_body(response.content, response.headers.get('Content-Type'))